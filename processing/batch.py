@@ -0,0 +1,340 @@
+'''
+Whole-study batch processing
+
+Runs the stages
+
+    convert  XDF files -> stream exports, see xdf_convert
+    ecg      stream exports -> extracted_csv/ecg_<vp_code>.csv, see ecg_process
+    eeg      stream exports -> extracted_csv/eeg_freq_<vp_code>.csv, see eeg_freq
+
+or, with --output, to the partitions of the subject in a study results
+dataset, see processing.shared.results
+
+for all subjects of a study on a process pool. Subjects are processed
+independently: If a stage fails, the run continues with the other subjects;
+if the conversion of a subject fails, its processing stages are skipped. A
+stage is also skipped if all its outputs are newer than its inputs, i.e.
+rerunning a study only processes new or changed subjects.
+
+The stages run on a subject are profiled to <vp_code>_batch_profile.json in
+its folder, see processing.shared.profiling. With --profile, allocations are
+traced as well and the hottest spans across all subjects are printed.
+'''
+import concurrent.futures
+import enum
+import logging
+import pathlib
+import typing as T
+
+import click
+
+from processing import ecg_process, ecg_rpeaks, eeg_freq
+from processing.ecg_rpeaks import RPeakOptions
+from processing.shared import profiling
+from processing.shared.recording import Recording
+from processing.shared.streams import FILE_SUFFIXES, STREAM_TYPES, OutputFormat
+from processing.shared.xdf_convert import convert_folder, group_by_folder
+
+logger = logging.getLogger(__name__)
+
+
+class Stage(enum.Enum):
+    CONVERT = "convert"
+    ECG = "ecg"
+    EEG = "eeg"
+
+
+class Status(enum.Enum):
+    DONE = "done"
+    UP_TO_DATE = "up to date"
+    FAILED = "failed"
+    BLOCKED = "blocked"
+    '''Not run because the conversion of the subject failed'''
+
+
+class StageResult(T.NamedTuple):
+    stage: Stage
+    status: Status
+    message: str = ""
+
+
+class BatchOptions(T.NamedTuple):
+    stages: T.Tuple[Stage, ...] = tuple(Stage)
+    force: bool = False
+    streaming: bool = False
+    sample_store: bool = False
+    rpeak_options: RPeakOptions = RPeakOptions()
+    detect_once: bool = False
+    chunked_eeg: bool = False
+    use_cache: bool = True
+    output: T.Optional[pathlib.Path] = None
+    '''Study results dataset, defaults to CSV files per subject'''
+    track_allocations: bool = False
+    '''Trace the Python allocations of each span, see shared.profiling'''
+
+
+class Subject(T.NamedTuple):
+    directory: pathlib.Path
+    xdf_paths: T.List[pathlib.Path]
+
+
+def find_subjects(roots: T.Iterable[pathlib.Path]) -> T.List[Subject]:
+    """Subject folders below roots, i.e. folders with XDF files or marker exports"""
+    xdf_paths = {}
+    for root in roots:
+        root = pathlib.Path(root).resolve()
+        for group in group_by_folder(root.rglob("*.xdf")):
+            xdf_paths[group[0].parent] = group
+        marker_pattern = f"*{FILE_SUFFIXES[STREAM_TYPES.marker]}{OutputFormat.PARQUET.value}"
+        for recording in Recording.find_by_pattern(marker_pattern, root):
+            xdf_paths.setdefault(recording.directory.resolve(), [])
+    return [Subject(directory, paths) for directory, paths in sorted(xdf_paths.items())]
+
+
+def process_subject(subject: Subject, options: BatchOptions) -> T.List[StageResult]:
+    """Runs all stages of one subject and writes their profile; never raises"""
+    results = []
+    profiler = profiling.Profiler(options.track_allocations)
+    conversion_failed = False
+    for stage in options.stages:
+        if conversion_failed:
+            results.append(StageResult(stage, Status.BLOCKED))
+            continue
+        try:
+            if not options.force and is_up_to_date(stage, subject, options.output):
+                results.append(StageResult(stage, Status.UP_TO_DATE))
+                continue
+            with profiler, profiling.span(stage.value):
+                run_stage(stage, subject, options)
+            results.append(StageResult(stage, Status.DONE))
+        except Exception as err:
+            logger.exception(f"Stage {stage.value} of {subject.directory} failed")
+            results.append(StageResult(stage, Status.FAILED, f"{type(err).__name__}: {err}"))
+            conversion_failed = stage is Stage.CONVERT
+    if profiler.records:
+        profiler.write(profile_path(subject), vp_code=subject.directory.name, command="batch")
+    return results
+
+
+def profile_path(subject: Subject) -> pathlib.Path:
+    return profiling.profile_path(subject.directory, subject.directory.name, "batch")
+
+
+def run_stage(stage: Stage, subject: Subject, options: BatchOptions):
+    if stage is Stage.CONVERT:
+        if not subject.xdf_paths:
+            raise FileNotFoundError(f"No XDF files in {subject.directory}")
+        convert_folder(
+            subject.xdf_paths,
+            OutputFormat.PARQUET,
+            streaming=options.streaming,
+            sample_store=options.sample_store,
+        )
+    elif stage is Stage.ECG:
+        ecg_process.write_results(
+            *ecg_process.submit_folder(
+                subject.directory,
+                detect_once=options.detect_once,
+                options=options.rpeak_options,
+                use_cache=options.use_cache,
+            ),
+            output=options.output,
+        )
+    elif stage is Stage.EEG:
+        path = eeg_freq.process_folder(
+            subject.directory, options.chunked_eeg, options.use_cache, options.output
+        )
+        if path is None:
+            raise KeyError(f"Unknown vp_code of {subject.directory}")
+
+
+def is_up_to_date(
+    stage: Stage, subject: Subject, output: T.Optional[pathlib.Path] = None
+) -> bool:
+    """Checks whether all outputs of a stage exist and are newer than its inputs"""
+    R = Recording(subject.directory)
+    if stage is Stage.CONVERT:
+        outputs = [
+            path
+            for path in (R.marker_path(), R.ecg_path(), R.eeg_path(), R.eye_tracking_path())
+            if path is not None
+        ]
+        if not subject.xdf_paths:
+            # Nothing to convert from, i.e. exports were copied into the study
+            return bool(outputs)
+        inputs = subject.xdf_paths
+    else:
+        stream_type, module = {
+            Stage.ECG: (STREAM_TYPES.brainvision_eda, ecg_process),
+            Stage.EEG: (STREAM_TYPES.g_tec, eeg_freq),
+        }[stage]
+        try:
+            inputs = R.stream_files(stream_type) + _marker_files(R)
+        except FileNotFoundError:
+            return False
+        outputs = [module.result_path(R, output)]
+    if not outputs or not all(path.exists() for path in outputs):
+        return False
+    return min(map(_mtime, outputs)) >= max(map(_mtime, inputs), default=0)
+
+
+def _marker_files(R: Recording) -> T.List[pathlib.Path]:
+    marker_path = R.marker_path()
+    if marker_path is None:
+        raise FileNotFoundError(f"No marker export found in {R.directory}")
+    fixes = (R.marker_path_invalid(), R.marker_path_missing())
+    return [marker_path] + [path for path in fixes if path.exists()]
+
+
+def _mtime(path: pathlib.Path) -> float:
+    """Modification time of a file, or of the newest file in a dataset directory"""
+    if path.is_dir():
+        mtimes = [file.stat().st_mtime for file in path.rglob("*")]
+        return max(mtimes, default=path.stat().st_mtime)
+    return path.stat().st_mtime
+
+
+@click.command()
+@click.option(
+    "--jobs",
+    "-j",
+    default=1,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Number of subjects processed in parallel",
+)
+@click.option(
+    "--stage",
+    "stages",
+    multiple=True,
+    type=click.Choice([stage.value for stage in Stage]),
+    help="Stage to run, may be repeated  [default: all stages]",
+)
+@click.option(
+    "--force",
+    is_flag=True,
+    help="Rerun stages even if their outputs are newer than their inputs",
+)
+@click.option(
+    "--streaming/--in-memory",
+    default=False,
+    show_default=True,
+    help="Convert XDF files chunk by chunk, see xdf_convert",
+)
+@click.option(
+    "--sample-store",
+    is_flag=True,
+    help="Build memory-mapped sample stores of the numeric streams during conversion",
+)
+@click.option(
+    "--detector",
+    default=RPeakOptions().detector,
+    show_default=True,
+    type=click.Choice(sorted(ecg_rpeaks.DETECTORS)),
+    help="R-peak detector",
+)
+@click.option(
+    "--detect-once/--detect-per-period",
+    default=False,
+    show_default=True,
+    help="Detect R-peaks once per recording instead of once per period",
+)
+@click.option(
+    "--chunked-eeg",
+    is_flag=True,
+    help="Filter the EEG block by block from its sample store, see eeg_freq --chunked",
+)
+@click.option(
+    "--cache/--no-cache",
+    "use_cache",
+    default=True,
+    show_default=True,
+    help="Reuse stage results cached in <folder>/.cache by earlier runs",
+)
+@click.option(
+    "--output",
+    type=click.Path(file_okay=False),
+    help="Study results dataset to write to instead of per-subject CSV files",
+)
+@click.option(
+    "--profile",
+    is_flag=True,
+    help="Trace allocations and print the hottest spans across all processed subjects",
+)
+@profiling.verbose_option
+@profiling.quiet_option
+@click.argument("roots", nargs=-1, type=click.Path(exists=True, file_okay=False))
+def main(
+    roots,
+    jobs,
+    stages,
+    force,
+    streaming,
+    sample_store,
+    detector,
+    detect_once,
+    chunked_eeg,
+    use_cache,
+    output,
+    profile,
+    verbose,
+    quiet,
+):
+    """Converts and processes all subjects of a study
+
+    roots: Study folders, searched recursively for subject folders with XDF
+    files or exported markers
+
+    Output: Stream exports and extracted_csv/ next to the XDF files, or the
+    --output results dataset, see xdf_convert, ecg_process and eeg_freq, and a
+    profile <vp_code>_batch_profile.json per processed subject
+    """
+    profiling.configure_logging(verbose, quiet)
+    options = BatchOptions(
+        stages=tuple(Stage(stage) for stage in stages) if stages else tuple(Stage),
+        force=force,
+        streaming=streaming,
+        sample_store=sample_store,
+        rpeak_options=RPeakOptions(detector=detector),
+        detect_once=detect_once,
+        chunked_eeg=chunked_eeg,
+        use_cache=use_cache,
+        output=pathlib.Path(output).resolve() if output is not None else None,
+        track_allocations=profile,
+    )
+    subjects = find_subjects(pathlib.Path(root) for root in roots)
+    logger.info(f"Found {len(subjects)} subjects")
+
+    if jobs == 1:
+        results = [process_subject(subject, options) for subject in subjects]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [
+                executor.submit(process_subject, subject, options) for subject in subjects
+            ]
+            results = [future.result() for future in futures]
+
+    print("Summary:")
+    num_failed = 0
+    for subject, subject_results in zip(subjects, results):
+        print(f"\t{subject.directory}")
+        for result in subject_results:
+            print(f"\t\t{result.stage.value}: {result.status.value} {result.message}".rstrip())
+            num_failed += result.status is Status.FAILED
+    if profile:
+        processed = [
+            subject
+            for subject, subject_results in zip(subjects, results)
+            if any(result.status in (Status.DONE, Status.FAILED) for result in subject_results)
+        ]
+        if processed:
+            profiles = [profiling.read_profile(profile_path(subject)) for subject in processed]
+            print(f"Hottest spans of {len(processed)} subjects:")
+            print(profiling.format_hot_spans(profiling.aggregate(profiles)))
+    if num_failed:
+        print(f"{num_failed} stages failed.")
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
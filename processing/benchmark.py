@@ -0,0 +1,325 @@
+'''
+Benchmarks of all pipeline stages on synthetic recordings
+
+    python -m processing.benchmark --duration 10min --duration 1h --history benchmarks.jsonl
+
+For each recording length a synthetic subject is generated (see
+processing.synthetic), converted and processed. Every stage runs in a fresh
+process, such that its peak resident memory is not hidden by the peak of an
+earlier stage. Stages time their work only, loading the inputs of e.g. the
+period selection is not included, but counts towards the memory peak.
+
+Results are printed and appended as JSON lines to the history file, together
+with the git revision, to track regressions across commits.
+'''
+import concurrent.futures
+import contextlib
+import datetime
+import json
+import multiprocessing
+import os
+import pathlib
+import platform
+import subprocess
+import tempfile
+import time
+import typing as T
+
+import click
+
+from processing import ecg_rpeaks
+from processing.ecg_rpeaks import RPeakOptions
+from processing.synthetic import SyntheticOptions, SyntheticRecording, XDF_NAME
+from processing.shared import profiling
+from processing.shared.streams import OutputFormat, STREAM_TYPES
+from processing.shared.xdf_convert import NUMERIC_STREAMS, convert_folder
+
+DURATIONS = {"10min": 600, "1h": 3600, "8h": 8 * 3600}
+
+# Known to the lookup tables in processing/data
+VP_CODE = "ABC12"
+
+
+class StageResult(T.NamedTuple):
+    stage: str
+    duration: str
+    duration_s: float
+    seconds: float
+    samples: int
+    baseline_rss_mb: float
+    '''Resident memory of the fresh process'''
+    peak_rss_mb: float
+
+    @property
+    def samples_per_s(self) -> float:
+        return self.samples / self.seconds if self.seconds else float("inf")
+
+    @property
+    def realtime_factor(self) -> float:
+        return self.duration_s / self.seconds if self.seconds else float("inf")
+
+
+def _convert(directory: pathlib.Path, detector: str, streaming: bool = False):
+    paths = sorted(directory.glob("*.xdf"))
+    return lambda: convert_folder(
+        paths, OutputFormat.PARQUET, streaming=streaming, sample_store=streaming
+    )
+
+
+def _convert_streaming(directory: pathlib.Path, detector: str):
+    return _convert(directory, detector, streaming=True)
+
+
+def _ecg_inputs(directory: pathlib.Path):
+    from processing.ecg_process import ECG_CHANNEL
+    from processing.shared.recording import Recording
+
+    R = Recording(directory)
+    data = R.read_stream(STREAM_TYPES.brainvision_eda, columns=[ECG_CHANNEL])
+    return R, data, R.read_markers()
+
+
+def _select(directory: pathlib.Path, detector: str):
+    from processing.helpers import Helper
+    from processing.shared.markers_example import Periods
+    from processing.shared.select_data import select_from_data
+
+    _, data, markers = _ecg_inputs(directory)
+
+    def run():
+        for block in select_from_data(data, markers, Periods.block):
+            Helper.extract_periods(block)
+
+    return run
+
+
+def _period_slices(directory: pathlib.Path, detector: str):
+    from processing.shared.select_data import period_slices
+
+    R, data, markers = _ecg_inputs(directory)
+    labels = [cond.value for cond in R.condition_order()]
+
+    def run():
+        slices = period_slices(data.index.values, markers, labels)
+        for _ in slices.take(data):
+            pass
+
+    return run
+
+
+def _ecg(directory: pathlib.Path, detector: str, detect_once: bool = False):
+    from processing import ecg_process
+
+    options = RPeakOptions(detector=detector)
+    return lambda: ecg_process.write_results(
+        *ecg_process.submit_folder(directory, detect_once=detect_once, options=options)
+    )
+
+
+def _ecg_once(directory: pathlib.Path, detector: str):
+    return _ecg(directory, detector, detect_once=True)
+
+
+def _eeg(directory: pathlib.Path, detector: str, chunked: bool = False):
+    from processing import eeg_freq
+
+    return lambda: eeg_freq.process_folder(directory, chunked=chunked)
+
+
+def _eeg_chunked(directory: pathlib.Path, detector: str):
+    return _eeg(directory, detector, chunked=True)
+
+
+def _online(directory: pathlib.Path, detector: str):
+    from processing import online
+
+    path = directory / XDF_NAME.format(vp_code=VP_CODE)
+    names = [STREAM_TYPES.marker, STREAM_TYPES.brainvision_eda, STREAM_TYPES.g_tec]
+    source = online.XDFReplaySource(path, speed=None, names=names)
+    options = online.OnlineOptions(detector=detector)
+    engine = online.OnlineEngine.for_streams(source.headers(), options)
+
+    def run():
+        for _ in engine.process(source):
+            pass
+
+    return run
+
+
+# Stages in the order they run, by name. Each takes the subject folder and
+# the R-peak detector, loads its inputs and returns the function to time.
+STAGES: T.Dict[str, T.Callable[[pathlib.Path, str], T.Callable[[], T.Any]]] = {
+    "convert": _convert,
+    "convert_streaming": _convert_streaming,
+    "select": _select,
+    "period_slices": _period_slices,
+    "ecg": _ecg,
+    "ecg_once": _ecg_once,
+    "eeg": _eeg,
+    "eeg_chunked": _eeg_chunked,
+    "online": _online,
+}
+
+# Streams whose samples each stage processes
+STAGE_STREAMS = {
+    "convert": NUMERIC_STREAMS,
+    "convert_streaming": NUMERIC_STREAMS,
+    "select": [STREAM_TYPES.brainvision_eda],
+    "period_slices": [STREAM_TYPES.brainvision_eda],
+    "ecg": [STREAM_TYPES.brainvision_eda],
+    "ecg_once": [STREAM_TYPES.brainvision_eda],
+    "eeg": [STREAM_TYPES.g_tec],
+    "eeg_chunked": [STREAM_TYPES.g_tec],
+    "online": [STREAM_TYPES.brainvision_eda, STREAM_TYPES.g_tec],
+}
+
+
+def _run_stage(
+    stage: str, directory: pathlib.Path, detector: str, verbose: bool
+) -> T.Tuple[float, float, float]:
+    """Runs a stage in the current process, returns seconds and baseline and peak RSS"""
+    baseline_rss_mb = profiling.peak_rss_mb()
+    profiling.configure_logging(quiet=not verbose)
+    with open(os.devnull, "w") as devnull, contextlib.ExitStack() as stack:
+        if not verbose:
+            # MNE logs to stdout with its own handler
+            stack.enter_context(contextlib.redirect_stdout(devnull))
+        run = STAGES[stage](directory, detector)
+        start = time.perf_counter()
+        run()
+        seconds = time.perf_counter() - start
+    return seconds, baseline_rss_mb, profiling.peak_rss_mb()
+
+
+def generate(root: pathlib.Path, duration_s: float, seed: int = 0) -> SyntheticRecording:
+    """Writes the XDF file and the converted exports of the benchmark subject"""
+    directory = root / VP_CODE
+    directory.mkdir(parents=True, exist_ok=True)
+    recording = SyntheticRecording(SyntheticOptions(duration_s=duration_s, seed=seed))
+    recording.write_xdf(directory / XDF_NAME.format(vp_code=VP_CODE))
+    # Stages after the conversion also run if the conversion is not benchmarked
+    recording.write_parquet(directory, VP_CODE)
+    return recording
+
+
+def run_benchmarks(
+    duration: str,
+    stages: T.Sequence[str],
+    root: pathlib.Path,
+    detector: str = RPeakOptions().detector,
+    verbose: bool = False,
+) -> T.Iterator[StageResult]:
+    """Generates a recording of the given duration in root and benchmarks stages on it"""
+    duration_s = DURATIONS[duration]
+    start = time.perf_counter()
+    recording = generate(root, duration_s)
+    seconds = time.perf_counter() - start
+    samples = {stream_type: recording.num_samples(stream_type) for stream_type in NUMERIC_STREAMS}
+    # Generation runs in this process, its memory is not measured
+    yield StageResult(
+        "generate", duration, duration_s, seconds, sum(samples.values()), float("nan"), float("nan")
+    )
+
+    context = multiprocessing.get_context("spawn")
+    for stage in (stage for stage in STAGES if stage in stages):
+        # A fresh process per stage, such that peak memory is per stage
+        with concurrent.futures.ProcessPoolExecutor(1, mp_context=context) as executor:
+            seconds, baseline_rss_mb, peak_rss_mb = executor.submit(
+                _run_stage, stage, root / VP_CODE, detector, verbose
+            ).result()
+        num_samples = sum(samples[stream_type] for stream_type in STAGE_STREAMS[stage])
+        yield StageResult(
+            stage, duration, duration_s, seconds, num_samples, baseline_rss_mb, peak_rss_mb
+        )
+
+
+def git_revision() -> T.Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=pathlib.Path(__file__).parent,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def history_entry(result: StageResult, detector: str, revision: T.Optional[str]) -> dict:
+    return {
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "revision": revision,
+        "python": platform.python_version(),
+        "detector": detector,
+        **result._asdict(),
+        "samples_per_s": result.samples_per_s,
+        "realtime_factor": result.realtime_factor,
+    }
+
+
+def format_result(result: StageResult) -> str:
+    return (
+        f"{result.duration:>6} {result.stage:<18} {result.seconds:9.2f} s "
+        f"{result.samples_per_s:12.0f} samples/s "
+        f"{result.realtime_factor:9.0f} x real time "
+        f"{result.peak_rss_mb:8.0f} MB peak ({result.baseline_rss_mb:.0f} MB baseline)"
+    )
+
+
+@click.command()
+@click.option(
+    "--duration",
+    "durations",
+    multiple=True,
+    type=click.Choice(list(DURATIONS)),
+    help="Recording length, can be given multiple times  [default: all]",
+)
+@click.option(
+    "--stage",
+    "stages",
+    multiple=True,
+    type=click.Choice(list(STAGES)),
+    help="Stage to benchmark, can be given multiple times  [default: all]",
+)
+@click.option(
+    "--detector",
+    default=RPeakOptions().detector,
+    show_default=True,
+    type=click.Choice(sorted(ecg_rpeaks.DETECTORS)),
+    help="R-peak detector of the ECG and online stages",
+)
+@click.option(
+    "--workdir",
+    type=click.Path(file_okay=False),
+    help="Folder for the synthetic recordings, a temporary folder if not given",
+)
+@click.option(
+    "--history",
+    type=click.Path(dir_okay=False),
+    help="JSON lines file the results are appended to",
+)
+@click.option("--verbose", is_flag=True, help="Show the log messages of the stages")
+def main(durations, stages, detector, workdir, history, verbose):
+    """Benchmarks the pipeline stages on synthetic recordings
+
+    Output: Time, throughput and peak memory per stage and recording length
+    """
+    durations = durations or list(DURATIONS)
+    stages = stages or list(STAGES)
+    revision = git_revision()
+    with contextlib.ExitStack() as stack:
+        if workdir is None:
+            workdir = stack.enter_context(tempfile.TemporaryDirectory())
+        for duration in durations:
+            root = pathlib.Path(workdir) / duration
+            print(f"Benchmarking {duration} recordings in {root}")
+            for result in run_benchmarks(duration, stages, root, detector, verbose):
+                print(format_result(result))
+                if history is not None:
+                    with open(history, "a") as f:
+                        f.write(json.dumps(history_entry(result, detector, revision)) + "\n")
+
+
+if __name__ == "__main__":
+    main()
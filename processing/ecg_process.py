@@ -4,125 +4,345 @@ Authors: Kerstin Pieper, Pablo Prietz
 Basic steps to extract parameters from ECG raw data
 
 '''
-import itertools
+import collections
+import concurrent.futures
+import logging
 import pathlib
 
 import click
-import neurokit as nk
+import numpy as np
 import pandas as pd
 
-from processing.shared.markers_example import Periods
-from processing.shared.select_data import select_data
+from processing import ecg_rpeaks, hrv
+from processing.ecg_rpeaks import RPeakOptions
+from processing.shared import profiling
+from processing.shared import results as results_dataset
+from processing.shared.cache import StageCache
+from processing.shared.select_data import period_slices
 from processing.shared.recording import Recording
+from processing.shared.streams import STREAM_TYPES
 
+ECG_CHANNEL = "ECG"
+# Modality of the results in a study results dataset, see processing.shared.results
+RESULTS_MODALITY = "ecg"
+# File name prefix of the per-subject CSV in extracted_csv/
+CSV_PREFIX = "ecg_"
+BASELINE_NAMES = ("baseline_h", "baseline_l")
+# HRV metrics written per period and their names in the result files
+RESULT_COLUMNS = {"hr_mean": "hr_mean", "sdnn": "sdnn", "rmssd": "rMSSD"}
 
-def process_ecg(data):
-    """Process_ecg uses neurokit to extract features from raw data.
+logger = logging.getLogger(__name__)
+
+
+def process_ecg(data, options=RPeakOptions(), cache=None):
+    """Extracts HR, sdNN and RMSSD from the raw ECG data of one period
 
     :param
-    data: pandas DataFrame
-        Recorded raw data is saved as DataFrame before
+    data: pandas Series
+        Recorded raw data of one period
+    options: RPeakOptions
+        R-peak detector, sampling rate and decimation
+    cache: StageCache, optional
+        Cache of the detected R-peaks
     :return:
     result_series: pandas Series
-        Includes extracted features (HR, sdNN, RMSSD)
+        Includes extracted features (HR, sdNN, RMSSD), see period_stats()
     """
-    print("\tStarting ecg processing...")
-    result = nk.ecg_process(
-        data,
-        sampling_rate=1000,     # must fit to current recording
-    )
+    logger.info("\tStarting ecg processing...")
+    if data.empty:
+        # Like hrv_windows() for windows without R-peaks
+        logger.warning("\tNo ECG samples in this period.")
+        return pd.Series(np.nan, index=list(RESULT_COLUMNS.values()))
+    rpeak_ts = detect_rpeaks(data, options, cache)
+    time_stamps = data.index.values
+    with profiling.span("hrv"):
+        stats = period_stats(rpeak_ts, time_stamps[:1], time_stamps[-1:])
+    logger.info("\tFinished ecg processing.")
+    return stats.iloc[0]
 
-    result["df"].set_index(data.index, inplace=True)
-    hrv_results = result["ECG"]["HRV"]
-    sdnn = hrv_results["sdNN"]
-    rMSSD = hrv_results["RMSSD"]
-    hr_mean = result["df"].Heart_Rate
-    print("\tFinished ecg processing.")
 
-    result_series = pd.Series(
-        [hr_mean, sdnn, rMSSD],
-        index=["hr_mean", "sdnn", "rMSSD"],
-    )
-    return result_series
+def detect_rpeaks(data, options=RPeakOptions(), cache=None):
+    """Detects the R-peaks of an ECG signal, see processing.ecg_rpeaks
 
+    :param
+    data: pandas Series
+        Raw ECG signal indexed by time stamps
+    options: RPeakOptions
+        R-peak detector, sampling rate and decimation
+    cache: StageCache, optional
+        Cache of the detected R-peaks, keyed by the options and the time span
+        of the signal
+    :return:
+    rpeak_ts: numpy array
+        Time stamps of the detected R-peaks
+    """
+    def detect():
+        logger.info(f"\tDetecting R-peaks ({options.detector})...")
+        with profiling.span("detect_rpeaks", samples=len(data)):
+            rpeak_ts = ecg_rpeaks.detect_rpeaks(data.values, data.index.values, options)
+        logger.info(f"\tFound {rpeak_ts.size} R-peaks.")
+        return {"rpeak_ts": rpeak_ts}
 
-def split(period_data, *, num_periods):
-    start, end = period_data.index[[0, -1]]
-    intervals = pd.interval_range(start, end, num_periods)
-    cuts = pd.cut(period_data.index, intervals)
-    groups = period_data.groupby(cuts)
-    return groups
+    if cache is None:
+        return detect()["rpeak_ts"]
+    params = {
+        "options": options._asdict(),
+        "channel": data.name,
+        "span": [data.index[0], data.index[-1], len(data)],
+    }
+    return cache.cached("rpeaks", params, detect)["rpeak_ts"]
 
 
-def extract_periods(block, num_task_subblocks=6):
-    data, markers = block
-    basline_h = next(select_data(data, markers, Periods.baseline_h))
-    basline_l = next(select_data(data, markers, Periods.baseline_l))
+def period_stats(rpeak_ts, starts, stops):
+    """Extracts HR, sdNN and RMSSD of the R-peaks within each time span [start, stop]
 
-    task, _ = next(select_data(data, markers, Periods.task))
-    subblocks = split(task, num_periods=num_task_subblocks)
-    subblocks = map(lambda groupby: groupby[1], subblocks)
+    hr_mean is the time-averaged heart rate, i.e. 60 s / mean RR interval.
+    """
+    stats = hrv.hrv_windows(rpeak_ts, starts, stops)
+    return stats[list(RESULT_COLUMNS)].rename(columns=RESULT_COLUMNS)
 
-    baselines = (basline_h[0], basline_l[0])
-    all_periods = itertools.chain(baselines, subblocks)
 
-    period_names = ["baseline_h", "baseline_l"]
-    period_names += [f"task_subblock_{idx}" for idx in range(num_task_subblocks)]
-    period_concat = pd.concat(
-        all_periods, keys=period_names, names=["period", data.index.name]
-    )
-    return period_concat
+def process_ecg_once(data, slices, options=RPeakOptions(), cache=None):
+    """Detects R-peaks once for the whole recording and aggregates them per period
 
+    Unlike process_ecg() per period, the signal is only filtered once and
+    beats at period boundaries are detected consistently.
+
+    :param
+    data: pandas Series
+        Raw ECG signal of a whole recording
+    slices: PeriodSlices
+        Periods of the recording
+    options: RPeakOptions
+        R-peak detector, sampling rate and decimation
+    cache: StageCache, optional
+        Cache of the detected R-peaks
+    :return:
+    results: list of pandas Series
+        Extracted features of each period, see period_stats()
+    """
+    rpeak_ts = detect_rpeaks(data, options, cache)
+    time_stamps = data.index.values
+    # A period's R-peaks lie within the time span of its samples; empty
+    # periods, e.g. tasks after the end of the recording, get an empty span
+    # and NaN statistics.
+    empty = slices.stop <= slices.start
+    period_first = time_stamps[slices.start.clip(max=len(time_stamps) - 1)]
+    period_last = np.where(
+        empty, -np.inf, time_stamps[(slices.stop - 1).clip(min=0)]
+    )
+    with profiling.span("hrv"):
+        stats = period_stats(rpeak_ts, period_first, period_last)
+    return [row for _, row in stats.iterrows()]
 
 
 @click.command()
+@click.option(
+    "--jobs",
+    "-j",
+    default=1,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Number of worker processes for the period-level ECG processing",
+)
+@click.option(
+    "--detect-once/--detect-per-period",
+    default=False,
+    show_default=True,
+    help="Detect R-peaks once per recording instead of once per period",
+)
+@click.option(
+    "--detector",
+    default=RPeakOptions().detector,
+    show_default=True,
+    type=click.Choice(sorted(ecg_rpeaks.DETECTORS)),
+    help="R-peak detector",
+)
+@click.option(
+    "--sampling-rate",
+    type=click.FloatRange(min=0, min_open=True),
+    help="ECG sampling rate in Hz  [default: from the sampling rate lookup table, "
+    "else inferred from the time stamps]",
+)
+@click.option(
+    "--decimate",
+    default=1,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Decimate the ECG signal by this factor before R-peak detection",
+)
+@click.option(
+    "--cache/--no-cache",
+    "use_cache",
+    default=True,
+    show_default=True,
+    help="Reuse R-peaks cached in <folder>/.cache by earlier runs",
+)
+@click.option(
+    "--clear-cache",
+    is_flag=True,
+    help="Remove all cached stage results of the folders before processing",
+)
+@click.option(
+    "--output",
+    type=click.Path(file_okay=False),
+    help="Study results dataset to write to instead of per-subject CSV files",
+)
+@profiling.verbose_option
+@profiling.quiet_option
 @click.argument("folders", nargs=-1, type=click.Path(exists=True))
-def main(folders):
-    print(folders)
-    """Processes and extracts statistics from EDA data
+def main(
+    folders,
+    jobs,
+    detect_once,
+    detector,
+    sampling_rate,
+    decimate,
+    use_cache,
+    clear_cache,
+    output,
+    verbose,
+    quiet,
+):
+    """Processes and extracts statistics from ECG data
 
-    folders: List of folders containing processed eda csv files
+    folders: List of folders containing processed ecg parquet files
 
-    Output: Stattistics saved to folder/extracted_csv/eda_<vp_code>.csv
+    Output: Statistics saved to folder/extracted_csv/ecg_<vp_code>.csv, or to
+    the partition modality=ecg/vp_code=<vp_code> of the --output dataset, and
+    a profile folder/<vp_code>_ecg_profile.json
     """
-    start_times = {}
+    profiling.configure_logging(verbose, quiet)
+    logger.debug(folders)
+    if output is not None:
+        output = pathlib.Path(output).resolve()
     folders = sorted(pathlib.Path(fn).resolve() for fn in folders)
-    for path in folders:
-        R = Recording(path)
-        print(f"Loading {path}")
-        conditions = R.condition_order()
-        print(f"\tFound vp_code `{R.vp_code}`:")
-        print(f"\t\tBlock 0: {conditions.block0}")
-        print(f"\t\tBlock 1: {conditions.block1}")
-        print(f"\t\tBlock 2: {conditions.block2}")
-        data = R.read_csv(R.ecg_path)
+    options = RPeakOptions(detector, sampling_rate, decimate)
+    executor = None
+    if jobs > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+    # Periods of up to `jobs` subjects are processed concurrently, such that
+    # workers stay busy across subject boundaries.
+    pending = collections.deque()
+    try:
+        for path in folders:
+            if clear_cache:
+                StageCache.for_recording(path).clear()
+            # Spans of the periods processed by workers are not recorded,
+            # collecting their results includes waiting for them.
+            profiler = profiling.Profiler()
+            with profiler:
+                submitted = submit_folder(path, executor, detect_once, options, use_cache)
+            pending.append((profiler, submitted))
+            while len(pending) > jobs:
+                _write_profiled(*pending.popleft(), output=output)
+        while pending:
+            _write_profiled(*pending.popleft(), output=output)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+
+def _write_profiled(profiler, submitted, output=None):
+    R = submitted[0]
+    with profiler:
+        write_results(*submitted, output=output)
+    path = profiling.profile_path(R.directory, R.vp_code, "ecg")
+    profiler.write(path, vp_code=R.vp_code, command="ecg")
+
+
+def submit_folder(
+    path: pathlib.Path,
+    executor=None,
+    detect_once=False,
+    options=RPeakOptions(),
+    use_cache=False,
+):
+    """Loads a recording and submits the ECG processing of all its periods
+
+    Returns the recording, its period slices and a function that collects
+    the period results. If no executor is given, the periods are processed
+    right away.
+    """
+    R = Recording(path)
+    logger.info(f"Loading {path}")
+    conditions = R.condition_order()
+    logger.info(f"\tFound vp_code `{R.vp_code}`:")
+    logger.info(f"\t\tBlock 0: {conditions.block0}")
+    logger.info(f"\t\tBlock 1: {conditions.block1}")
+    logger.info(f"\t\tBlock 2: {conditions.block2}")
+    with profiling.span("load") as span:
+        data = R.read_stream(STREAM_TYPES.brainvision_eda, columns=[ECG_CHANNEL])
         markers = R.read_markers()
-        print("\tData loaded. Starting processing...")
-
-        blocks = select_data(data.ECG, markers, Periods.block)
-        results = []
-        for cond, block in zip(conditions, blocks):
-            print(f"\tCalculating statistics for {cond.value}...")
-            periods = extract_periods(block)
-            stats = periods.groupby(level=0).apply(process_ecg)
-            results.append(stats)
-            print("\tFinished statistics.")
-
-        print("\tCombining results...")
-        condition_labels = [cond.value for cond in conditions]
-        results = pd.concat(results, keys=condition_labels, names=["block"], sort=True)
-        final = pd.concat([results], keys=[R.vp_code], names=["vp_code"])
-        final_frame = final.to_frame()
-        final_frame.reset_index(inplace=True)
-
-        target_dir = R.directory / "extracted_csv"
-        target_dir.mkdir(exist_ok=True)
-        extracted_csv_name = f"ecg_{R.vp_code}.csv"
-        extracted_csv_path = target_dir / extracted_csv_name
-        print(f"\tWriting results to {extracted_csv_path}")
-        final_frame.to_csv(extracted_csv_path, index=False)
-        print("\tDone!")
+        span.samples = len(data)
+    logger.info("\tData loaded. Starting processing...")
+    if options.sampling_rate is None:
+        # Per-subject override from the lookup tables, else inferred from the data
+        sampling_rate = R.sampling_rate(STREAM_TYPES.brainvision_eda)
+        if sampling_rate is not None:
+            logger.info(f"\tUsing sampling rate {sampling_rate} Hz from the lookup table")
+            options = options._replace(sampling_rate=sampling_rate)
+    cache = None
+    if use_cache:
+        cache = StageCache.for_recording(
+            R.directory, R.stream_files(STREAM_TYPES.brainvision_eda)
+        )
+        # Hash the inputs once instead of in every worker
+        cache.input_hash()
+
+    condition_labels = [cond.value for cond in conditions]
+    with profiling.span("period_slices"):
+        slices = period_slices(
+            data.index.values,
+            markers,
+            condition_labels,
+            baseline_names=BASELINE_NAMES,
+        )
+    if detect_once:
+        logger.info("\tCalculating statistics for all periods...")
+        future = _submit(
+            executor, process_ecg_once, data[ECG_CHANNEL], slices, options, cache
+        )
+        return R, slices, future.result
+
+    futures = []
+    for (cond, period), period_data in slices.take(data[ECG_CHANNEL]):
+        logger.info(f"\tCalculating statistics for {cond}, {period}...")
+        futures.append(_submit(executor, process_ecg, period_data, options, cache))
+    return R, slices, lambda: [future.result() for future in futures]
+
+
+def _submit(executor, fn, *args):
+    if executor is None:
+        future = concurrent.futures.Future()
+        future.set_result(fn(*args))
+        return future
+    return executor.submit(fn, *args)
+
+
+def write_results(R: Recording, slices, collect_results, output=None):
+    """Collects the period results of a recording in label order and writes them
+
+    output: Study results dataset to write to, see processing.shared.results;
+        defaults to a CSV file in the recording folder
+    """
+    with profiling.span("collect"):
+        results = collect_results()
+    logger.info(f"\tFinished statistics for {R.vp_code}.")
+
+    logger.info("\tCombining results...")
+    results = pd.DataFrame(results, index=slices.labels)
+    final = pd.concat([results], keys=[R.vp_code], names=["vp_code"])
+    final_frame = final.reset_index()
+
+    return results_dataset.write_subject_results(
+        R, RESULTS_MODALITY, final_frame, CSV_PREFIX, output
+    )
+
+
+def result_path(R: Recording, output=None) -> pathlib.Path:
+    return results_dataset.subject_result_path(R, RESULTS_MODALITY, CSV_PREFIX, output)
 
 
 if __name__ == "__main__":
-       main()
\ No newline at end of file
+       main()
@@ -0,0 +1,165 @@
+'''
+R-peak detection with pluggable detectors
+
+Detectors only return the R-peak positions, all further features are derived
+from them, see processing.hrv. Available detectors:
+
+    pantompkins vectorised Pan-Tompkins style detector using numpy/scipy
+                only, the default
+    neurokit    neurokit's ecg_preprocess(), the default of earlier versions
+    hamilton, christov, engzee, gamboa, ssf
+                biosppy's segmenters on the FIR-filtered signal
+
+neurokit and biosppy are only imported when their detectors are used, i.e.
+the default works without them.
+
+The sampling rate is inferred from the stream time stamps. The signal can
+optionally be decimated by an integer factor with a polyphase filter before
+detection, which reduces the detection time roughly by that factor at the
+cost of a time resolution of `factor / sampling_rate`.
+'''
+import typing as T
+
+import numpy as np
+
+from processing.shared import backends
+
+scipy_signal = backends.lazy("scipy.signal")
+
+# Detectors expect at least this sampling rate, e.g. for the 3-45 Hz band pass
+MIN_SAMPLING_RATE = 100.0
+
+BIOSPPY_SEGMENTERS = {
+    "hamilton": "hamilton_segmenter",
+    "christov": "christov_segmenter",
+    "engzee": "engzee_segmenter",
+    "gamboa": "gamboa_segmenter",
+    "ssf": "ssf_segmenter",
+}
+
+
+class RPeakOptions(T.NamedTuple):
+    detector: str = "pantompkins"
+    sampling_rate: T.Optional[float] = None
+    '''Sampling rate in Hz, inferred from the time stamps if None'''
+    decimate: int = 1
+    '''Decimation factor applied before detection'''
+
+
+def detect_rpeaks(
+    signal: np.ndarray, time_stamps: np.ndarray, options: RPeakOptions = RPeakOptions()
+) -> np.ndarray:
+    """Detects R-peaks in a raw ECG signal and returns their time stamps"""
+    sampling_rate = options.sampling_rate or infer_sampling_rate(time_stamps)
+    signal = np.asarray(signal, dtype=np.float64)
+    time_stamps = np.asarray(time_stamps)
+    if options.decimate > 1:
+        signal, time_stamps = decimate(signal, time_stamps, options.decimate)
+        sampling_rate /= options.decimate
+    # Inferred rates are subject to time stamp rounding
+    if sampling_rate < MIN_SAMPLING_RATE * (1 - 1e-6):
+        raise ValueError(
+            f"Sampling rate of {sampling_rate:.1f} Hz is too low for R-peak detection,"
+            f" at least {MIN_SAMPLING_RATE:.0f} Hz are required"
+        )
+    rpeaks = DETECTORS[options.detector](signal, sampling_rate)
+    return time_stamps[np.unique(rpeaks)]
+
+
+def infer_sampling_rate(time_stamps: np.ndarray) -> float:
+    """Effective sampling rate from the median time stamp difference"""
+    if len(time_stamps) < 2:
+        raise ValueError("At least two samples are required to infer the sampling rate")
+    return float(1.0 / np.median(np.diff(time_stamps)))
+
+
+def decimate(
+    signal: np.ndarray, time_stamps: np.ndarray, factor: int
+) -> T.Tuple[np.ndarray, np.ndarray]:
+    """Low-pass filters and downsamples the signal by an integer factor"""
+    signal = scipy_signal.resample_poly(signal, up=1, down=factor)
+    return signal, time_stamps[::factor]
+
+
+def neurokit_detector(signal: np.ndarray, sampling_rate: float) -> np.ndarray:
+    nk = backends.load("neurokit")
+    processed = nk.ecg_preprocess(signal, sampling_rate=sampling_rate)
+    return np.asarray(processed["ECG"]["R_Peaks"], dtype=int)
+
+
+def biosppy_detector(name: str) -> T.Callable[[np.ndarray, float], np.ndarray]:
+    """Wraps a biosppy segmenter like biosppy.signals.ecg.ecg() does"""
+    def detect(signal: np.ndarray, sampling_rate: float) -> np.ndarray:
+        ecg = backends.load("biosppy.signals.ecg")
+        tools = backends.load("biosppy.signals.tools")
+        filtered, _, _ = tools.filter_signal(
+            signal=signal,
+            ftype="FIR",
+            band="bandpass",
+            order=int(0.3 * sampling_rate),
+            frequency=[3, 45],
+            sampling_rate=sampling_rate,
+        )
+        rpeaks, = getattr(ecg, BIOSPPY_SEGMENTERS[name])(
+            signal=filtered, sampling_rate=sampling_rate
+        )
+        rpeaks, = ecg.correct_rpeaks(
+            signal=filtered, rpeaks=rpeaks, sampling_rate=sampling_rate, tol=0.05
+        )
+        return np.asarray(rpeaks, dtype=int)
+
+    return detect
+
+
+def pan_tompkins_detector(
+    signal: np.ndarray,
+    sampling_rate: float,
+    threshold: float = 0.3,
+    segment_s: float = 5.0,
+    refractory_s: float = 0.25,
+) -> np.ndarray:
+    """Pan-Tompkins style detector without per-beat Python loops
+
+    The 5-15 Hz band passed signal is differentiated, squared and integrated
+    over 150 ms. Peaks of the integrated energy above `threshold` times its
+    98th percentile within segments of `segment_s` (but at least a fifth of
+    its median over all segments), and at least `refractory_s` apart, are QRS
+    complexes. The R-peak is the maximum of the absolute band passed signal
+    within the integration window around them.
+    """
+    sos = scipy_signal.butter(2, [5, 15], btype="bandpass", fs=sampling_rate, output="sos")
+    filtered = scipy_signal.sosfiltfilt(sos, signal)
+    energy = np.gradient(filtered) ** 2
+
+    half_width = max(int(0.075 * sampling_rate), 1)
+    cumsum = np.concatenate([[0.0], np.cumsum(energy)])
+    upper = np.minimum(np.arange(energy.size) + half_width + 1, energy.size)
+    lower = np.maximum(np.arange(energy.size) - half_width, 0)
+    integrated = (cumsum[upper] - cumsum[lower]) / (2 * half_width + 1)
+
+    # The threshold adapts to amplitude changes over the course of a recording
+    segment = max(int(segment_s * sampling_rate), 1)
+    num_segments = -(-integrated.size // segment)
+    padded = np.full(num_segments * segment, np.nan)
+    padded[: integrated.size] = integrated
+    levels = np.nanpercentile(padded.reshape(num_segments, segment), 98, axis=1)
+    # Segments without beats, e.g. with detached electrodes, must not turn noise into beats
+    levels = np.maximum(levels, 0.2 * np.median(levels))
+    height = threshold * np.repeat(levels, segment)[: integrated.size]
+
+    candidates, _ = scipy_signal.find_peaks(
+        integrated, height=height, distance=max(int(refractory_s * sampling_rate), 1)
+    )
+    if candidates.size == 0:
+        return candidates
+
+    magnitude = np.pad(np.abs(filtered), half_width, mode="constant")
+    windows = np.lib.stride_tricks.sliding_window_view(magnitude, 2 * half_width + 1)
+    return candidates + windows[candidates].argmax(axis=1) - half_width
+
+
+DETECTORS: T.Dict[str, T.Callable[[np.ndarray, float], np.ndarray]] = {
+    "neurokit": neurokit_detector,
+    **{name: biosppy_detector(name) for name in BIOSPPY_SEGMENTERS},
+    "pantompkins": pan_tompkins_detector,
+}
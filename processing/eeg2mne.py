@@ -2,12 +2,18 @@
 Author: Pablo Prietz
 '''
 import pandas as pd
-import mne
 
+from processing.shared import backends
+
+mne = backends.lazy("mne")
+
+
+ELECTRODE_SITES = ['F3','Fz','F4','T3','C3','Cz','C4','T4','P3','Pz','P4','O1','Oz','O2']
+SFREQ = 256
 
 
 def eeg2mne(gtec_dataframe):
-    electrode_sites = ['F3','Fz','F4','T3','C3','Cz','C4','T4','P3','Pz','P4','O1','Oz','O2']
+    electrode_sites = ELECTRODE_SITES
 
     # Select columns with channels of interest
     eeg = gtec_dataframe[electrode_sites]
@@ -18,7 +24,7 @@ def eeg2mne(gtec_dataframe):
     # Create list with channel types
     channel_types = ['eeg'] * len(electrode_sites)
     # Create sampling frequency
-    sfreq = 256
+    sfreq = SFREQ
     # Create MNE info file
     eeg_info = mne.create_info(channel_names, sfreq, channel_types)
     # Create raw file in MNE format
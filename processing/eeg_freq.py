@@ -1,24 +1,38 @@
 '''
 Authors: Kerstin Pieper, Pablo Prietz
 '''
-import functools
-import itertools
+import logging
 import pathlib
+import typing as T
 import click
-import mne
 import numpy as np
 import pandas as pd
 
-from processing.eeg2mne import eeg2mne
-from processing.shared.markers_example import Periods
-from processing.shared.select_data import select_from_data, extract_periods, split
+from processing.chunked_filter import ChunkedFIRFilter, bandpass_fir
+from processing.eeg2mne import eeg2mne, ELECTRODE_SITES, SFREQ
+from processing.spectral import BandPowerAccumulator, FREQ_BANDS, period_mean
+from processing.shared.select_data import period_slices
+from processing.shared import backends, profiling
+from processing.shared import results as results_dataset
+from processing.shared.cache import StageCache
 from processing.shared.recording import Recording
-from processing.helpers import Helper
+from processing.shared.sample_store import SampleStore
+from processing.shared.streams import STREAM_TYPES
+
+# Band pass of the EEG signal before the spectral analysis
+FILTER_FREQS = (1, 48)
+# Modality of the results in a study results dataset, see processing.shared.results
+RESULTS_MODALITY = "eeg_freq"
+# File name prefix of the per-subject CSV in extracted_csv/
+CSV_PREFIX = "eeg_freq_"
+
+mne = backends.lazy("mne")
+logger = logging.getLogger(__name__)
 
 
 def filter_raw(raw):
     # bandpass filter
-    fmin, fmax = 1, 48  # to adjust
+    fmin, fmax = FILTER_FREQS  # to adjust
 
     raw_fir_filtered = raw.filter(
         fmin,
@@ -37,17 +51,17 @@ def filter_raw(raw):
 
 def check_for_bads(data_raw, b_ch=None):
     if not b_ch:
-        print('no bad channels')
+        logger.info('no bad channels')
         return False
     else:
         data_raw.info['bads'].extend(b_ch)
-        print(f"\tFound bad channels `{data_raw.info['bads']}`:")
+        logger.info(f"\tFound bad channels `{data_raw.info['bads']}`:")
         return True
 
 
 def mod_chan_list(data_raw, vp_code=None):
     bad = data_raw.info['bads']
-    channels = data_raw.info['ch_names']
+    channels = list(data_raw.info['ch_names'])
     for x in bad:
         try:
             channels.remove(x)
@@ -56,128 +70,257 @@ def mod_chan_list(data_raw, vp_code=None):
     return channels
 
 
-def do_welch(raw):
-    psds_welch, freqs = mne.time_frequency.psd_welch(
-        raw,
-        fmin=1,
-        fmax=48,
-        average=None,
-        reject_by_annotation=True,  # exclude bad channels
-    )
-    return psds_welch, freqs
-
-
+def welch_band_power(raw, channels, chunk_s=60.0):
+    """Welch band power per channel and segment, see processing.spectral
 
-def calc_eeg_stats_per_band(psds_welch, channels, subblock_idc):
-    Freq_bands = {
-        "Delta": [0, 4],
-        "Theta": [4, 8],
-        "Alpha": [8, 12],
-        "Beta": [12, 30],
-        "Gamma": [30, 45],
-    }
+    The filtered signal is fed to the accumulator in chunks of chunk_s, such
+    that the full power spectral density is never held in memory.
 
-    selection = subblock_idc.values.reshape(-1)
-
-    eeg_stats = []
-    for fmin, fmax in Freq_bands.values():
-        psds_band = psds_welch[:, fmin:fmax, selection].mean(axis=-1).mean(axis=-1)
-        eeg_stats.append(psds_band)
-    columns = pd.Index(channels, name="Channels")
-    index = pd.Index(Freq_bands.keys(), name="Freq Bands")
+    Returns the (channels, bands, segments) band power and the segment start
+    times relative to the first sample in s.
+    """
+    sfreq = raw.info["sfreq"]
+    accumulator = BandPowerAccumulator(sfreq)
+    data = raw.get_data(picks=channels)
+    chunk = int(chunk_s * sfreq)
+    for start in range(0, data.shape[-1], chunk):
+        accumulator.update(data[:, start : start + chunk])
+    return accumulator.result(), accumulator.segment_offsets() / sfreq
+
+
+def aggregate_band_power(band_power, channels, slices, vp_code):
+    """Mean band power of all channels, bands and periods of a recording
+
+    :param
+    band_power: numpy array
+        (channels, bands, segments) band power, see welch_band_power()
+    channels: list of str
+        Channel names
+    slices: PeriodSlices
+        Segment ranges of all periods
+    vp_code: str
+    :return:
+    power: pandas DataFrame
+        Tidy frame with the columns vp_code, block, Channels, period,
+        Freq Bands and Power, ordered by block, channel, period and band
+    """
+    # (periods, channels, bands) from a single reduction over all periods
+    power = period_mean(band_power, slices.start, slices.stop)
+    num_periods, num_channels, num_bands = power.shape
 
-    aggregated = pd.DataFrame(eeg_stats, index=index, columns=columns)
-    return aggregated
+    period_idx, channel_idx, band_idx = np.meshgrid(
+        np.arange(num_periods), np.arange(num_channels), np.arange(num_bands),
+        indexing="ij",
+    )
+    block_codes, blocks = pd.factorize(slices.labels.get_level_values("block"))
+    order = np.lexsort(
+        (band_idx.ravel(), period_idx.ravel(), channel_idx.ravel(),
+         block_codes[period_idx.ravel()])
+    )
+    period_idx = period_idx.ravel()[order]
+    return pd.DataFrame({
+        "vp_code": vp_code,
+        "block": slices.labels.get_level_values("block")[period_idx],
+        "Channels": np.asarray(channels)[channel_idx.ravel()[order]],
+        "period": slices.labels.get_level_values("period")[period_idx],
+        "Freq Bands": np.asarray(list(FREQ_BANDS))[band_idx.ravel()[order]],
+        "Power": power.ravel()[order],
+    })
 
 
 @click.command()
 @click.argument("folders", nargs=-1, type=click.Path(exists=True))
-def main(folders):
-    print(folders)
+@click.option(
+    "--chunked/--in-memory",
+    default=False,
+    show_default=True,
+    help="Filter the EEG block by block from its sample store instead of with MNE in memory",
+)
+@click.option(
+    "--cache/--no-cache",
+    "use_cache",
+    default=True,
+    show_default=True,
+    help="Reuse filtered EEG and band power cached in <folder>/.cache by earlier runs",
+)
+@click.option(
+    "--clear-cache",
+    is_flag=True,
+    help="Remove all cached stage results of the folders before processing",
+)
+@click.option(
+    "--output",
+    type=click.Path(file_okay=False),
+    help="Study results dataset to write to instead of per-subject CSV files",
+)
+@profiling.verbose_option
+@profiling.quiet_option
+def main(folders, chunked, use_cache, clear_cache, output, verbose, quiet):
     """Processes and extracts statistics from EEG data
 
     folders: List of folders containing processed eeg parquet files
 
-    Output: Statistics saved to folder/extracted_csv/eeg_<vp_code>.csv
+    Output: Statistics saved to folder/extracted_csv/eeg_freq_<vp_code>.csv, or
+    to the partition modality=eeg_freq/vp_code=<vp_code> of the --output
+    dataset, and a profile folder/<vp_code>_eeg_profile.json
     """
-    start_times = {}
+    profiling.configure_logging(verbose, quiet)
+    if output is not None:
+        output = pathlib.Path(output).resolve()
     folders = sorted(pathlib.Path(fn).resolve() for fn in folders)
     for path in folders:
-        R = Recording(path)
-        print(f"Loading {path}")
-        try:
-            conditions = Helper.condition_order()
-        except KeyError:
-            print(f"\tUnknown vp_code {R.vp_code}. Aborting.")
-            continue
-        print(f"\tFound vp_code `{R.vp_code}`:")
-        print(f"\t\tBlock 0: {conditions.block0}")
-        print(f"\t\tBlock 1: {conditions.block1}")
-        print(f"\t\tBlock 2: {conditions.block2}")
-        data = R.read_parquet(R.eeg_path())
+        if clear_cache:
+            StageCache.for_recording(path).clear()
+        with profiling.Profiler() as profiler:
+            result = process_folder(path, chunked, use_cache, output)
+        if result is not None:
+            vp_code = Recording(path).vp_code
+            profile_path = profiling.profile_path(path, vp_code, "eeg")
+            profiler.write(profile_path, vp_code=vp_code, command="eeg")
+
+
+def process_folder(
+    path: pathlib.Path,
+    chunked: bool = False,
+    use_cache: bool = False,
+    output: T.Optional[pathlib.Path] = None,
+) -> T.Optional[pathlib.Path]:
+    """Extracts the band power per period of one recording and writes it
+
+    Returns the path of the written results, None if the vp_code is unknown.
+    """
+    R = Recording(path)
+    logger.info(f"Loading {path}")
+    try:
+        conditions = R.condition_order()
+    except KeyError:
+        logger.warning(f"\tUnknown vp_code {R.vp_code}. Aborting.")
+        return None
+    logger.info(f"\tFound vp_code `{R.vp_code}`:")
+    logger.info(f"\t\tBlock 0: {conditions.block0}")
+    logger.info(f"\t\tBlock 1: {conditions.block1}")
+    logger.info(f"\t\tBlock 2: {conditions.block2}")
+    markers = R.read_markers()
+    b_ch = R.bads()
+    compute = chunked_band_power if chunked else in_memory_band_power
+    with profiling.span("band_power"):
+        if use_cache:
+            cache = StageCache.for_recording(R.directory, R.stream_files(STREAM_TYPES.g_tec))
+            band_power, channels, welch_ts = cached_band_power(cache, compute, R, b_ch, chunked)
+        else:
+            band_power, channels, welch_ts = compute(R, b_ch)
+
+    logger.info("\tCalculating statistics for all periods...")
+    with profiling.span("aggregate"):
+        condition_labels = [cond.value for cond in conditions]
+        slices = period_slices(welch_ts, markers, condition_labels, num_task_subblocks=6)
+        final_frame = aggregate_band_power(band_power, channels, slices, R.vp_code)
+    logger.info("\tFinished statistics.")
+    return results_dataset.write_subject_results(
+        R, RESULTS_MODALITY, final_frame, CSV_PREFIX, output
+    )
+
+
+def cached_band_power(cache: StageCache, compute, R: Recording, b_ch, chunked: bool):
+    """Band power from the stage cache, computed with compute() on a miss
+
+    Returns the band power, the good channels and the segment time stamps.
+    """
+    params = {
+        "mode": "chunked" if chunked else "in-memory",
+        "bads": sorted(b_ch or []),
+        "filter": FILTER_FREQS,
+        "sfreq": SFREQ,
+        "bands": FREQ_BANDS,
+    }
+
+    def compute_arrays():
+        band_power, channels, welch_ts = compute(R, b_ch, cache)
+        return {"band_power": band_power, "channels": np.asarray(channels), "welch_ts": welch_ts}
+
+    arrays = cache.cached("band_power", params, compute_arrays)
+    return arrays["band_power"], arrays["channels"].tolist(), arrays["welch_ts"]
+
+
+def filtered_eeg(data_raw, cache=None):
+    """Band pass filtered EEG, see filter_raw(), optionally from the stage cache"""
+    if cache is None:
+        return filter_raw(data_raw)
+    params = {"filter": FILTER_FREQS, "sfreq": SFREQ, "channels": data_raw.ch_names}
+    arrays = cache.cached(
+        "filtered_eeg", params, lambda: {"data": filter_raw(data_raw).get_data()}
+    )
+    return mne.io.RawArray(arrays["data"], data_raw.info, verbose=False)
+
+
+def in_memory_band_power(R: Recording, b_ch, cache=None):
+    """Band power of the good channels, filtered by MNE on the whole recording
+
+    Returns the band power, the good channels and the segment time stamps.
+    """
+    with profiling.span("load") as span:
+        data = R.read_stream(STREAM_TYPES.g_tec, columns=ELECTRODE_SITES)
         data_raw = eeg2mne(data)
-        markers = R.read_markers()
-        print("\tData loaded. Starting processing...")
+        span.samples = len(data)
+    logger.info("\tData loaded. Starting processing...")
 
-        print("\tFilter frequencies below 1Hz and above 48 Hz.")
-        data_filtered = filter_raw(data_raw)
+    logger.info("\tFilter frequencies below 1Hz and above 48 Hz.")
+    with profiling.span("filter", samples=len(data)):
+        data_filtered = filtered_eeg(data_raw, cache)
 
-        print("\tCheck for bad channels")
-        b_ch = Helper.get_bads()
-        if check_for_bads(data_raw, b_ch) == True:
-            psds_welch, freqs = do_welch(data_filtered)
-            channels = mod_chan_list(data_raw, R.vp_code)
-            print("\tCalc Welch without bads.")
+    logger.info("\tCheck for bad channels")
+    if check_for_bads(data_raw, b_ch) == True:
+        channels = mod_chan_list(data_raw, R.vp_code)
+        logger.info("\tCalc Welch without bads.")
+    else:
+        logger.info("\tCalc Welch.")
+        channels = data_raw.info['ch_names']
+    with profiling.span("welch", samples=len(data)):
+        band_power, welch_offsets = welch_band_power(data_filtered, channels)
+    return band_power, channels, welch_offsets + data.index[0]
 
-        else:
-            print("\tCalc Welch.")
-            psds_welch, freqs = do_welch(data_filtered)
-            channels = data_raw.info['ch_names']
-
-        n_seg = psds_welch.shape[-1]
-        eeg_ts_first = data.index[0]
-        welch_idc = np.arange(n_seg)
-        welch_ts = welch_idc + eeg_ts_first
-        welch_idc_df = pd.DataFrame(welch_idc, index=welch_ts)
-        blocks = select_from_data(welch_idc_df, markers, Periods.block)
-
-        print("\tCalc Welch.")
-        calc_eeg_stats_per_band_fixed = functools.partial(calc_eeg_stats_per_band, psds_welch, channels)
-
-        results = []
-
-        for cond, block in zip(conditions, blocks):
-            print(f"\tCalculating statistics for {cond.value}...")
-            periods = extract_periods(block, num_task_subblocks=6)
-
-            eeg_stats_per_band = periods.groupby(level=0).apply(calc_eeg_stats_per_band_fixed)
-            channel_names = eeg_stats_per_band.columns
-            eeg_stats_per_band_long = pd.concat(
-                [eeg_stats_per_band[cn] for cn in channel_names],
-                keys=channel_names,
-            )
-            eeg_stats_per_band_long.name = "Power"
-            results.append(eeg_stats_per_band_long)
-
-        print("\tFinished statistics.")
-
-        print("\tCombining results...")
-        condition_labels = [cond.value for cond in conditions]
-        results = pd.concat(results, keys=condition_labels, names=["block"], sort=True)
-        final = pd.concat([results], keys=[R.vp_code], names=["vp_code"])
-        final_frame = final.to_frame()
-        final_frame.reset_index(inplace=True)
 
-        target_dir = R.directory / "extracted_csv"
-        target_dir.mkdir(exist_ok=True)
-        extracted_csv_name = f"eeg_freq_{R.vp_code}.csv"
-        extracted_csv_path = target_dir / extracted_csv_name
-        print(f"\tWriting results to {extracted_csv_path}")
-        final_frame.to_csv(extracted_csv_path, index=False)
-        print("\tDone!")
+def chunked_band_power(R: Recording, b_ch, cache=None, block_s=60.0):
+    """Band power of the good channels, filtered block by block
 
+    The samples are streamed from the sample store of the EEG stream, if
+    there is one, through the chunked FIR filter into the band power
+    accumulator, such that peak memory does not depend on the recording
+    length. See processing.chunked_filter for the tolerance to MNE's filter.
+    The filtered signal is never materialized, hence not cached.
 
-if __name__ == "__main__":
-    main()
+    Returns the band power, the good channels and the segment time stamps.
+    """
+    with profiling.span("load"):
+        store = R.sample_store(STREAM_TYPES.g_tec)
+        if store is None:
+            logger.info("\tNo sample store found, reading the whole EEG stream.")
+            data = R.read_stream(STREAM_TYPES.g_tec, columns=ELECTRODE_SITES)
+            store = SampleStore(data.to_numpy().T, data.index.values, list(data.columns))
+    logger.info("\tData loaded. Starting processing...")
+
+    logger.info("\tCheck for bad channels")
+    channels = [ch for ch in ELECTRODE_SITES if ch not in (b_ch or [])]
+    if b_ch:
+        logger.info(f"\tFound bad channels `{b_ch}`:")
+    else:
+        logger.info('no bad channels')
+    rows = [store.channels.index(ch) for ch in channels]
 
+    logger.info("\tFilter frequencies below 1Hz and above 48 Hz and calc Welch.")
+    fir = ChunkedFIRFilter(bandpass_fir(SFREQ, *FILTER_FREQS))
+    accumulator = BandPowerAccumulator(SFREQ)
+    num_samples = store.samples.shape[-1]
+    with profiling.span("filter_welch", samples=num_samples):
+        for _, block in fir.iter_blocks(store.samples, int(block_s * SFREQ), rows):
+            accumulator.update(block)
+    welch_ts = store.time_stamps[0] + accumulator.segment_offsets() / SFREQ
+    return accumulator.result(), channels, welch_ts
 
+
+def result_path(R: Recording, output=None) -> pathlib.Path:
+    return results_dataset.subject_result_path(R, RESULTS_MODALITY, CSV_PREFIX, output)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,61 +2,30 @@
 Authors: Pablo Prietz, Kerstin Pieper
 '''
 import itertools
-import pathlib
-import enum
-import typing as T
 import pandas as pd
 
+from processing.shared.metadata import Condition, ConditionOrder, default_registry
 from processing.shared.select_data import select_from_data, split
 from processing.shared.markers_example import Periods
 
 
-# definition of conditions
-class Condition(enum.Enum):
-    H = "hard"
-    C = "control"
-    E = "easy"
-
-# order in which condition blocks were presented
-class ConditionOrder(T.NamedTuple):
-    block0: Condition
-    block1: Condition
-    block2: Condition
-
-
 class Helper:
 
     def get_bads(self):
-        """Check for bad channels in lookup file and return them as list
+        """Bad channels of self.vp_code, see shared.metadata.SubjectRegistry
 
         :param self:
         :return:
         bad_list : list
-        bad_list_list : list
         """
-        script_parent_folder = pathlib.Path(__file__).parent
-        vp_bads_lookup_loc = script_parent_folder / "bads_lookup_example.csv"
-        vp_bads_lookup = pd.read_csv(vp_bads_lookup_loc, index_col="VP-Code")
-        bad_raw = vp_bads_lookup.loc[self.vp_code]
-        bad_list_list = bad_raw.values.tolist()
-        if len(bad_list_list) > 1:
-            bad_list = list(itertools.chain(*bad_list_list))
-            return bad_list
-        else:
-            return bad_list_list
+        return default_registry().bads(self.vp_code)
 
     def condition_order(self) -> ConditionOrder:
-        """Check for order in which different test conditions were applied.
+        """Order in which the test conditions were applied to self.vp_code
 
         :return:
         """
-        script_parent_folder = pathlib.Path(__file__).parent
-        vp_condition_lookup_loc = script_parent_folder / "condition_lookup_example.csv"
-        vp_condition_lookup = pd.read_csv(vp_condition_lookup_loc, index_col="VP-Code")
-        conditions_raw = vp_condition_lookup.loc[self.vp_code]
-        conditions = [Condition(cond) for cond in conditions_raw]
-        condition_order = ConditionOrder(*conditions)
-        return condition_order
+        return default_registry().condition_order(self.vp_code)
 
     def extract_periods(block, num_task_subblocks=6):
         data, markers = block
@@ -0,0 +1,136 @@
+'''
+Heart rate variability from R-peak time stamps
+
+All metrics are computed for arbitrary sets of time windows at once. Per-beat
+quantities are accumulated with cumulative sums, such that each window costs
+O(1) after an O(beats) preparation, independent of the window length.
+'''
+import typing as T
+
+import numpy as np
+import pandas as pd
+
+HRV_METRICS = ["num_rr", "mean_rr", "hr_mean", "sdnn", "rmssd", "sdsd", "pnn50"]
+
+
+def rr_intervals(rpeak_ts: np.ndarray) -> np.ndarray:
+    """RR intervals in ms from R-peak time stamps in s"""
+    return np.diff(np.asarray(rpeak_ts, dtype=float)) * 1000
+
+
+def sliding_windows(
+    start_ts: float, stop_ts: float, width_s: float, hop_s: float
+) -> T.Tuple[np.ndarray, np.ndarray]:
+    """Start and stop times of windows of width_s every hop_s within [start_ts, stop_ts]"""
+    num_windows = int(np.floor((stop_ts - start_ts - width_s) / hop_s + 1e-9)) + 1
+    starts = start_ts + hop_s * np.arange(max(num_windows, 0))
+    return starts, starts + width_s
+
+
+def hrv_windows(
+    rpeak_ts: np.ndarray,
+    starts: T.Union[np.ndarray, T.Sequence[float]],
+    stops: T.Union[np.ndarray, T.Sequence[float]],
+    index: T.Optional[pd.Index] = None,
+) -> pd.DataFrame:
+    """Computes HRV metrics for each time window [starts[i], stops[i]]
+
+    An RR interval belongs to a window if both of its R-peaks lie within it.
+
+    Input:
+        rpeak_ts: Sorted R-peak time stamps in s
+        starts, stops: Window boundaries in s
+        index: Index of the result, defaults to a range index
+
+    Output: DataFrame with one row per window and the columns
+        num_rr: number of RR intervals
+        mean_rr: mean RR interval in ms
+        hr_mean: time-averaged heart rate in bpm, i.e. 60 s / mean_rr
+        sdnn: standard deviation of the RR intervals in ms
+        rmssd: root mean square of successive RR differences in ms
+        sdsd: standard deviation of successive RR differences in ms
+        pnn50: percentage of successive RR differences above 50 ms
+    Metrics are NaN if a window contains too few intervals.
+    """
+    rpeak_ts = np.asarray(rpeak_ts, dtype=float)
+    starts = np.asarray(starts, dtype=float)
+    stops = np.asarray(stops, dtype=float)
+    rr = rr_intervals(rpeak_ts)
+    diffs = np.diff(rr)
+
+    # Center the intervals before accumulating squares, which keeps the
+    # variance computation from cancelling out for long recordings.
+    reference = np.median(rr) if rr.size else 0.0
+    rr_centered = rr - reference
+    cum_rr = _cumsum(rr_centered)
+    cum_rr_sq = _cumsum(rr_centered ** 2)
+    cum_diff = _cumsum(diffs)
+    cum_diff_sq = _cumsum(diffs ** 2)
+    cum_nn50 = _cumsum(np.abs(diffs) > 50)
+
+    # Peaks [first, last) lie within each window, i.e. the RR intervals
+    # [first, last - 1) and successive differences [first, last - 2).
+    first = np.searchsorted(rpeak_ts, starts, side="left")
+    last = np.searchsorted(rpeak_ts, stops, side="right")
+    num_rr = np.maximum(last - first - 1, 0)
+    num_diff = np.maximum(num_rr - 1, 0)
+    # Windows after the last intervals start past the end of the cumulative
+    # sums. They hold no intervals and their metrics are masked below.
+    first_rr = np.minimum(first, cum_rr.size - 1)
+    first_diff = np.minimum(first, cum_diff.size - 1)
+    rr_stop = first_rr + num_rr
+    diff_stop = first_diff + num_diff
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        sum_rr = cum_rr[rr_stop] - cum_rr[first_rr]
+        mean_centered = sum_rr / num_rr
+        mean_rr = mean_centered + reference
+        sum_rr_sq = cum_rr_sq[rr_stop] - cum_rr_sq[first_rr]
+        var_rr = (sum_rr_sq - sum_rr * mean_centered) / (num_rr - 1)
+        sdnn = np.sqrt(np.maximum(var_rr, 0))
+
+        sum_diff = cum_diff[diff_stop] - cum_diff[first_diff]
+        sum_diff_sq = cum_diff_sq[diff_stop] - cum_diff_sq[first_diff]
+        rmssd = np.sqrt(sum_diff_sq / num_diff)
+        var_diff = (sum_diff_sq - sum_diff ** 2 / num_diff) / (num_diff - 1)
+        sdsd = np.sqrt(np.maximum(var_diff, 0))
+        pnn50 = 100 * (cum_nn50[diff_stop] - cum_nn50[first_diff]) / num_diff
+
+    metrics = {
+        "num_rr": num_rr,
+        "mean_rr": np.where(num_rr > 0, mean_rr, np.nan),
+        "hr_mean": np.where(num_rr > 0, 60_000 / mean_rr, np.nan),
+        "sdnn": np.where(num_rr > 1, sdnn, np.nan),
+        "rmssd": np.where(num_diff > 0, rmssd, np.nan),
+        "sdsd": np.where(num_diff > 1, sdsd, np.nan),
+        "pnn50": np.where(num_diff > 0, pnn50, np.nan),
+    }
+    return pd.DataFrame(metrics, index=index, columns=HRV_METRICS)
+
+
+def hrv_sliding(
+    rpeak_ts: np.ndarray,
+    width_s: float = 60.0,
+    hop_s: float = 5.0,
+    start_ts: T.Optional[float] = None,
+    stop_ts: T.Optional[float] = None,
+) -> pd.DataFrame:
+    """HRV metrics for dense sliding windows, indexed by the window start time
+
+    start_ts, stop_ts default to the first and last R-peak.
+    """
+    rpeak_ts = np.asarray(rpeak_ts, dtype=float)
+    if start_ts is None:
+        start_ts = rpeak_ts[0]
+    if stop_ts is None:
+        stop_ts = rpeak_ts[-1]
+    starts, stops = sliding_windows(start_ts, stop_ts, width_s, hop_s)
+    index = pd.Index(starts, name="window_start")
+    return hrv_windows(rpeak_ts, starts, stops, index=index)
+
+
+def _cumsum(values: np.ndarray) -> np.ndarray:
+    """Cumulative sum with a leading zero, i.e. sum(values[a:b]) == c[b] - c[a]"""
+    cumsum = np.zeros(values.size + 1)
+    np.cumsum(values, out=cumsum[1:])
+    return cumsum
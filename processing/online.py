@@ -0,0 +1,447 @@
+'''
+Online processing of live streams
+
+Consumes sample chunks of the streams known to xdf_convert (see
+shared.streams.STREAM_TYPES) and updates features while a session runs:
+
+    BrainVision RDA  ECG  -> HRV of the last hrv_width_s, see OnlineHRV
+    g.USBamp         EEG  -> band power of the last eeg_window_s, see OnlineBandPower
+    psychopy_marker       -> latest marker, attached to each feature
+
+Each stream is held in a fixed-size RingBuffer and features are updated every
+hop_s, such that the work per chunk only depends on the chunk, hop and window
+sizes, never on the session length.
+
+XDFReplaySource feeds a recorded XDF file chunk by chunk at real-time or
+accelerated speed, i.e. the engine can be tested and benchmarked without an
+LSL network or hardware:
+
+    python -m processing.online --speed 10 ABC12.xdf
+'''
+import collections
+import logging
+import pathlib
+import time
+import typing as T
+
+import click
+import numpy as np
+import pandas as pd
+
+from processing import ecg_rpeaks, hrv
+from processing.chunked_filter import bandpass_fir
+from processing.ecg_process import ECG_CHANNEL
+from processing.eeg2mne import ELECTRODE_SITES
+from processing.eeg_freq import FILTER_FREQS
+from processing.spectral import BandPowerAccumulator, FREQ_BANDS
+from processing.shared import backends, profiling
+from processing.shared.streams import STREAM_TYPES
+from processing.shared.xdf_stream import StreamHeader, XDFStreamReader
+
+# (time stamp, features) of one update
+Update = T.Tuple[float, pd.Series]
+
+scipy_signal = backends.lazy("scipy.signal")
+logger = logging.getLogger(__name__)
+
+
+class Chunk(T.NamedTuple):
+    stream: str
+    '''Stream name, see STREAM_TYPES'''
+    time_stamps: np.ndarray
+    values: T.Union[np.ndarray, T.List[list]]
+    '''(samples, channels) array, list of lists for string streams'''
+
+
+class Feature(T.NamedTuple):
+    stream: str
+    time_stamp: float
+    '''End of the analysed window'''
+    values: pd.Series
+    marker: T.Optional[str] = None
+    '''Most recent marker when the feature was computed'''
+
+
+class OnlineOptions(T.NamedTuple):
+    hop_s: float = 5.0
+    hrv_width_s: float = 60.0
+    eeg_window_s: float = 10.0
+    detector: str = "pantompkins"
+    bads: T.Tuple[str, ...] = ()
+
+
+class RingBuffer:
+    """The last `capacity` samples of a multi-channel stream
+
+    Samples are stored channel-major like in a SampleStore. Appending a chunk
+    costs O(chunk), independent of the capacity.
+    """
+
+    def __init__(self, capacity: int, num_channels: int = 1, dtype=np.float64):
+        if capacity < 1:
+            raise ValueError("Ring buffer capacity must be positive")
+        self.capacity = capacity
+        self.samples = np.zeros((num_channels, capacity), dtype=dtype)
+        self.time_stamps = np.zeros(capacity)
+        self.total = 0
+        '''Number of samples appended so far'''
+
+    def __len__(self) -> int:
+        return min(self.total, self.capacity)
+
+    @property
+    def last_time_stamp(self) -> float:
+        if not self.total:
+            return np.nan
+        return self.time_stamps[(self.total - 1) % self.capacity]
+
+    def extend(self, time_stamps: np.ndarray, values: np.ndarray):
+        """Appends (samples, channels) or (samples,) values, as read from a stream"""
+        time_stamps = np.asarray(time_stamps, dtype=np.float64)
+        values = np.asarray(values).reshape(time_stamps.size, -1)
+        num_dropped = max(time_stamps.size - self.capacity, 0)
+        # Samples that would be overwritten right away are not copied
+        time_stamps, values = time_stamps[num_dropped:], values[num_dropped:]
+        self.total += num_dropped
+
+        start = self.total % self.capacity
+        first = min(time_stamps.size, self.capacity - start)
+        self.samples[:, start : start + first] = values[:first].T
+        self.time_stamps[start : start + first] = time_stamps[:first]
+        rest = time_stamps.size - first
+        self.samples[:, :rest] = values[first:].T
+        self.time_stamps[:rest] = time_stamps[first:]
+        self.total += time_stamps.size
+
+    def latest(self, num: T.Optional[int] = None) -> T.Tuple[np.ndarray, np.ndarray]:
+        """Copies of the last num samples in order, (samples,) and (channels, samples)"""
+        num = len(self) if num is None else min(num, len(self))
+        idx = (self.total - num + np.arange(num)) % self.capacity
+        return self.time_stamps[idx], self.samples[:, idx]
+
+    def since(self, time_stamp: float) -> T.Tuple[np.ndarray, np.ndarray]:
+        """Copies of the buffered samples at or after time_stamp"""
+        time_stamps, samples = self.latest()
+        start = np.searchsorted(time_stamps, time_stamp)
+        return time_stamps[start:], samples[:, start:]
+
+
+class OnlineHRV:
+    """HRV of the last width_s of an ECG stream, updated every hop_s
+
+    R-peaks are detected on the hop_s of signal since the last update, plus
+    context_s before it for the detector's adaptive threshold and at least
+    lookahead_s after it, as the detector's filters are not settled at the
+    end of the signal. Hence the features lag the stream by lookahead_s.
+    """
+
+    def __init__(
+        self,
+        sampling_rate: float,
+        column: int = 0,
+        width_s: float = 60.0,
+        hop_s: float = 5.0,
+        detector: str = "pantompkins",
+        context_s: float = 5.0,
+        lookahead_s: float = 1.0,
+        refractory_s: float = 0.25,
+    ):
+        if sampling_rate < ecg_rpeaks.MIN_SAMPLING_RATE:
+            raise ValueError(
+                f"R-peak detection requires at least {ecg_rpeaks.MIN_SAMPLING_RATE} Hz, "
+                f"got {sampling_rate} Hz"
+            )
+        self.sampling_rate = sampling_rate
+        self.column = column
+        self.width_s = width_s
+        self.hop_s = hop_s
+        self.context_s = context_s
+        self.lookahead_s = lookahead_s
+        self.refractory_s = refractory_s
+        self.detect = ecg_rpeaks.DETECTORS[detector]
+        self.hop_samples = max(int(hop_s * sampling_rate), 1)
+        # The buffer holds the context, up to two hops and the lookahead
+        capacity = int(np.ceil((context_s + 2 * hop_s + lookahead_s) * sampling_rate)) + 1
+        self.buffer = RingBuffer(capacity)
+        self.rpeak_ts: T.Deque[float] = collections.deque()
+        self._processed_until: T.Optional[float] = None
+
+    def update(self, time_stamps: np.ndarray, values: np.ndarray) -> T.List[Update]:
+        values = np.asarray(values)
+        signal = values[:, self.column] if values.ndim == 2 else values
+        if self._processed_until is None and len(time_stamps):
+            self._processed_until = time_stamps[0]
+        updates = []
+        # Large chunks, e.g. from an accelerated replay, are consumed hop by hop
+        for start in range(0, len(time_stamps), self.hop_samples):
+            stop = start + self.hop_samples
+            self.buffer.extend(time_stamps[start:stop], signal[start:stop])
+            while self.buffer.last_time_stamp - self._processed_until >= (
+                self.hop_s + self.lookahead_s
+            ):
+                updates.append(self._step())
+        return updates
+
+    def _step(self) -> Update:
+        time_stamps, samples = self.buffer.since(self._processed_until - self.context_s)
+        stop_ts = self._processed_until + self.hop_s
+        peaks = time_stamps[np.unique(self.detect(samples[0], self.sampling_rate))]
+        for peak in peaks[(peaks >= self._processed_until) & (peaks < stop_ts)]:
+            # Beats at the previous boundary may be detected by both updates
+            if not self.rpeak_ts or peak - self.rpeak_ts[-1] >= self.refractory_s:
+                self.rpeak_ts.append(peak)
+        self._processed_until = stop_ts
+
+        start_ts = stop_ts - self.width_s
+        while self.rpeak_ts and self.rpeak_ts[0] < start_ts:
+            self.rpeak_ts.popleft()
+        stats = hrv.hrv_windows(np.array(self.rpeak_ts), [start_ts], [stop_ts])
+        return stop_ts, stats.iloc[0]
+
+
+class OnlineBandPower:
+    """Mean band power of the last window_s of an EEG stream, updated every hop_s
+
+    The signal is filtered causally with the band pass of the offline analysis
+    (eeg_freq.FILTER_FREQS) and fed into a BandPowerAccumulator; the band
+    power of the segments within the window is kept in a ring. The linear
+    phase filter delays the signal by (len(h) - 1) / 2 samples, which is
+    compensated in the time stamps of the features.
+    """
+
+    def __init__(
+        self,
+        sampling_rate: float,
+        columns: T.Sequence[int],
+        channels: T.Sequence[str],
+        window_s: float = 10.0,
+        hop_s: float = 5.0,
+        filter_freqs: T.Tuple[float, float] = FILTER_FREQS,
+    ):
+        if sampling_rate <= 0:
+            raise ValueError("Online band power requires a regularly sampled stream")
+        self.sampling_rate = sampling_rate
+        self.columns = list(columns)
+        self.h = bandpass_fir(sampling_rate, *filter_freqs)
+        self.delay_s = (self.h.size - 1) / 2 / sampling_rate
+        self.accumulator = BandPowerAccumulator(sampling_rate)
+        step = self.accumulator.step
+        self.hop_segments = max(int(round(hop_s * sampling_rate / step)), 1)
+        window_segments = max(int(round(window_s * sampling_rate / step)), 1)
+        self._band_power = np.full((len(channels), len(FREQ_BANDS), window_segments), np.nan)
+        self._index = pd.MultiIndex.from_product(
+            [list(channels), list(FREQ_BANDS)], names=["Channels", "Freq Bands"]
+        )
+        self._history: T.Optional[np.ndarray] = None
+        self._first_ts: T.Optional[float] = None
+
+    def update(self, time_stamps: np.ndarray, values: np.ndarray) -> T.List[Update]:
+        if not len(time_stamps):
+            return []
+        samples = np.asarray(values, dtype=np.float64)[:, self.columns].T
+        if self._history is None:
+            self._first_ts = time_stamps[0]
+            # Start as if the first sample had been constant before
+            self._history = np.repeat(samples[:, :1], self.h.size - 1, axis=-1)
+        extended = np.concatenate([self._history, samples], axis=-1)
+        filtered = scipy_signal.oaconvolve(extended, self.h[np.newaxis], mode="valid", axes=-1)
+        self._history = extended[:, extended.shape[-1] - (self.h.size - 1) :]
+
+        first_segment = self.accumulator.num_segments
+        self.accumulator.update(filtered)
+        band_power = self.accumulator.drain()
+        updates = []
+        for offset in range(band_power.shape[-1]):
+            segment = first_segment + offset
+            self._band_power[..., segment % self._band_power.shape[-1]] = band_power[..., offset]
+            if (segment + 1) % self.hop_segments == 0:
+                updates.append(self._feature(segment))
+        return updates
+
+    def _feature(self, segment: int) -> Update:
+        stop = segment * self.accumulator.step + self.accumulator.n_fft
+        time_stamp = self._first_ts + stop / self.sampling_rate - self.delay_s
+        # Like np.nanmean, but NaN without a warning while the ring holds no
+        # valid segment, e.g. during a dropout at the start of the stream
+        valid = ~np.isnan(self._band_power)
+        num_valid = valid.sum(axis=-1)
+        total = np.where(valid, self._band_power, 0).sum(axis=-1)
+        power = np.where(num_valid > 0, total / np.maximum(num_valid, 1), np.nan)
+        return time_stamp, pd.Series(power.ravel(), index=self._index)
+
+
+class OnlineEngine:
+    """Dispatches stream chunks to the processor of each stream
+
+    processors: Objects with an update(time_stamps, values) method returning
+        a list of (time stamp, features) updates, by stream name
+    """
+
+    def __init__(self, processors: T.Mapping[str, T.Any]):
+        self.processors = dict(processors)
+        self.marker: T.Optional[str] = None
+        self.num_samples: T.Counter[str] = collections.Counter()
+
+    @classmethod
+    def for_streams(
+        cls, headers: T.Iterable[StreamHeader], options: OnlineOptions = OnlineOptions()
+    ) -> "OnlineEngine":
+        """Engine with processors for the ECG and EEG streams among headers"""
+        processors = {}
+        for header in headers:
+            columns = header.columns
+            if header.name == STREAM_TYPES.brainvision_eda and ECG_CHANNEL in columns:
+                processors[header.name] = OnlineHRV(
+                    header.nominal_srate,
+                    column=columns.index(ECG_CHANNEL),
+                    width_s=options.hrv_width_s,
+                    hop_s=options.hop_s,
+                    detector=options.detector,
+                )
+            elif header.name == STREAM_TYPES.g_tec:
+                channels = [
+                    ch for ch in ELECTRODE_SITES if ch in columns and ch not in options.bads
+                ]
+                processors[header.name] = OnlineBandPower(
+                    header.nominal_srate,
+                    [columns.index(ch) for ch in channels],
+                    channels,
+                    window_s=options.eeg_window_s,
+                    hop_s=options.hop_s,
+                )
+        return cls(processors)
+
+    def process(self, chunks: T.Iterable[Chunk]) -> T.Iterator[Feature]:
+        """Yields features as soon as the chunks they depend on were consumed"""
+        for chunk in chunks:
+            self.num_samples[chunk.stream] += len(chunk.time_stamps)
+            if chunk.stream == STREAM_TYPES.marker:
+                if len(chunk.values):
+                    self.marker = str(chunk.values[-1][0])
+                continue
+            processor = self.processors.get(chunk.stream)
+            if processor is None:
+                continue
+            for time_stamp, values in processor.update(chunk.time_stamps, chunk.values):
+                yield Feature(chunk.stream, time_stamp, values, self.marker)
+
+
+class XDFReplaySource:
+    """Replays the sample chunks of a recorded XDF file like live streams
+
+    speed: Replay speed relative to real time, None replays as fast as possible
+    clock, sleep: Time functions, replaceable for testing
+    """
+
+    def __init__(
+        self,
+        path: T.Union[pathlib.Path, str],
+        speed: T.Optional[float] = 1.0,
+        names: T.Optional[T.Iterable[str]] = None,
+        clock: T.Callable[[], float] = time.monotonic,
+        sleep: T.Callable[[float], None] = time.sleep,
+    ):
+        if speed is not None and speed <= 0:
+            raise ValueError("Replay speed must be positive")
+        self.reader = XDFStreamReader(path, names)
+        self.speed = speed
+        self.clock = clock
+        self.sleep = sleep
+
+    def headers(self) -> T.List[StreamHeader]:
+        if not self.reader.headers:
+            self.reader.scan()
+        return list(self.reader.headers.values())
+
+    def __iter__(self) -> T.Iterator[Chunk]:
+        names = {header.stream_id: header.name for header in self.headers()}
+        start = None
+        for stream_id, time_stamps, values in self.reader.iter_samples():
+            if self.speed is not None:
+                if start is None:
+                    start = (time_stamps[0], self.clock())
+                # A chunk is due once its last sample would have been recorded
+                due = start[1] + (time_stamps[-1] - start[0]) / self.speed
+                delay = due - self.clock()
+                if delay > 0:
+                    self.sleep(delay)
+            yield Chunk(names[stream_id], time_stamps, values)
+
+
+def format_feature(feature: Feature) -> str:
+    """One line summary, band power is averaged over channels"""
+    if isinstance(feature.values.index, pd.MultiIndex):
+        summary = feature.values.groupby(level="Freq Bands", sort=False).mean()
+        values = " ".join(f"{band}={power:.3g}" for band, power in summary.items())
+    else:
+        summary = feature.values[["hr_mean", "sdnn", "rmssd"]]
+        values = " ".join(f"{name}={value:.1f}" for name, value in summary.items())
+    return f"{feature.time_stamp:10.2f}  {feature.stream:<16} [{feature.marker}]  {values}"
+
+
+@click.command()
+@click.argument("xdf_path", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--speed",
+    default=1.0,
+    show_default=True,
+    type=click.FloatRange(min=0),
+    help="Replay speed relative to real time, 0 replays as fast as possible",
+)
+@click.option(
+    "--hop",
+    "hop_s",
+    default=OnlineOptions().hop_s,
+    show_default=True,
+    help="Update interval in s",
+)
+@click.option(
+    "--hrv-window",
+    "hrv_width_s",
+    default=OnlineOptions().hrv_width_s,
+    show_default=True,
+    help="HRV window in s",
+)
+@click.option(
+    "--eeg-window",
+    "eeg_window_s",
+    default=OnlineOptions().eeg_window_s,
+    show_default=True,
+    help="Band power window in s",
+)
+@click.option(
+    "--detector",
+    default=OnlineOptions().detector,
+    show_default=True,
+    type=click.Choice(sorted(ecg_rpeaks.DETECTORS)),
+    help="R-peak detector",
+)
+@profiling.verbose_option
+@profiling.quiet_option
+def main(xdf_path, speed, hop_s, hrv_width_s, eeg_window_s, detector, verbose, quiet):
+    """Replays a recorded session through the online engine
+
+    xdf_path: Recorded XDF file
+
+    Output: HRV and band power updates, printed as they are computed
+    """
+    profiling.configure_logging(verbose, quiet)
+    options = OnlineOptions(hop_s, hrv_width_s, eeg_window_s, detector)
+    names = [STREAM_TYPES.marker, STREAM_TYPES.brainvision_eda, STREAM_TYPES.g_tec]
+    source = XDFReplaySource(xdf_path, speed or None, names)
+    engine = OnlineEngine.for_streams(source.headers(), options)
+    logger.info(f"Replaying {xdf_path} with processors for {sorted(engine.processors)}")
+
+    start = time.perf_counter()
+    for feature in engine.process(source):
+        print(format_feature(feature))
+    elapsed = time.perf_counter() - start
+    num_samples = sum(engine.num_samples.values())
+    print(
+        f"Processed {num_samples} samples in {elapsed:.2f} s "
+        f"({num_samples / elapsed:.0f} samples/s)"
+    )
+
+
+if __name__ == "__main__":
+    main()
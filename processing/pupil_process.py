@@ -0,0 +1,379 @@
+'''
+Pupil diameter statistics per period from Pupil Labs eye tracking data
+
+Only the confidence and the pupil diameters of both eyes are read from the
+wide pupil_capture stream, in chunks, and cleaned with vectorised steps:
+
+1. Samples below a confidence threshold or without a positive diameter are
+   invalid. Pupil Capture reports blinks as samples with zero confidence.
+2. Runs of invalid samples that last between min_blink_s and max_blink_s
+   are counted as blinks.
+3. All gaps are widened by blink_margin_s on both sides, as the diameter is
+   distorted while the lid closes and opens, and interpolated linearly if
+   they span at most max_gap_s. Longer gaps remain missing.
+
+Every chunk is cleaned together with the samples around it that can affect
+its result, i.e. independent of the chunk size. The statistics of the
+periods, resolved by period_slices() like extract_periods(), are summed
+chunk by chunk, such that memory does not depend on the recording length
+except for the time stamps.
+'''
+import itertools
+import logging
+import pathlib
+import typing as T
+
+import click
+import numpy as np
+import pandas as pd
+
+from processing.shared import profiling
+from processing.shared import results as results_dataset
+from processing.shared.recording import Recording
+from processing.shared.sample_store import SampleStore
+from processing.shared.select_data import PeriodSlices, period_slices
+from processing.shared.streams import STREAM_TYPES
+
+CONFIDENCE_CHANNEL = "confidence"
+# Diameters of both eyes, in mm of the 3d eye model or in pixels of the eye images
+DIAMETER_CHANNELS = {
+    "3d": ["diameter0_3d", "diameter1_3d"],
+    "2d": ["diameter0_2d", "diameter1_2d"],
+}
+# Modality of the results in a study results dataset, see processing.shared.results
+RESULTS_MODALITY = "pupil"
+# File name prefix of the per-subject CSV in extracted_csv/
+CSV_PREFIX = "pupil_"
+# Samples read at once, about 15 min at 120 Hz
+DEFAULT_CHUNK_SAMPLES = 100_000
+
+logger = logging.getLogger(__name__)
+
+
+class PupilOptions(T.NamedTuple):
+    min_confidence: float = 0.6
+    '''Samples below this confidence are invalid, as recommended by Pupil Labs'''
+    diameter: str = "3d"
+    '''Diameter estimate, see DIAMETER_CHANNELS'''
+    min_blink_s: float = 0.05
+    max_blink_s: float = 0.5
+    blink_margin_s: float = 0.05
+    '''Time before and after each gap that is interpolated as well'''
+    max_gap_s: float = 1.0
+    '''Longest gap, including its margins, that is interpolated'''
+
+    @property
+    def context_s(self) -> float:
+        """Time before and after a sample that can affect its cleaned value"""
+        return max(self.max_blink_s, self.max_gap_s) + 2 * self.blink_margin_s
+
+
+class CleanPupil(T.NamedTuple):
+    diameter: np.ndarray
+    '''Cleaned diameter, NaN within gaps that were not interpolated'''
+    valid: np.ndarray
+    '''Whether a sample passed the confidence filter'''
+    interpolated: np.ndarray
+    blink_onsets: np.ndarray
+    '''Whether a blink starts at a sample'''
+
+
+# Per-sample quantities that are summed per period, see period_pupil_stats()
+_SUMS = ("diameter", "squares", "count", "valid", "interpolated", "blinks")
+
+
+def clean_pupil(
+    time_stamps: np.ndarray,
+    confidence: np.ndarray,
+    diameters: np.ndarray,
+    options: PupilOptions = PupilOptions(),
+) -> CleanPupil:
+    """Filters, detects blinks and interpolates the diameter of consecutive samples
+
+    time_stamps: (samples,) sorted time stamps
+    confidence: (samples,) confidence of the pupil detection
+    diameters: (eyes, samples) diameter of each eye
+
+    The diameter of a sample is the mean of the eyes with a positive diameter.
+    Gaps at the start and end of the samples are neither blinks nor
+    interpolated.
+    """
+    time_stamps = np.asarray(time_stamps)
+    num_samples = time_stamps.size
+    diameters = np.asarray(diameters, dtype=np.float64)
+    detected = diameters > 0
+    num_detected = detected.sum(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        diameter = np.where(detected, diameters, 0).sum(axis=0) / num_detected
+    valid = (np.asarray(confidence) >= options.min_confidence) & (num_detected > 0)
+
+    start, stop = _runs(~valid)
+    inner = (start > 0) & (stop < num_samples)
+    duration = time_stamps[stop.clip(max=num_samples - 1)] - time_stamps[start]
+    blink = inner & (duration >= options.min_blink_s) & (duration <= options.max_blink_s)
+    blink_onsets = np.zeros(num_samples, dtype=bool)
+    blink_onsets[start[blink]] = True
+
+    margin_start = np.searchsorted(
+        time_stamps, time_stamps[start] - options.blink_margin_s, side="left"
+    )
+    margin_stop = np.searchsorted(
+        time_stamps, time_stamps[stop - 1] + options.blink_margin_s, side="right"
+    )
+    usable = ~_cover(num_samples, margin_start, margin_stop)
+
+    # Gaps are interpolated between their usable neighbours
+    start, stop = _runs(~usable)
+    inner = (start > 0) & (stop < num_samples)
+    span = time_stamps[stop.clip(max=num_samples - 1)] - time_stamps[(start - 1).clip(min=0)]
+    fill = inner & (span <= options.max_gap_s)
+    interpolated = _cover(num_samples, start[fill], stop[fill])
+
+    cleaned = np.full(num_samples, np.nan)
+    cleaned[usable] = diameter[usable]
+    if interpolated.any():
+        cleaned[interpolated] = np.interp(
+            time_stamps[interpolated], time_stamps[usable], diameter[usable]
+        )
+    return CleanPupil(cleaned, valid, interpolated, blink_onsets)
+
+
+def _runs(mask: np.ndarray) -> T.Tuple[np.ndarray, np.ndarray]:
+    """Offsets [start, stop) of the runs of True values"""
+    edges = np.diff(mask.astype(np.int8), prepend=0, append=0)
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+
+def _cover(num_samples: int, start: np.ndarray, stop: np.ndarray) -> np.ndarray:
+    """Mask of the samples within any of the, possibly overlapping, ranges [start, stop)"""
+    counts = np.zeros(num_samples + 1, dtype=np.intp)
+    np.add.at(counts, start, 1)
+    np.add.at(counts, stop, -1)
+    return np.cumsum(counts[:-1]) > 0
+
+
+def iter_clean_chunks(
+    chunks: T.Iterable[SampleStore], options: PupilOptions = PupilOptions()
+) -> T.Iterator[T.Tuple[np.ndarray, CleanPupil]]:
+    """Cleans a stream chunk by chunk, see clean_pupil()
+
+    chunks: Consecutive chunks of the confidence and diameter channels, in
+        this order, e.g. from Recording.iter_stream()
+
+    Yields the time stamps and the cleaned samples of consecutive ranges of
+    samples. Each range is cleaned together with options.context_s of
+    samples before and after it, which gives the same result as cleaning
+    the whole stream at once.
+    """
+    buffer = None
+    # Samples at the start of the buffer that were yielded already and are
+    # only kept as context
+    done = 0
+    for chunk in itertools.chain(chunks, [None]):
+        if chunk is not None:
+            if buffer is None:
+                buffer = chunk
+            else:
+                buffer = SampleStore(
+                    np.concatenate([buffer.samples, chunk.samples], axis=1),
+                    np.concatenate([buffer.time_stamps, chunk.time_stamps]),
+                    buffer.channels,
+                )
+            # Samples followed by their full context can be cleaned
+            ready = int(
+                np.searchsorted(
+                    buffer.time_stamps, buffer.time_stamps[-1] - options.context_s, side="left"
+                )
+            )
+        elif buffer is None:
+            return
+        else:
+            ready = len(buffer)
+        if ready <= done:
+            continue
+
+        cleaned = clean_pupil(buffer.time_stamps, buffer.samples[0], buffer.samples[1:], options)
+        yield buffer.time_stamps[done:ready], CleanPupil(*(field[done:ready] for field in cleaned))
+
+        if ready < len(buffer):
+            # Keep one sample more than the context, such that the next range
+            # never starts a gap at the start of the buffer
+            keep = np.searchsorted(
+                buffer.time_stamps, buffer.time_stamps[ready] - options.context_s, side="left"
+            )
+            keep = max(int(keep) - 1, 0)
+            buffer = buffer.slice(keep, len(buffer))
+            done = ready - keep
+
+
+def period_pupil_stats(
+    chunks: T.Iterable[SampleStore],
+    time_stamps: np.ndarray,
+    slices: PeriodSlices,
+    options: PupilOptions = PupilOptions(),
+) -> pd.DataFrame:
+    """Cleans a stream chunk by chunk and aggregates it per period
+
+    chunks: Consecutive chunks of the confidence and diameter channels
+    time_stamps: All time stamps of the stream, which the slices refer to
+
+    Output: Frame indexed by the period labels with the mean and standard
+    deviation of the cleaned diameter, the ratios of valid and of
+    interpolated samples, and the number and rate per minute of blinks.
+    Statistics of empty periods are NaN.
+    """
+    start = np.asarray(slices.start, dtype=np.intp)
+    stop = np.maximum(np.asarray(slices.stop, dtype=np.intp), start)
+    sums = np.zeros((len(_SUMS), start.size))
+    offset = 0
+    for _, cleaned in iter_clean_chunks(chunks, options):
+        num_samples = cleaned.diameter.size
+        diameter = np.nan_to_num(cleaned.diameter)
+        values = np.stack([
+            diameter,
+            diameter**2,
+            np.isfinite(cleaned.diameter),
+            cleaned.valid,
+            cleaned.interpolated,
+            cleaned.blink_onsets,
+        ])
+        # Sums of all periods from a single cumulative sum, like period_mean()
+        cumsum = np.zeros((len(_SUMS), num_samples + 1))
+        np.cumsum(values, axis=-1, out=cumsum[:, 1:])
+        first = (start - offset).clip(0, num_samples)
+        last = (stop - offset).clip(0, num_samples)
+        sums += cumsum[:, last] - cumsum[:, first]
+        offset += num_samples
+    totals = dict(zip(_SUMS, sums))
+
+    length = (stop - start).astype(np.float64)
+    length[length == 0] = np.nan
+    empty = stop == start
+    duration_s = np.where(
+        empty,
+        np.nan,
+        time_stamps[(stop - 1).clip(min=0)] - time_stamps[start.clip(max=len(time_stamps) - 1)],
+    )
+    with np.errstate(invalid="ignore", divide="ignore"):
+        count = np.where(totals["count"] > 0, totals["count"], np.nan)
+        mean = totals["diameter"] / count
+        variance = (totals["squares"] - totals["diameter"] * mean) / (count - 1)
+        stats = {
+            "pupil_mean": mean,
+            "pupil_std": np.sqrt(variance.clip(min=0)),
+            "valid_ratio": totals["valid"] / length,
+            "interpolated_ratio": totals["interpolated"] / length,
+            "blinks": np.where(empty, np.nan, totals["blinks"]),
+            "blink_rate": totals["blinks"] / (duration_s / 60),
+        }
+    return pd.DataFrame(stats, index=slices.labels)
+
+
+@click.command()
+@click.argument("folders", nargs=-1, type=click.Path(exists=True))
+@click.option(
+    "--diameter",
+    default=PupilOptions().diameter,
+    show_default=True,
+    type=click.Choice(sorted(DIAMETER_CHANNELS)),
+    help="Diameter of the 3d eye model in mm or of the 2d pupil ellipse in pixels",
+)
+@click.option(
+    "--min-confidence",
+    default=PupilOptions().min_confidence,
+    show_default=True,
+    type=click.FloatRange(0, 1),
+    help="Samples with a lower pupil detection confidence are invalid",
+)
+@click.option(
+    "--max-gap",
+    default=PupilOptions().max_gap_s,
+    show_default=True,
+    type=click.FloatRange(min=0),
+    help="Longest gap in s that is interpolated, including the blink margins",
+)
+@click.option(
+    "--chunk-samples",
+    default=DEFAULT_CHUNK_SAMPLES,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Number of samples read and cleaned at once",
+)
+@click.option(
+    "--output",
+    type=click.Path(file_okay=False),
+    help="Study results dataset to write to instead of per-subject CSV files",
+)
+@profiling.verbose_option
+@profiling.quiet_option
+def main(folders, diameter, min_confidence, max_gap, chunk_samples, output, verbose, quiet):
+    """Processes and extracts pupil diameter statistics from eye tracking data
+
+    folders: List of folders containing processed eye tracking parquet files
+
+    Output: Statistics saved to folder/extracted_csv/pupil_<vp_code>.csv, or
+    to the partition modality=pupil/vp_code=<vp_code> of the --output
+    dataset, and a profile folder/<vp_code>_pupil_profile.json
+    """
+    profiling.configure_logging(verbose, quiet)
+    if output is not None:
+        output = pathlib.Path(output).resolve()
+    folders = sorted(pathlib.Path(fn).resolve() for fn in folders)
+    options = PupilOptions(
+        min_confidence=min_confidence, diameter=diameter, max_gap_s=max_gap
+    )
+    for path in folders:
+        with profiling.Profiler() as profiler:
+            result = process_folder(path, options, chunk_samples, output)
+        if result is not None:
+            vp_code = Recording(path).vp_code
+            profile_path = profiling.profile_path(path, vp_code, "pupil")
+            profiler.write(profile_path, vp_code=vp_code, command="pupil")
+
+
+def process_folder(
+    path: pathlib.Path,
+    options: PupilOptions = PupilOptions(),
+    chunk_samples: int = DEFAULT_CHUNK_SAMPLES,
+    output: T.Optional[pathlib.Path] = None,
+) -> T.Optional[pathlib.Path]:
+    """Extracts the pupil statistics per period of one recording and writes them
+
+    Returns the path of the written results, None if the vp_code is unknown.
+    """
+    R = Recording(path)
+    logger.info(f"Loading {path}")
+    try:
+        conditions = R.condition_order()
+    except KeyError:
+        logger.warning(f"\tUnknown vp_code {R.vp_code}. Aborting.")
+        return None
+    logger.info(f"\tFound vp_code `{R.vp_code}`:")
+    logger.info(f"\t\tBlock 0: {conditions.block0}")
+    logger.info(f"\t\tBlock 1: {conditions.block1}")
+    logger.info(f"\t\tBlock 2: {conditions.block2}")
+    with profiling.span("period_slices"):
+        markers = R.read_markers()
+        time_stamps = R.read_time_stamps(STREAM_TYPES.eye_tracking)
+        condition_labels = [cond.value for cond in conditions]
+        slices = period_slices(time_stamps, markers, condition_labels, num_task_subblocks=6)
+
+    logger.info("\tCleaning pupil diameters and calculating statistics for all periods...")
+    columns = [CONFIDENCE_CHANNEL, *DIAMETER_CHANNELS[options.diameter]]
+    chunks = R.iter_stream(STREAM_TYPES.eye_tracking, columns, chunk_samples)
+    with profiling.span("clean_aggregate", samples=len(time_stamps)):
+        stats = period_pupil_stats(chunks, time_stamps, slices, options)
+    logger.info("\tFinished statistics.")
+
+    final_frame = pd.concat([stats], keys=[R.vp_code], names=["vp_code"]).reset_index()
+    return results_dataset.write_subject_results(
+        R, RESULTS_MODALITY, final_frame, CSV_PREFIX, output
+    )
+
+
+def result_path(R: Recording, output=None) -> pathlib.Path:
+    return results_dataset.subject_result_path(R, RESULTS_MODALITY, CSV_PREFIX, output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,414 @@
+'''
+Alignment of the numeric streams of a recording onto a common time grid
+
+The exports keep the time stamps of each stream as recorded, relative to
+the first block start (see xdf_convert.normalize_index). LSL's clock
+synchronization removed the offsets between the recording hosts already,
+but each device samples with its own clock, which drifts against the LSL
+clock, and the time stamps jitter with the transmission.
+
+fit_clock() estimates the sample clock of a stream with a linear fit of its
+time stamps over the sample index, per segment between dropouts, like
+pyxdf's dejittering: the offset of its first sample, its effective
+sampling rate and thereby its drift against the nominal rate, and the
+remaining jitter. Every channel is then mapped onto one regular grid,
+with vectorised linear interpolation, or, when the grid has a lower rate,
+with polyphase resampling followed by interpolation onto the exact grid
+points.
+
+    python -m processing.shared.align --rate 256 study/*/
+
+writes the channels of all streams as one sample store next to the exports:
+
+    ABC12_aligned.npy                (channels, samples) on the common grid
+    ABC12_aligned_time_stamps.npy
+    ABC12_aligned_channels.json      ["brainvision/ECG", "gtec/F3", ...]
+    ABC12_aligned_alignment.json     grid rate and clock model per stream
+
+whose periods hold the samples of all modalities at once:
+
+    aligned = AlignedStore.open(aligned_path(R))
+    for label, period in aligned.periods(R.read_markers(), condition_labels):
+        ecg, fz = period.channel("brainvision/ECG"), period.channel("gtec/Fz")
+
+Samples of the grid outside of a stream, or within its dropouts, are NaN.
+'''
+import dataclasses
+import fractions
+import json
+import logging
+import math
+import pathlib
+import typing as T
+
+import click
+import numpy as np
+
+from processing.shared import backends, profiling
+from processing.shared.recording import Recording
+from processing.shared.sample_store import SampleStore, channels_path, time_stamps_path
+from processing.shared.select_data import PeriodSlices, period_slices
+from processing.shared.streams import STREAM_TYPES, FILE_SUFFIXES
+
+ALIGNED_STREAMS = [
+    STREAM_TYPES.brainvision_eda,
+    STREAM_TYPES.g_tec,
+    STREAM_TYPES.eye_tracking,
+]
+# Nominal sampling rates, overridden per subject by the sampling rate lookup
+# table. Pupil Capture sends samples at the irregular frame rate of the
+# eye cameras.
+NOMINAL_RATES = {
+    STREAM_TYPES.brainvision_eda: 1000.0,
+    STREAM_TYPES.g_tec: 256.0,
+    STREAM_TYPES.eye_tracking: None,
+}
+# Rate of the common grid, the EEG sampling rate of eeg2mne
+DEFAULT_RATE = 256.0
+ALIGNED_SUFFIX = "_aligned"
+ALIGNMENT_SUFFIX = "_alignment.json"
+# Time stamp gaps longer than this split a stream into segments, see pyxdf's
+# jitter_break_threshold_seconds
+BREAK_THRESHOLD_S = 1.0
+# Streams whose jitter is below this fraction of the sample period are
+# sampled regularly, their fitted time stamps replace the recorded ones
+REGULAR_JITTER = 0.25
+# Largest up and down factor of the polyphase resampling
+MAX_RESAMPLE_FACTOR = 1000
+
+
+class Method:
+    auto = "auto"
+    '''Polyphase resampling if the grid rate is lower than the stream's'''
+    linear = "linear"
+    poly = "poly"
+
+
+scipy_signal = backends.lazy("scipy.signal")
+logger = logging.getLogger(__name__)
+
+
+class ClockModel(T.NamedTuple):
+    nominal_rate: T.Optional[float]
+    effective_rate: float
+    '''Samples per second of the LSL clock, averaged over all segments'''
+    offset_s: float
+    '''Fitted time stamp of the first sample'''
+    drift_ppm: T.Optional[float]
+    '''Deviation of the effective from the nominal rate in parts per million'''
+    jitter_s: float
+    '''Standard deviation of the recorded from the fitted time stamps'''
+    segments: int
+
+    @property
+    def regular(self) -> bool:
+        return self.jitter_s < REGULAR_JITTER / self.effective_rate
+
+
+class CommonGrid(T.NamedTuple):
+    first: int
+    '''Index of the first sample, the grid includes time zero'''
+    rate: float
+    num_samples: int
+
+    @classmethod
+    def spanning(cls, intervals: T.Iterable[T.Tuple[float, float]], rate: float) -> "CommonGrid":
+        """Grid from the earliest start to the latest stop of the intervals"""
+        intervals = list(intervals)
+        first = math.ceil(min(start for start, _ in intervals) * rate)
+        last = math.floor(max(stop for _, stop in intervals) * rate)
+        return cls(first, rate, last - first + 1)
+
+    def time_stamps(self) -> np.ndarray:
+        return (self.first + np.arange(self.num_samples)) / self.rate
+
+
+def fit_clock(
+    time_stamps: np.ndarray,
+    nominal_rate: T.Optional[float] = None,
+    break_s: float = BREAK_THRESHOLD_S,
+) -> T.Tuple[ClockModel, np.ndarray]:
+    """Fits the sample clock of a stream to its time stamps
+
+    The time stamps of each segment between gaps longer than `break_s` are
+    fitted by a line over the sample index.
+
+    Returns the clock model and the fitted time stamps. Raises a ValueError
+    if no segment has two samples, i.e. there is no interval to fit.
+    """
+    time_stamps = np.asarray(time_stamps, dtype=np.float64)
+    if time_stamps.size < 2:
+        raise ValueError(f"Fitting a clock needs two samples, got {time_stamps.size}")
+    fitted = np.empty_like(time_stamps)
+    periods = []
+    for start, stop in _segments(time_stamps, break_s):
+        segment = time_stamps[start:stop]
+        num_samples = stop - start
+        index = np.arange(num_samples) - (num_samples - 1) / 2
+        mean = segment.mean()
+        if num_samples > 1:
+            # Least squares slope, the sum of squared index deviations in closed form
+            period = index @ (segment - mean) / (num_samples * (num_samples**2 - 1) / 12)
+        else:
+            period = np.nan
+        fitted[start:stop] = mean + index * np.nan_to_num(period)
+        periods.append((period, num_samples - 1))
+
+    intervals = sum(count for _, count in periods)
+    if not intervals:
+        raise ValueError(f"No two of the {time_stamps.size} samples lie within {break_s} s")
+    period = sum(period * count for period, count in periods if count) / intervals
+    effective_rate = 1.0 / period
+    drift_ppm = None
+    if nominal_rate is not None:
+        drift_ppm = (effective_rate / nominal_rate - 1) * 1e6
+    clock = ClockModel(
+        nominal_rate,
+        effective_rate,
+        float(fitted[0]),
+        drift_ppm,
+        float(np.std(time_stamps - fitted)),
+        len(periods),
+    )
+    return clock, fitted
+
+
+def _segments(time_stamps: np.ndarray, break_s: float) -> T.List[T.Tuple[int, int]]:
+    breaks = np.flatnonzero(np.diff(time_stamps) > break_s) + 1
+    bounds = [0, *breaks.tolist(), time_stamps.size]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def resample_to_grid(
+    values: np.ndarray,
+    time_stamps: np.ndarray,
+    grid: CommonGrid,
+    method: str = Method.linear,
+    source_rate: T.Optional[float] = None,
+    break_s: float = BREAK_THRESHOLD_S,
+) -> np.ndarray:
+    """Maps a channel sampled at `time_stamps` onto the grid
+
+    method: Method.linear interpolates linearly. Method.poly first low pass
+        filters and resamples each segment with scipy.signal.resample_poly
+        by the ratio of the grid rate and `source_rate` and then
+        interpolates onto the grid points, the time stamps of a segment
+        have to be equidistant.
+    source_rate: Nominal rate of the channel, defaults to the rate of each
+        segment. The interpolation corrects the drift from the nominal rate.
+
+    Grid points outside of the segments of the channel are NaN.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    grid_time_stamps = grid.time_stamps()
+    resampled = np.full(grid.num_samples, np.nan)
+    for start, stop in _segments(time_stamps, break_s):
+        segment_ts = time_stamps[start:stop]
+        segment = values[start:stop]
+        first = np.searchsorted(grid_time_stamps, segment_ts[0], side="left")
+        last = np.searchsorted(grid_time_stamps, segment_ts[-1], side="right")
+        if last <= first:
+            continue
+        if method == Method.poly and stop - start > 1:
+            period = (segment_ts[-1] - segment_ts[0]) / (stop - start - 1)
+            rate = 1 / period if source_rate is None else source_rate
+            ratio = fractions.Fraction(grid.rate / rate).limit_denominator(MAX_RESAMPLE_FACTOR)
+            segment = scipy_signal.resample_poly(
+                segment, ratio.numerator, ratio.denominator, padtype="line"
+            )
+            segment_ts = segment_ts[0] + np.arange(segment.size) * (period / float(ratio))
+        resampled[first:last] = np.interp(grid_time_stamps[first:last], segment_ts, segment)
+    return resampled
+
+
+def stream_channel(stream_type: str, channel: str) -> str:
+    """Name of a stream's channel in an aligned store, e.g. "gtec/Fz" """
+    return f"{FILE_SUFFIXES[stream_type].lstrip('_')}/{channel}"
+
+
+def aligned_path(R: Recording) -> pathlib.Path:
+    return R.directory / f"{R.vp_code}{ALIGNED_SUFFIX}.npy"
+
+
+def alignment_path(store_path: pathlib.Path) -> pathlib.Path:
+    return store_path.with_name(store_path.stem + ALIGNMENT_SUFFIX)
+
+
+@dataclasses.dataclass
+class AlignedStore:
+    store: SampleStore
+    '''Channels of all streams on the common grid'''
+    rate: float
+    clocks: T.Dict[str, ClockModel]
+    '''Clock model per stream type'''
+    methods: T.Dict[str, str]
+    '''Method that mapped each stream onto the grid'''
+
+    @classmethod
+    def open(cls, path: pathlib.Path) -> "AlignedStore":
+        path = pathlib.Path(path)
+        alignment = json.loads(alignment_path(path).read_text())
+        clocks = {
+            stream_type: ClockModel(**clock)
+            for stream_type, clock in alignment["clocks"].items()
+        }
+        return cls(SampleStore.open(path), alignment["rate"], clocks, alignment["methods"])
+
+    def stream(self, stream_type: str) -> SampleStore:
+        """Channels of one stream with their names in the stream"""
+        prefix = stream_channel(stream_type, "")
+        channels = [ch for ch in self.store.channels if ch.startswith(prefix)]
+        store = self.store.select_channels(channels)
+        return dataclasses.replace(store, channels=[ch[len(prefix):] for ch in channels])
+
+    def period_slices(self, markers, block_labels=None, **kwargs) -> PeriodSlices:
+        """Periods of the grid, see select_data.period_slices()"""
+        return period_slices(self.store.time_stamps, markers, block_labels, **kwargs)
+
+    def periods(
+        self, markers, block_labels=None, **kwargs
+    ) -> T.Iterator[T.Tuple[T.Tuple[str, str], SampleStore]]:
+        """Yields (label, view) of every period with the channels of all streams"""
+        return self.period_slices(markers, block_labels, **kwargs).take(self.store)
+
+
+def align_recording(
+    R: Recording,
+    rate: float = DEFAULT_RATE,
+    method: str = Method.auto,
+    stream_types: T.Sequence[str] = ALIGNED_STREAMS,
+    path: T.Optional[pathlib.Path] = None,
+) -> AlignedStore:
+    """Maps the channels of the streams of a recording onto a common grid
+
+    The streams are read one channel at a time and written to an aligned
+    store of float32 samples at `path`, which defaults to aligned_path().
+    Streams that were not exported or are too short to fit their clock are
+    left out with a warning, e.g. sessions without eye tracking.
+    """
+    path = aligned_path(R) if path is None else pathlib.Path(path)
+    clocks = {}
+    methods = {}
+    stream_time_stamps = {}
+    with profiling.span("fit_clocks"):
+        for stream_type in stream_types:
+            try:
+                time_stamps = R.read_time_stamps(stream_type)
+                nominal_rate = R.sampling_rate(stream_type) or NOMINAL_RATES.get(stream_type)
+                clock, fitted = fit_clock(time_stamps, nominal_rate)
+            except (FileNotFoundError, ValueError) as error:
+                logger.warning(f"\tSkipping {stream_type}: {error}")
+                continue
+            logger.info(f"\t{stream_type}: {format_clock(clock)}")
+            stream_method = method
+            if method == Method.auto:
+                stream_rate = clock.nominal_rate or clock.effective_rate
+                stream_method = Method.poly if stream_rate > rate else Method.linear
+            clocks[stream_type] = clock
+            methods[stream_type] = stream_method
+            # Polyphase resampling needs equidistant samples
+            if clock.regular or stream_method == Method.poly:
+                stream_time_stamps[stream_type] = fitted
+            else:
+                stream_time_stamps[stream_type] = np.asarray(time_stamps)
+
+    if not clocks:
+        raise ValueError(f"None of {', '.join(stream_types)} can be aligned in {R.directory}")
+    # Streams in the requested order, without the skipped ones
+    aligned_streams = list(clocks)
+
+    grid = CommonGrid.spanning(
+        ((ts[0], ts[-1]) for ts in stream_time_stamps.values()), rate
+    )
+    channels = {
+        stream_type: R.stream_channels(stream_type) for stream_type in aligned_streams
+    }
+    all_channels = [
+        stream_channel(stream_type, channel)
+        for stream_type in aligned_streams
+        for channel in channels[stream_type]
+    ]
+    samples = np.lib.format.open_memmap(
+        path, mode="w+", dtype=np.float32, shape=(len(all_channels), grid.num_samples)
+    )
+    np.save(time_stamps_path(path), grid.time_stamps())
+    channels_path(path).write_text(json.dumps(all_channels))
+
+    row = 0
+    for stream_type in aligned_streams:
+        time_stamps = stream_time_stamps[stream_type]
+        logger.info(f"\tMapping {stream_type} onto {rate} Hz ({methods[stream_type]})...")
+        num_samples = len(time_stamps) * len(channels[stream_type])
+        with profiling.span("resample", samples=num_samples):
+            for channel in channels[stream_type]:
+                values = R.read_stream(stream_type, columns=[channel])[channel].to_numpy()
+                samples[row] = resample_to_grid(
+                    values,
+                    time_stamps,
+                    grid,
+                    methods[stream_type],
+                    source_rate=clocks[stream_type].nominal_rate,
+                )
+                row += 1
+    samples.flush()
+    del samples
+
+    alignment = {
+        "rate": rate,
+        "clocks": {stream_type: clock._asdict() for stream_type, clock in clocks.items()},
+        "methods": methods,
+    }
+    alignment_path(path).write_text(json.dumps(alignment, indent=1))
+    return AlignedStore.open(path)
+
+
+def format_clock(clock: ClockModel) -> str:
+    text = f"{clock.effective_rate:.3f} Hz"
+    if clock.drift_ppm is not None:
+        text += f" ({clock.drift_ppm:+.1f} ppm)"
+    text += f", offset {clock.offset_s:.4f} s, jitter {clock.jitter_s * 1e3:.3f} ms"
+    if clock.segments > 1:
+        text += f", {clock.segments} segments"
+    return text
+
+
+@click.command()
+@click.argument("folders", nargs=-1, type=click.Path(exists=True, file_okay=False))
+@click.option(
+    "--rate",
+    default=DEFAULT_RATE,
+    show_default=True,
+    type=click.FloatRange(min=0, min_open=True),
+    help="Sampling rate of the common grid in Hz",
+)
+@click.option(
+    "--method",
+    default=Method.auto,
+    show_default=True,
+    type=click.Choice([Method.auto, Method.linear, Method.poly]),
+    help="Linear interpolation, or polyphase resampling followed by interpolation",
+)
+@profiling.verbose_option
+@profiling.quiet_option
+def main(folders, rate, method, verbose, quiet):
+    """Aligns the ECG, EEG and eye tracking streams onto a common time grid
+
+    folders: List of folders containing processed parquet files
+
+    Output: An aligned sample store folder/<vp_code>_aligned.npy with its
+    sidecars and a profile folder/<vp_code>_align_profile.json
+    """
+    profiling.configure_logging(verbose, quiet)
+    folders = sorted(pathlib.Path(fn).resolve() for fn in folders)
+    for folder in folders:
+        R = Recording(folder)
+        logger.info(f"Aligning {folder}")
+        with profiling.Profiler() as profiler:
+            aligned = align_recording(R, rate, method)
+        logger.info(f"\tWrote {len(aligned.store.channels)} channels to {aligned_path(R)}")
+        path = profiling.profile_path(R.directory, R.vp_code, "align")
+        profiler.write(path, vp_code=R.vp_code, command="align")
+
+
+if __name__ == "__main__":
+    main()
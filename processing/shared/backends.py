@@ -0,0 +1,84 @@
+'''
+Registry of heavy backend libraries, imported on first use
+
+Importing mne, neurokit, biosppy, pyxdf or scipy.signal takes from a few
+hundred ms up to seconds each. Modules hold a lazy proxy instead, such that
+`--help`, the conversion and every spawned worker process only pay for the
+backends they actually use:
+
+    mne = backends.lazy("mne")
+
+    def eeg2mne(...):
+        info = mne.create_info(...)  # imports mne on first attribute access
+
+load() imports a backend right away. Both raise an ImportError naming the
+package to install if a backend is missing.
+'''
+import importlib
+import importlib.util
+import sys
+import types
+import typing as T
+
+
+class Backend(T.NamedTuple):
+    package: str
+    '''Distribution that provides the backend'''
+    used_for: str
+
+
+BACKENDS = {
+    "mne": Backend("mne", "filtering EEG, see eeg_freq"),
+    "neurokit": Backend("neurokit", "the neurokit R-peak detector"),
+    "biosppy": Backend("biosppy", "the biosppy R-peak detectors"),
+    "pyxdf": Backend("pyxdf", "loading whole XDF files, see xdf_convert"),
+    "scipy.signal": Backend("scipy", "filters and spectral estimates"),
+}
+
+
+def backend(module_name: str) -> Backend:
+    """Registered backend of a module or of one of its parent packages"""
+    parts = module_name.split(".")
+    for idx in range(len(parts), 0, -1):
+        name = ".".join(parts[:idx])
+        if name in BACKENDS:
+            return BACKENDS[name]
+    raise KeyError(f"{module_name} is not a registered backend")
+
+
+def load(module_name: str) -> types.ModuleType:
+    """Imports a backend module, e.g. "mne" or "biosppy.signals.ecg" """
+    registered = backend(module_name)
+    try:
+        return importlib.import_module(module_name)
+    except ImportError as err:
+        raise ImportError(
+            f"{module_name} is required for {registered.used_for}, "
+            f"install the package {registered.package}"
+        ) from err
+
+
+def is_available(module_name: str) -> bool:
+    """Whether the package of a backend is installed, without importing it"""
+    backend(module_name)
+    return importlib.util.find_spec(module_name.split(".")[0]) is not None
+
+
+def loaded() -> T.List[str]:
+    """Registered backends that have been imported by this process"""
+    return [name for name in BACKENDS if name in sys.modules]
+
+
+class LazyModule(types.ModuleType):
+    """Proxy that imports its backend on the first attribute access"""
+
+    def __getattr__(self, attr: str):
+        return getattr(load(self.__name__), attr)
+
+    def __dir__(self):
+        return dir(load(self.__name__))
+
+
+def lazy(module_name: str) -> LazyModule:
+    backend(module_name)
+    return LazyModule(module_name)
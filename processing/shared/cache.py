@@ -0,0 +1,161 @@
+"""
+Content-addressed cache of expensive pipeline stages
+
+Results of stages like R-peak detection or Welch band power are stored as
+.npz files in a `.cache` folder next to the recording:
+
+    ABC12/.cache/inputs.json                   content hashes of the input files
+    ABC12/.cache/rpeaks_<key>.npz
+    ABC12/.cache/band_power_<key>.npz
+
+The key is the sha256 of the stage name, the content hashes of the stage's
+input files and its parameters, i.e. a changed input or parameter never hits
+a stale entry. Content hashes are only recomputed if the size or mtime of an
+input changed. Loading an entry refreshes its mtime; if the cache exceeds its
+size bound, entries are evicted in least recently used order.
+"""
+import dataclasses
+import hashlib
+import json
+import os
+import pathlib
+import typing as T
+
+import numpy as np
+
+from processing.shared.manifest import FileEntry
+
+CACHE_DIR_NAME = ".cache"
+INPUTS_NAME = "inputs.json"
+ENTRY_SUFFIX = ".npz"
+
+# Size bound of the cache of a single recording
+DEFAULT_MAX_BYTES = 2 << 30
+
+Arrays = T.Dict[str, np.ndarray]
+
+
+@dataclasses.dataclass
+class StageCache:
+    directory: pathlib.Path
+    inputs: T.Sequence[pathlib.Path] = ()
+    '''Files the cached stages are computed from'''
+    max_bytes: int = DEFAULT_MAX_BYTES
+    _input_hash: T.Optional[str] = dataclasses.field(default=None, repr=False, compare=False)
+
+    @classmethod
+    def for_recording(
+        cls, recording_dir: pathlib.Path, inputs: T.Sequence[pathlib.Path] = (), **kwargs
+    ) -> "StageCache":
+        return cls(pathlib.Path(recording_dir) / CACHE_DIR_NAME, list(inputs), **kwargs)
+
+    def with_inputs(self, inputs: T.Sequence[pathlib.Path]) -> "StageCache":
+        """Cache in the same folder for stages with different input files"""
+        return dataclasses.replace(self, inputs=list(inputs), _input_hash=None)
+
+    def key(self, stage: str, params: dict) -> str:
+        content = {"stage": stage, "inputs": self.input_hash(), "params": params}
+        encoded = json.dumps(content, sort_keys=True, default=_json_default)
+        return hashlib.sha256(encoded.encode()).hexdigest()
+
+    def entry_path(self, stage: str, params: dict) -> pathlib.Path:
+        return self.directory / f"{stage}_{self.key(stage, params)}{ENTRY_SUFFIX}"
+
+    def load(self, stage: str, params: dict) -> T.Optional[Arrays]:
+        path = self.entry_path(stage, params)
+        try:
+            with np.load(path) as entry:
+                arrays = {name: entry[name] for name in entry.files}
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+        # Mark the entry as recently used. Another process may have evicted it
+        # since it was read, the touch is best-effort.
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return arrays
+
+    def save(self, stage: str, params: dict, arrays: Arrays):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.entry_path(stage, params)
+        # np.savez would append .npz to a temporary name without that suffix
+        tmp_path = path.with_name(f".{path.stem}.{os.getpid()}.tmp{ENTRY_SUFFIX}")
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def cached(self, stage: str, params: dict, compute: T.Callable[[], Arrays]) -> Arrays:
+        """Loads the result of a stage, computing and storing it on a miss"""
+        arrays = self.load(stage, params)
+        if arrays is None:
+            arrays = compute()
+            self.save(stage, params, arrays)
+        return arrays
+
+    def entries(self) -> T.List[pathlib.Path]:
+        if not self.directory.exists():
+            return []
+        return [
+            path
+            for path in self.directory.glob(f"*{ENTRY_SUFFIX}")
+            if not path.name.startswith(".")
+        ]
+
+    def evict(self):
+        """Removes least recently used entries until the cache fits max_bytes"""
+        stats = []
+        for path in self.entries():
+            try:
+                stats.append((path, path.stat()))
+            except FileNotFoundError:
+                continue
+        total = sum(stat.st_size for _, stat in stats)
+        for path, stat in sorted(stats, key=lambda item: item[1].st_mtime):
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= stat.st_size
+
+    def clear(self):
+        for path in self.entries():
+            path.unlink(missing_ok=True)
+        (self.directory / INPUTS_NAME).unlink(missing_ok=True)
+
+    def input_hash(self) -> str:
+        """Combined content hash of the input files"""
+        if self._input_hash is None:
+            entries = self._input_entries()
+            content = [(path.name, entries[path.name].sha256) for path in self.inputs]
+            self._input_hash = hashlib.sha256(json.dumps(content).encode()).hexdigest()
+        return self._input_hash
+
+    def _input_entries(self) -> T.Dict[str, FileEntry]:
+        index_path = self.directory / INPUTS_NAME
+        try:
+            index = {
+                name: FileEntry(**entry)
+                for name, entry in json.loads(index_path.read_text()).items()
+            }
+        except (FileNotFoundError, ValueError):
+            index = {}
+        updated = dict(index)
+        for path in self.inputs:
+            updated[path.name] = FileEntry.from_path(path, index.get(path.name))
+        if updated != index:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            tmp_path = index_path.with_name(f".{INPUTS_NAME}.{os.getpid()}.tmp")
+            content = {name: dataclasses.asdict(entry) for name, entry in updated.items()}
+            tmp_path.write_text(json.dumps(content, indent=1, sort_keys=True))
+            os.replace(tmp_path, index_path)
+        return updated
+
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, pathlib.Path):
+        return value.as_posix()
+    raise TypeError(f"Cache parameter of type {type(value).__name__} is not serializable")
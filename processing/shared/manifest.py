@@ -0,0 +1,202 @@
+"""
+Study manifest
+
+A single json file at the study root that lists all recordings, their XDF
+files and exported stream files with size, mtime and content hash:
+
+    {
+        "version": 1,
+        "recordings": {
+            "ABC12": {
+                "options": {...},
+                "xdf": ["sub-ABC12_run-001_eeg.xdf"],
+                "files": {"ABC12_gtec.parquet": {"size": ..., "mtime": ..., "sha256": ...}},
+                "streams": {"_gtec.parquet": "ABC12_gtec.parquet", ...}
+            }
+        }
+    }
+
+Recordings resolve their stream files from the "streams" index instead of
+globbing the (possibly network mounted) recording folder. xdf_convert uses the
+XDF entries to skip recordings whose outputs are up to date.
+
+Both are opt-in: xdf_convert only reads and updates a manifest given with
+--manifest, and only Recordings created with a manifest, see
+Recording.from_manifest(), use its index. Without one, stream files are
+found by globbing the recording folder.
+"""
+import dataclasses
+import hashlib
+import json
+import os
+import pathlib
+import typing as T
+
+from processing.shared.streams import FILE_SUFFIXES, OutputFormat
+from processing.shared.sample_store import STORE_SUFFIX, channels_path, time_stamps_path
+
+MANIFEST_NAME = "manifest.json"
+MANIFEST_VERSION = 1
+
+# Read files in blocks of this size when hashing
+HASH_BLOCK_SIZE = 1 << 20
+
+# All file endings of exported streams, see stream_key()
+STREAM_EXTENSIONS = [fmt.value for fmt in OutputFormat] + [STORE_SUFFIX]
+
+
+def stream_key(stream_type: str, ext: str) -> str:
+    """Index key of a stream file, e.g. `_gtec.parquet`"""
+    return f"{FILE_SUFFIXES[stream_type]}{ext}"
+
+
+@dataclasses.dataclass
+class FileEntry:
+    size: int
+    mtime: float
+    sha256: str
+
+    @classmethod
+    def from_path(
+        cls, path: pathlib.Path, previous: T.Optional["FileEntry"] = None
+    ) -> "FileEntry":
+        """Creates an entry for a file or parquet dataset directory
+
+        The content hash of `previous` is reused if size and mtime did not change.
+        """
+        files = sorted(path.rglob("*")) if path.is_dir() else [path]
+        stats = [file.stat() for file in files if file.is_file()]
+        size = sum(stat.st_size for stat in stats)
+        mtime = max((stat.st_mtime for stat in stats), default=path.stat().st_mtime)
+        if previous is not None and (previous.size, previous.mtime) == (size, mtime):
+            return previous
+        return cls(size, mtime, _hash_files(f for f in files if f.is_file()))
+
+    def matches(self, path: pathlib.Path) -> bool:
+        """Checks whether the file at path still has the recorded content"""
+        if not path.exists():
+            return False
+        return FileEntry.from_path(path, previous=self).sha256 == self.sha256
+
+
+class Manifest:
+    def __init__(self, root: T.Union[pathlib.Path, str], recordings=None):
+        self.root = pathlib.Path(root).resolve()
+        self.recordings: T.Dict[str, dict] = recordings or {}
+
+    @property
+    def path(self) -> pathlib.Path:
+        return self.root / MANIFEST_NAME
+
+    @classmethod
+    def load(cls, root: T.Union[pathlib.Path, str]) -> "Manifest":
+        """Loads the manifest of the study at root; empty if there is none yet"""
+        manifest = cls(root)
+        if manifest.path.exists():
+            content = json.loads(manifest.path.read_text())
+            if content.get("version") == MANIFEST_VERSION:
+                manifest.recordings = content["recordings"]
+        return manifest
+
+    def save(self):
+        # Write to a temporary file first, such that readers never see a
+        # partially written manifest.
+        content = {"version": MANIFEST_VERSION, "recordings": self.recordings}
+        tmp_path = self.path.with_name(f".{MANIFEST_NAME}.{os.getpid()}.tmp")
+        tmp_path.write_text(json.dumps(content, indent=1, sort_keys=True))
+        os.replace(tmp_path, self.path)
+
+    def key(self, directory: pathlib.Path) -> str:
+        return pathlib.Path(directory).resolve().relative_to(self.root).as_posix()
+
+    def contains(self, directory: pathlib.Path) -> bool:
+        """Whether a folder lies within the study root, i.e. has a key"""
+        directory = pathlib.Path(directory).resolve()
+        return directory == self.root or self.root in directory.parents
+
+    def directories(self) -> T.Iterator[pathlib.Path]:
+        for key in sorted(self.recordings):
+            yield self.root / key
+
+    def stream_path(
+        self, directory: pathlib.Path, stream_type: str, ext: str
+    ) -> T.Optional[pathlib.Path]:
+        entry = self.recordings.get(self.key(directory))
+        if entry is None:
+            return None
+        name = entry["streams"].get(stream_key(stream_type, ext))
+        if name is None:
+            return None
+        return pathlib.Path(directory) / name
+
+    def update_recording(
+        self,
+        directory: pathlib.Path,
+        xdf_paths: T.Iterable[pathlib.Path] = (),
+        options: T.Optional[dict] = None,
+    ):
+        """(Re-)indexes the stream files of a recording folder
+
+        xdf_paths: XDF files the outputs were converted from
+        options: Conversion options the outputs were created with
+        """
+        directory = pathlib.Path(directory).resolve()
+        key = self.key(directory)
+        previous = self.recordings.get(key, {})
+        previous_files = {
+            name: FileEntry(**entry) for name, entry in previous.get("files", {}).items()
+        }
+
+        streams = {}
+        files = {}
+        for path in sorted(directory.iterdir()):
+            for stream_type in FILE_SUFFIXES:
+                for ext in STREAM_EXTENSIONS:
+                    if path.name.endswith(stream_key(stream_type, ext)):
+                        streams.setdefault(stream_key(stream_type, ext), path.name)
+                        files[path.name] = path
+                        if ext == STORE_SUFFIX:
+                            for sidecar in (time_stamps_path(path), channels_path(path)):
+                                files[sidecar.name] = sidecar
+        xdf_names = sorted(path.name for path in xdf_paths)
+        for name in xdf_names:
+            files[name] = directory / name
+
+        self.recordings[key] = {
+            "options": options if options is not None else previous.get("options"),
+            "xdf": xdf_names or previous.get("xdf", []),
+            "streams": streams,
+            "files": {
+                name: dataclasses.asdict(FileEntry.from_path(path, previous_files.get(name)))
+                for name, path in files.items()
+            },
+        }
+
+    def is_up_to_date(
+        self, xdf_paths: T.Sequence[pathlib.Path], options: T.Optional[dict] = None
+    ) -> bool:
+        """Checks whether the outputs of the XDF files of one folder are up to date
+
+        That is the case if the same XDF files were converted before with the
+        same options, their content did not change, and all recorded outputs
+        still exist unchanged.
+        """
+        directory = xdf_paths[0].parent
+        entry = self.recordings.get(self.key(directory))
+        if entry is None or entry["options"] != options:
+            return False
+        if entry["xdf"] != sorted(path.name for path in xdf_paths):
+            return False
+        for name, file_entry in entry["files"].items():
+            if not FileEntry(**file_entry).matches(directory / name):
+                return False
+        return True
+
+
+def _hash_files(paths: T.Iterable[pathlib.Path]) -> str:
+    content_hash = hashlib.sha256()
+    for path in paths:
+        with path.open("rb") as f:
+            for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+                content_hash.update(block)
+    return content_hash.hexdigest()
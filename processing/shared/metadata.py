@@ -0,0 +1,118 @@
+"""
+Registry of per-subject metadata from the lookup tables in processing/data
+
+    condition_lookup_example.csv       VP-Code,Block0,Block1,Block2
+    bads_lookup_example.csv            VP-Code,Bad             (one row per bad channel)
+    sampling_rate_lookup_example.csv   VP-Code,Stream,Sampling Rate   (optional)
+
+Each table is parsed once into a dict keyed by vp_code and only parsed again
+if the size or mtime of its file changed, i.e. lookups of thousands of
+subjects cost a stat call each instead of a CSV parse.
+"""
+import dataclasses
+import enum
+import functools
+import pathlib
+import typing as T
+
+import pandas as pd
+
+DATA_DIR = pathlib.Path(__file__).parents[1] / "data"
+CONDITION_LOOKUP_NAME = "condition_lookup_example.csv"
+BADS_LOOKUP_NAME = "bads_lookup_example.csv"
+SAMPLING_RATE_LOOKUP_NAME = "sampling_rate_lookup_example.csv"
+
+
+# definition of conditions
+class Condition(enum.Enum):
+    H = "hard"
+    C = "control"
+    E = "easy"
+
+
+# order in which condition blocks were presented
+class ConditionOrder(T.NamedTuple):
+    block0: Condition
+    block1: Condition
+    block2: Condition
+
+
+@dataclasses.dataclass
+class _LookupTable:
+    path: pathlib.Path
+    parse: T.Callable[[pd.DataFrame], dict]
+    required: bool = True
+    _signature: T.Optional[T.Tuple[int, int]] = None
+    _entries: dict = dataclasses.field(default_factory=dict)
+
+    def entries(self) -> dict:
+        """Entries by vp_code, parsed again if the file changed"""
+        try:
+            stat = self.path.stat()
+        except FileNotFoundError:
+            if self.required:
+                raise
+            self._signature, self._entries = None, {}
+            return self._entries
+        signature = (stat.st_size, stat.st_mtime_ns)
+        if signature != self._signature:
+            # Read vp_codes as strings, such that leading zeros are kept
+            table = pd.read_csv(self.path, dtype=str, skipinitialspace=True)
+            self._entries = self.parse(table.dropna(how="all"))
+            self._signature = signature
+        return self._entries
+
+
+class SubjectRegistry:
+    """Condition order, bad channels and sampling rate overrides by vp_code"""
+
+    def __init__(self, data_dir: pathlib.Path = DATA_DIR):
+        data_dir = pathlib.Path(data_dir)
+        self._conditions = _LookupTable(data_dir / CONDITION_LOOKUP_NAME, _parse_conditions)
+        self._bads = _LookupTable(data_dir / BADS_LOOKUP_NAME, _parse_bads)
+        self._sampling_rates = _LookupTable(
+            data_dir / SAMPLING_RATE_LOOKUP_NAME, _parse_sampling_rates, required=False
+        )
+
+    def condition_order(self, vp_code: str) -> ConditionOrder:
+        """Order of the condition blocks, raises KeyError for unknown subjects"""
+        return self._conditions.entries()[vp_code]
+
+    def bads(self, vp_code: str) -> T.List[str]:
+        """Bad EEG channels, empty for subjects without bad channels"""
+        return list(self._bads.entries().get(vp_code, ()))
+
+    def sampling_rate(self, vp_code: str, stream_type: str) -> T.Optional[float]:
+        """Sampling rate override of a stream, see streams.STREAM_TYPES"""
+        return self._sampling_rates.entries().get((vp_code, stream_type))
+
+
+@functools.lru_cache(maxsize=None)
+def default_registry() -> SubjectRegistry:
+    """Registry of the lookup tables in processing/data, shared per process"""
+    return SubjectRegistry()
+
+
+def _parse_conditions(table: pd.DataFrame) -> T.Dict[str, ConditionOrder]:
+    blocks = table[["Block0", "Block1", "Block2"]]
+    return {
+        vp_code: ConditionOrder(*(Condition(cond.strip()) for cond in conditions))
+        for vp_code, conditions in zip(table["VP-Code"], blocks.itertuples(index=False))
+    }
+
+
+def _parse_bads(table: pd.DataFrame) -> T.Dict[str, T.Tuple[str, ...]]:
+    table = table.dropna(subset=["Bad"])
+    return {
+        vp_code: tuple(channels)
+        for vp_code, channels in table.groupby("VP-Code", sort=False)["Bad"]
+    }
+
+
+def _parse_sampling_rates(table: pd.DataFrame) -> T.Dict[T.Tuple[str, str], float]:
+    return {
+        (vp_code, stream): float(rate)
+        for vp_code, stream, rate in zip(
+            table["VP-Code"], table["Stream"], table["Sampling Rate"]
+        )
+    }
@@ -0,0 +1,285 @@
+'''
+Nested timing spans with memory and sample counts, and logging setup
+
+Processing code is instrumented with spans, which cost next to nothing
+unless a Profiler is active:
+
+    with profiling.span("detect_rpeaks", samples=len(data)):
+        ...
+
+    with Profiler() as profiler:
+        process_folder(path)
+    profiler.write(profile_path(path, vp_code, "eeg"))
+
+A span records its wall time, the number of samples it processed, the peak
+resident memory of the process at its end (ru_maxrss) and by how much the
+span raised it, and, if the profiler tracks allocations, the peak of the
+Python allocations traced by tracemalloc during the span. Spans nest per
+thread, a span's path joins the names of all enclosing spans with "/".
+
+Profiles are written as JSON per subject. aggregate() sums the spans of
+many profiles to find the hot stages of a batch:
+
+    python -m processing.shared.profiling study/*/*_profile.json
+'''
+import contextlib
+import json
+import logging
+import pathlib
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+import typing as T
+
+import click
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+PROFILE_SUFFIX = "_profile.json"
+
+# ru_maxrss is in bytes on macOS and in KiB elsewhere
+RSS_UNIT = 1 if sys.platform == "darwin" else 1024
+MB = 2**20
+
+
+def peak_rss_mb() -> float:
+    """Peak resident memory of this process so far"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * RSS_UNIT / MB
+
+
+class SpanRecord(T.NamedTuple):
+    path: str
+    start_s: float
+    '''Start relative to the first activation of the profiler'''
+    seconds: float
+    samples: T.Optional[int]
+    peak_rss_mb: float
+    rss_increase_mb: float
+    '''Increase of the process' peak resident memory during the span'''
+    alloc_peak_mb: T.Optional[float]
+    '''Peak of traced allocations above those at the start of the span'''
+
+
+class Span:
+    """An open span, samples may be set while it runs"""
+
+    def __init__(self, name: str, samples: T.Optional[int] = None):
+        self.name = name
+        self.samples = samples
+        self.path = name
+        self.alloc_start = 0
+        self.alloc_peak = 0
+
+
+class Profiler:
+    """Collects the spans of the code run while it is active
+
+    A profiler can be activated repeatedly, e.g. around the submission and
+    the collection of a subject's results, and collects the spans of all
+    activations. Only one profiler is active at a time.
+    """
+
+    def __init__(self, track_allocations: bool = False):
+        self.track_allocations = track_allocations
+        self.records: T.List[SpanRecord] = []
+        self._origin: T.Optional[float] = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._open: T.List[Span] = []
+        self._previous: T.List[T.Optional["Profiler"]] = []
+        self._started_tracing = False
+
+    def __enter__(self) -> "Profiler":
+        global _active
+        if self._origin is None:
+            self._origin = time.perf_counter()
+        if self.track_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        self._previous.append(_active)
+        _active = self
+        return self
+
+    def __exit__(self, *exc_info):
+        global _active
+        _active = self._previous.pop()
+        if self._started_tracing and not self._previous:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    @contextlib.contextmanager
+    def span(self, name: str, samples: T.Optional[int] = None) -> T.Iterator[Span]:
+        stack = self._stack()
+        current = Span(name, samples)
+        if stack:
+            current.path = f"{stack[-1].path}/{name}"
+        tracing = self.track_allocations and tracemalloc.is_tracing()
+        if tracing:
+            with self._lock:
+                self._fold_alloc_peak()
+                current.alloc_start = current.alloc_peak = tracemalloc.get_traced_memory()[0]
+                self._open.append(current)
+        stack.append(current)
+        rss_start = peak_rss_mb()
+        start = time.perf_counter()
+        try:
+            yield current
+        finally:
+            seconds = time.perf_counter() - start
+            stack.pop()
+            alloc_peak_mb = None
+            if tracing:
+                with self._lock:
+                    self._fold_alloc_peak()
+                    self._open.remove(current)
+                alloc_peak_mb = (current.alloc_peak - current.alloc_start) / MB
+            rss_end = peak_rss_mb()
+            record = SpanRecord(
+                current.path,
+                start - self._origin,
+                seconds,
+                current.samples,
+                rss_end,
+                rss_end - rss_start,
+                alloc_peak_mb,
+            )
+            self.records.append(record)
+            logger.debug(format_record(record))
+
+    def to_dict(self, **metadata) -> dict:
+        return {**metadata, "spans": [record._asdict() for record in self.records]}
+
+    def write(self, path: pathlib.Path, **metadata) -> pathlib.Path:
+        path = pathlib.Path(path)
+        path.write_text(json.dumps(self.to_dict(**metadata), indent=1))
+        return path
+
+    def _stack(self) -> T.List[Span]:
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def _fold_alloc_peak(self):
+        """Raises the allocation peak of all open spans to the traced peak"""
+        _, peak = tracemalloc.get_traced_memory()
+        for open_span in self._open:
+            open_span.alloc_peak = max(open_span.alloc_peak, peak)
+        tracemalloc.reset_peak()
+
+
+_active: T.Optional[Profiler] = None
+
+
+@contextlib.contextmanager
+def span(name: str, samples: T.Optional[int] = None) -> T.Iterator[Span]:
+    """A span of the active profiler, see Profiler.span()"""
+    if _active is None:
+        yield Span(name, samples)
+        return
+    with _active.span(name, samples) as current:
+        yield current
+
+
+def profile_path(directory: pathlib.Path, vp_code: str, command: str) -> pathlib.Path:
+    """Profile of a command run on a subject, next to the subject's exports"""
+    return pathlib.Path(directory) / f"{vp_code}_{command}{PROFILE_SUFFIX}"
+
+
+def read_profile(path: pathlib.Path) -> dict:
+    return json.loads(pathlib.Path(path).read_text())
+
+
+def aggregate(profiles: T.Iterable[dict]) -> pd.DataFrame:
+    """Span statistics across profiles, the hot spans first
+
+    Returns a frame indexed by span path with the number of calls and of
+    subjects, the total, mean and max seconds, the processed samples and
+    their rate, and the max peak RSS and allocation peak.
+    """
+    spans = pd.DataFrame(
+        [
+            {**span_, "subject": idx}
+            for idx, profile in enumerate(profiles)
+            for span_ in profile["spans"]
+        ],
+        columns=[*SpanRecord._fields, "subject"],
+    )
+    spans["samples"] = pd.to_numeric(spans["samples"])
+    spans["alloc_peak_mb"] = pd.to_numeric(spans["alloc_peak_mb"])
+    stats = spans.groupby("path").agg(
+        calls=("seconds", "size"),
+        subjects=("subject", "nunique"),
+        total_s=("seconds", "sum"),
+        mean_s=("seconds", "mean"),
+        max_s=("seconds", "max"),
+        samples=("samples", lambda samples: samples.sum(min_count=1)),
+        peak_rss_mb=("peak_rss_mb", "max"),
+        alloc_peak_mb=("alloc_peak_mb", "max"),
+    )
+    stats["samples_per_s"] = stats["samples"] / stats["total_s"]
+    return stats.sort_values("total_s", ascending=False)
+
+
+def format_record(record: SpanRecord) -> str:
+    text = f"{record.path}: {record.seconds:.3f} s"
+    if record.samples:
+        text += f", {record.samples / record.seconds:.0f} samples/s"
+    text += f", peak RSS {record.peak_rss_mb:.0f} MB (+{record.rss_increase_mb:.0f})"
+    if record.alloc_peak_mb is not None:
+        text += f", allocation peak {record.alloc_peak_mb:.1f} MB"
+    return text
+
+
+def format_hot_spans(stats: pd.DataFrame, top: int = 20) -> str:
+    columns = [
+        "calls",
+        "subjects",
+        "total_s",
+        "mean_s",
+        "max_s",
+        "samples_per_s",
+        "peak_rss_mb",
+        "alloc_peak_mb",
+    ]
+    return stats[columns].head(top).to_string(float_format=lambda value: f"{value:.2f}")
+
+
+def configure_logging(verbose: int = 0, quiet: bool = False):
+    """Logs progress at INFO, span timings at DEBUG (-v) and timestamps with -vv"""
+    level = logging.DEBUG if verbose else logging.INFO
+    if quiet:
+        level = logging.WARNING
+    fmt = "%(message)s"
+    if verbose > 1:
+        fmt = "%(asctime)s %(processName)s %(name)s: %(message)s"
+    logging.basicConfig(level=level, format=fmt, force=True)
+
+
+# Options of all command line interfaces, passed to configure_logging()
+verbose_option = click.option(
+    "-v",
+    "--verbose",
+    count=True,
+    help="Also log the time and memory of each span, repeat to add timestamps",
+)
+quiet_option = click.option("-q", "--quiet", is_flag=True, help="Only log warnings")
+
+
+@click.command()
+@click.option("--top", default=20, show_default=True, help="Number of spans shown")
+@click.argument("paths", nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+def main(top, paths):
+    """Aggregates the spans of profiles
+
+    paths: Profiles written by batch, ecg_process or eeg_freq
+
+    Output: The hottest spans by total time
+    """
+    print(format_hot_spans(aggregate(read_profile(path) for path in paths), top))
+
+
+if __name__ == "__main__":
+    main()
@@ -9,9 +9,21 @@ import pathlib
 import typing as T
 import itertools
 
+import numpy as np
 import pandas as pd
 
-from processing.shared.xdf_convert import STREAM_TYPES, FILE_SUFFIXES, OutputFormat
+from processing.shared.manifest import Manifest
+from processing.shared.metadata import ConditionOrder, SubjectRegistry, default_registry
+from processing.shared.sample_store import (
+    DEFAULT_BATCH_ROWS,
+    SampleStore,
+    STORE_SUFFIX,
+    iter_parquet,
+    parquet_channels,
+    read_parquet_time_stamps,
+    time_stamps_path,
+)
+from processing.shared.streams import STREAM_TYPES, FILE_SUFFIXES, OutputFormat
 
 logger = logging.getLogger(__name__)
 
@@ -26,6 +38,14 @@ class Recording:
     Extracts data out of lsl streams and save it to parquet/csv.
     Combines raw physio data with marker data.
     '''
+    manifest: T.Optional[Manifest] = dataclasses.field(
+        default=None, repr=False, compare=False
+    )
+    '''Study manifest to resolve stream files from instead of globbing'''
+    registry: T.Optional[SubjectRegistry] = dataclasses.field(
+        default=None, repr=False, compare=False
+    )
+    '''Subject metadata, defaults to the lookup tables in processing/data'''
 
     @classmethod
     def find_by_pattern(
@@ -44,20 +64,43 @@ class Recording:
         for match in root.rglob(pattern):
             if match.is_file():
                 yield cls.from_incl_file(match)
+            elif match.is_dir() and match.suffix == OutputFormat.PARQUET.value:
+                # Split recordings are exported as parquet dataset directories
+                yield cls(match.resolve().parent)
             elif match.is_dir():
                 yield cls(match)
             else:
                 raise RuntimeError(f"Unknown path type: {match}")
 
+    @classmethod
+    def from_manifest(
+        cls, root: T.Union[pathlib.Path, str, Manifest]
+    ) -> T.Iterable["Recording"]:
+        """Yields all recordings listed in the manifest of the study at root"""
+        manifest = root if isinstance(root, Manifest) else Manifest.load(root)
+        for directory in manifest.directories():
+            yield cls(directory, manifest=manifest)
+
     @classmethod
     def from_incl_file(cls, file: pathlib.Path) -> "Recording":
         assert file.is_file()
         return cls(file.resolve().parent)
 
-    def marker_path(self, ext: OutputFormat = OutputFormat.PARQUET) -> pathlib.Path:
-        pat = f"*{FILE_SUFFIXES[STREAM_TYPES.marker]}{ext.value}"
+    def _stream_path(self, stream_type: str, ext: str) -> T.Optional[pathlib.Path]:
+        """Export of a stream with the given file ending, None if there is none
+
+        The manifest lookup is opt-in: only recordings created with a manifest,
+        e.g. by from_manifest(), resolve streams from its index. All others,
+        like the Recording(folder) of the processing CLIs, glob the folder.
+        """
+        if self.manifest is not None:
+            return self.manifest.stream_path(self.directory, stream_type, ext)
+        pat = f"*{FILE_SUFFIXES[stream_type]}{ext}"
         return next(self.directory.glob(pat), None)
 
+    def marker_path(self, ext: OutputFormat = OutputFormat.PARQUET) -> pathlib.Path:
+        return self._stream_path(STREAM_TYPES.marker, ext.value)
+
     def marker_path_missing(self, *args, **kwargs) -> pathlib.Path:
         """Path to marker file that includes missing markers"""
         return self._marker_path_fixed("_missing", *args, **kwargs)
@@ -79,26 +122,132 @@ class Recording:
     def eye_tracking_path(
         self, ext: OutputFormat = OutputFormat.PARQUET
     ) -> pathlib.Path:
-        pat = f"*{FILE_SUFFIXES[STREAM_TYPES.eye_tracking]}{ext.value}"
-        return next(self.directory.glob(pat), None)
+        return self._stream_path(STREAM_TYPES.eye_tracking, ext.value)
 
     def ecg_path(self, ext: OutputFormat = OutputFormat.PARQUET) -> pathlib.Path:
-        pat = f"*{FILE_SUFFIXES[STREAM_TYPES.brainvision_eda]}{ext.value}"
-        return next(self.directory.glob(pat), None)
+        return self._stream_path(STREAM_TYPES.brainvision_eda, ext.value)
 
     def eeg_path(self, ext: OutputFormat = OutputFormat.PARQUET) -> pathlib.Path:
-        pat = f"*{FILE_SUFFIXES[STREAM_TYPES.g_tec]}{ext.value}"
-        return next(self.directory.glob(pat), None)
+        return self._stream_path(STREAM_TYPES.g_tec, ext.value)
+
+    def sample_store_path(self, stream_type: str) -> T.Optional[pathlib.Path]:
+        return self._stream_path(stream_type, STORE_SUFFIX)
+
+    def sample_store(self, stream_type: str) -> T.Optional[SampleStore]:
+        """Memory-mapped sample store of a stream, None if it was not written"""
+        path = self.sample_store_path(stream_type)
+        if path is None:
+            return None
+        return SampleStore.open(path)
+
+    def stream_files(self, stream_type: str) -> T.List[pathlib.Path]:
+        """Files read_stream() reads a stream from, e.g. to hash its content"""
+        store_path = self.sample_store_path(stream_type)
+        if store_path is not None:
+            return [store_path, time_stamps_path(store_path)]
+        path = self._stream_path(stream_type, OutputFormat.PARQUET.value)
+        if path is None:
+            raise FileNotFoundError(f"No {stream_type} export found in {self.directory}")
+        return [path]
+
+    def read_stream(
+        self,
+        stream_type: str,
+        columns: T.Optional[T.List[str]] = None,
+        dtype: T.Optional[T.Union[str, type]] = None,
+    ) -> pd.DataFrame:
+        """Reads a numeric stream, preferring its sample store over the parquet export
+
+        A frame read from the sample store is a view onto the mapped samples.
+        """
+        store = self.sample_store(stream_type)
+        if store is not None:
+            df = store.to_frame(columns)
+            if dtype is not None:
+                df = df.astype(dtype)
+            return df
+        path = self._stream_path(stream_type, OutputFormat.PARQUET.value)
+        if path is None:
+            raise FileNotFoundError(f"No {stream_type} export found in {self.directory}")
+        return self.read_parquet(path, columns=columns, dtype=dtype)
+
+    def iter_stream(
+        self,
+        stream_type: str,
+        columns: T.Sequence[str],
+        chunk_samples: int = DEFAULT_BATCH_ROWS,
+    ) -> T.Iterator[SampleStore]:
+        """Reads columns of a numeric stream in chunks of up to `chunk_samples` samples
+
+        Chunks are views onto the sample store of the stream if there is one,
+        else they are read batch by batch from the parquet export, such that
+        memory depends on the chunk size, not the recording length.
+        """
+        store = self.sample_store(stream_type)
+        if store is not None:
+            # Channels are selected per chunk, selecting scattered channels
+            # of the whole store would copy them at once
+            for start in range(0, len(store), chunk_samples):
+                yield store.slice(start, start + chunk_samples).select_channels(columns)
+            return
+        path = self._stream_path(stream_type, OutputFormat.PARQUET.value)
+        if path is None:
+            raise FileNotFoundError(f"No {stream_type} export found in {self.directory}")
+        yield from iter_parquet(path, columns, chunk_samples)
+
+    def stream_channels(self, stream_type: str) -> T.List[str]:
+        """Numeric channels of a stream, without reading its samples"""
+        store = self.sample_store(stream_type)
+        if store is not None:
+            return store.channels
+        path = self._stream_path(stream_type, OutputFormat.PARQUET.value)
+        if path is None:
+            raise FileNotFoundError(f"No {stream_type} export found in {self.directory}")
+        return parquet_channels(path)
+
+    def read_time_stamps(self, stream_type: str) -> np.ndarray:
+        """Time stamps of a numeric stream, without reading its samples"""
+        store = self.sample_store(stream_type)
+        if store is not None:
+            return store.time_stamps
+        path = self._stream_path(stream_type, OutputFormat.PARQUET.value)
+        if path is None:
+            raise FileNotFoundError(f"No {stream_type} export found in {self.directory}")
+        return read_parquet_time_stamps(path)
 
     @staticmethod
-    def read_csv(path: pathlib.Path) -> pd.DataFrame:
-        return pd.read_csv(path, index_col="time_stamps")
+    def read_csv(
+        path: pathlib.Path,
+        columns: T.Optional[T.List[str]] = None,
+        dtype: T.Optional[T.Union[str, type]] = None,
+    ) -> pd.DataFrame:
+        usecols = None if columns is None else ["time_stamps", *columns]
+        df = pd.read_csv(path, index_col="time_stamps", usecols=usecols)
+        if dtype is not None:
+            df = df.astype(dtype)
+        return df
 
     @staticmethod
-    def read_parquet(path: pathlib.Path, *args, **kwargs) -> pd.DataFrame:
-        df = pd.read_parquet(path, *args, **kwargs)
+    def read_parquet(
+        path: pathlib.Path,
+        *args,
+        columns: T.Optional[T.List[str]] = None,
+        dtype: T.Optional[T.Union[str, type]] = None,
+        **kwargs,
+    ) -> pd.DataFrame:
+        """Reads a parquet export, either a single file or a dataset directory
+        that contains one part file per split recording
+
+        columns: Only read these columns (the time stamps are always read)
+        dtype: Cast the read columns to this dtype, e.g. float32
+        """
+        if columns is not None:
+            columns = [*columns, "time_stamps"]
+        df = pd.read_parquet(path, *args, columns=columns, **kwargs)
         if df.index.name != "time_stamps":
             df.set_index("time_stamps", inplace=True)
+        if dtype is not None:
+            df = df.astype(dtype)
         return df
 
     def read_markers(self, include_fixes=True):
@@ -123,7 +272,7 @@ class Recording:
             invalid_markers = read_method(invalid_marker_path)
             num_inv_markers = invalid_markers.shape[0]
             try:
-                print(f"{__name__}! Dropping {num_inv_markers} invalid marker(s).")
+                logger.warning(f"Dropping {num_inv_markers} invalid marker(s).")
                 df = df.drop(index=invalid_markers.index)
             except KeyError as err:
                 err_msg = (
@@ -136,7 +285,7 @@ class Recording:
         if include_fixes and missing_marker_path.exists():
             missing_markers = read_method(missing_marker_path)
             num_mis_markers = missing_markers.shape[0]
-            print(f"{__name__}! Inserting {num_mis_markers} missing marker(s).")
+            logger.warning(f"Inserting {num_mis_markers} missing marker(s).")
             df = pd.concat([df, missing_markers]).sort_index()
         return df
 
@@ -144,6 +293,22 @@ class Recording:
     def vp_code(self):
         return self.directory.name
 
+    @property
+    def metadata(self) -> SubjectRegistry:
+        return self.registry if self.registry is not None else default_registry()
+
+    def condition_order(self) -> ConditionOrder:
+        """Order of the condition blocks, raises KeyError for unknown subjects"""
+        return self.metadata.condition_order(self.vp_code)
+
+    def bads(self) -> T.List[str]:
+        """Bad EEG channels"""
+        return self.metadata.bads(self.vp_code)
+
+    def sampling_rate(self, stream_type: str) -> T.Optional[float]:
+        """Sampling rate override of a stream from the lookup tables, if any"""
+        return self.metadata.sampling_rate(self.vp_code, stream_type)
+
 
 
 
@@ -0,0 +1,146 @@
+"""
+Study-level results dataset
+
+Instead of one CSV per subject and analysis, results can be written to a
+single parquet dataset of the study, partitioned by modality and subject:
+
+    results/modality=ecg/vp_code=ABC12/part.parquet
+    results/modality=ecg/vp_code=DEF34/part.parquet
+    results/modality=eeg_freq/vp_code=ABC12/part.parquet
+
+Every subject owns its partition, i.e. parallel workers never write the same
+file. A partition file is written to a hidden temporary file first and then
+renamed over the previous results of the subject, so readers never see a
+partially written or duplicated partition. Readers ignore the hidden files.
+
+Label columns like block, period, channel and band are stored as
+categoricals (parquet dictionary columns), which keeps the files small and
+makes group-bys of the combined table cheap.
+
+Without a dataset, the analyses write one CSV per subject to the
+extracted_csv folder of the recording, see write_subject_results().
+"""
+import logging
+import os
+import pathlib
+import typing as T
+import uuid
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+from processing.shared import profiling
+from processing.shared.recording import Recording
+
+PARTITION_FILE_NAME = "part.parquet"
+EXTRACTED_CSV_DIR = "extracted_csv"
+
+# Label columns stored as categoricals, if present
+CATEGORICAL_COLUMNS = ("block", "period", "Channels", "Freq Bands")
+
+logger = logging.getLogger(__name__)
+
+
+def partition_path(root: pathlib.Path, modality: str, vp_code: str) -> pathlib.Path:
+    partition_dir = pathlib.Path(root) / f"modality={modality}" / f"vp_code={vp_code}"
+    return partition_dir / PARTITION_FILE_NAME
+
+
+def write_results(
+    root: pathlib.Path, modality: str, vp_code: str, frame: pd.DataFrame
+) -> pathlib.Path:
+    """Replaces the results of one subject and modality in the dataset at root
+
+    frame: Results of the subject; a vp_code column is dropped, as it is
+        encoded in the partition path
+
+    Returns the path of the written partition file.
+    """
+    path = partition_path(root, modality, vp_code)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    frame = frame.drop(columns=["vp_code"], errors="ignore")
+    frame = frame.astype(
+        {
+            column: pd.CategoricalDtype(pd.unique(frame[column]))
+            for column in CATEGORICAL_COLUMNS
+            if column in frame.columns
+        }
+    )
+    # Unique per writer, such that concurrent writers of a subject cannot
+    # clobber each other's temporary file
+    tmp_path = path.with_name(f".{path.stem}.{os.getpid()}.{uuid.uuid4().hex}.tmp")
+    try:
+        frame.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+    return path
+
+
+def subject_result_path(
+    R: Recording, modality: str, csv_prefix: str, output: T.Optional[pathlib.Path] = None
+) -> pathlib.Path:
+    """Partition of the subject in the dataset at output, or its CSV file
+
+    csv_prefix: File name prefix of the CSV in the extracted_csv folder of
+        the recording, e.g. "ecg_" for extracted_csv/ecg_<vp_code>.csv
+    """
+    if output is not None:
+        return partition_path(output, modality, R.vp_code)
+    return R.directory / EXTRACTED_CSV_DIR / f"{csv_prefix}{R.vp_code}.csv"
+
+
+def write_subject_results(
+    R: Recording,
+    modality: str,
+    frame: pd.DataFrame,
+    csv_prefix: str,
+    output: T.Optional[pathlib.Path] = None,
+) -> pathlib.Path:
+    """Writes the results of a recording to the dataset at output or as CSV
+
+    Returns the written path, see subject_result_path().
+    """
+    if output is not None:
+        logger.info(f"\tWriting results to {output}")
+        with profiling.span("write"):
+            path = write_results(output, modality, R.vp_code, frame)
+        logger.info("\tDone!")
+        return path
+
+    path = subject_result_path(R, modality, csv_prefix)
+    path.parent.mkdir(exist_ok=True)
+    logger.info(f"\tWriting results to {path}")
+    with profiling.span("write"):
+        frame.to_csv(path, index=False)
+    logger.info("\tDone!")
+    return path
+
+
+def load_results(
+    root: pathlib.Path,
+    modality: str,
+    vp_codes: T.Optional[T.Iterable[str]] = None,
+    columns: T.Optional[T.Sequence[str]] = None,
+) -> pd.DataFrame:
+    """Combined results of all (or the given) subjects of one modality
+
+    Only the partitions of the selected subjects and the requested columns
+    are read. vp_code is a categorical column of the result.
+    """
+    modality_dir = pathlib.Path(root) / f"modality={modality}"
+    if not modality_dir.is_dir():
+        raise FileNotFoundError(f"No {modality} results in {root}")
+    # Explicitly typed, as codes like 01234 would be inferred as integers
+    partitioning = ds.partitioning(pa.schema([("vp_code", pa.string())]), flavor="hive")
+    dataset = ds.dataset(modality_dir, format="parquet", partitioning=partitioning)
+    filter_ = None
+    if vp_codes is not None:
+        filter_ = ds.field("vp_code").isin([str(vp_code) for vp_code in vp_codes])
+    if columns is not None and "vp_code" not in columns:
+        columns = ["vp_code", *columns]
+    table = dataset.to_table(columns=columns, filter=filter_)
+    frame = table.unify_dictionaries().to_pandas()
+    frame.insert(0, "vp_code", frame.pop("vp_code").astype("category"))
+    return frame
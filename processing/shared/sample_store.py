@@ -0,0 +1,224 @@
+"""
+Memory-mapped sample store
+
+Numeric streams can additionally be stored as a channel-major .npy block next
+to their parquet export, with the time stamps and channel names as sidecars:
+
+    ABC12_gtec.npy              (channels, samples)
+    ABC12_gtec_time_stamps.npy  (samples,)
+    ABC12_gtec_channels.json    ["F3", "Fz", ...]
+
+The files are opened as memory maps, i.e. slicing returns views onto the
+mapped pages and several processes can share one recording through the OS
+page cache.
+"""
+import dataclasses
+import json
+import pathlib
+import typing as T
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+STORE_SUFFIX = ".npy"
+TIME_STAMPS_SUFFIX = "_time_stamps.npy"
+CHANNELS_SUFFIX = "_channels.json"
+
+# Number of rows that are copied at once when building a store
+DEFAULT_BATCH_ROWS = 1_000_000
+
+
+@dataclasses.dataclass
+class SampleStore:
+    samples: np.ndarray
+    '''(channels, samples) array, usually a read-only memory map'''
+    time_stamps: np.ndarray
+    '''(samples,) array of sorted time stamps'''
+    channels: T.List[str]
+
+    @classmethod
+    def open(cls, path: pathlib.Path, mode: str = "r") -> "SampleStore":
+        path = pathlib.Path(path)
+        samples = np.load(path, mmap_mode=mode)
+        time_stamps = np.load(time_stamps_path(path), mmap_mode=mode)
+        channels = json.loads(channels_path(path).read_text())
+        return cls(samples, time_stamps, channels)
+
+    @classmethod
+    def from_parquet(
+        cls,
+        parquet_path: pathlib.Path,
+        store_path: T.Optional[pathlib.Path] = None,
+        dtype: T.Optional[T.Union[str, np.dtype]] = None,
+        batch_rows: int = DEFAULT_BATCH_ROWS,
+    ) -> "SampleStore":
+        """Writes the numeric columns of a parquet export to a sample store
+
+        parquet_path: Single parquet file or dataset directory of split recordings
+        store_path: Defaults to the parquet path with .npy suffix
+        dtype: Defaults to the common dtype of the numeric columns
+
+        The export is copied in batches of `batch_rows` rows.
+        """
+        parquet_path = pathlib.Path(parquet_path)
+        if store_path is None:
+            store_path = parquet_path.with_suffix(STORE_SUFFIX)
+        files = [pq.ParquetFile(path) for path in _parquet_files(parquet_path)]
+
+        schema = files[0].schema_arrow
+        channels = _numeric_columns(schema)
+        if dtype is None:
+            dtype = np.result_type(*(schema.field(ch).type.to_pandas_dtype() for ch in channels))
+        num_rows = sum(file.metadata.num_rows for file in files)
+
+        samples = np.lib.format.open_memmap(
+            store_path, mode="w+", dtype=dtype, shape=(len(channels), num_rows)
+        )
+        time_stamps = np.lib.format.open_memmap(
+            time_stamps_path(store_path), mode="w+", dtype=np.float64, shape=(num_rows,)
+        )
+        pos = 0
+        for file in files:
+            batches = file.iter_batches(
+                batch_size=batch_rows, columns=[*channels, "time_stamps"]
+            )
+            for batch in batches:
+                stop = pos + batch.num_rows
+                time_stamps[pos:stop] = batch.column("time_stamps").to_numpy()
+                for idx, channel in enumerate(channels):
+                    samples[idx, pos:stop] = batch.column(channel).to_numpy()
+                pos = stop
+        samples.flush()
+        time_stamps.flush()
+        del samples, time_stamps
+        channels_path(store_path).write_text(json.dumps(channels))
+        return cls.open(store_path)
+
+    def __len__(self) -> int:
+        return self.time_stamps.shape[0]
+
+    @property
+    def loc(self) -> "_TimeIndexer":
+        """Label based slicing by time stamps, like DataFrame.loc[start:stop]
+
+        Both ends are included. Returns a SampleStore of views.
+        """
+        return _TimeIndexer(self)
+
+    def offsets(self, start_ts: float, stop_ts: float) -> T.Tuple[int, int]:
+        """Sample offsets [start, stop) of the closed time interval [start_ts, stop_ts]"""
+        start = np.searchsorted(self.time_stamps, start_ts, side="left")
+        stop = np.searchsorted(self.time_stamps, stop_ts, side="right")
+        return int(start), int(stop)
+
+    def slice(self, start: int, stop: int) -> "SampleStore":
+        """Zero-copy view of the samples [start, stop)"""
+        return SampleStore(
+            self.samples[:, start:stop], self.time_stamps[start:stop], self.channels
+        )
+
+    def channel(self, name: str) -> np.ndarray:
+        """Zero-copy view of a single channel"""
+        return self.samples[self.channels.index(name)]
+
+    def select_channels(self, names: T.Sequence[str]) -> "SampleStore":
+        """Subset of channels; a view if the channels are consecutive"""
+        indices = [self.channels.index(name) for name in names]
+        if indices == list(range(indices[0], indices[-1] + 1)):
+            samples = self.samples[indices[0] : indices[-1] + 1]
+        else:
+            samples = self.samples[indices]
+        return SampleStore(samples, self.time_stamps, list(names))
+
+    def to_frame(self, columns: T.Optional[T.Sequence[str]] = None) -> pd.DataFrame:
+        """DataFrame backed by the (mapped) sample memory
+
+        pandas stores the columns of a single-dtype frame as one
+        (columns, rows) block, i.e. exactly the channel-major layout of the
+        store, such that no data is copied.
+        """
+        store = self if columns is None else self.select_channels(columns)
+        index = pd.Index(store.time_stamps, name="time_stamps", copy=False)
+        return pd.DataFrame(store.samples.T, index=index, columns=store.channels, copy=False)
+
+
+def iter_parquet(
+    parquet_path: pathlib.Path,
+    columns: T.Sequence[str],
+    batch_rows: int = DEFAULT_BATCH_ROWS,
+) -> T.Iterator[SampleStore]:
+    """Reads columns of a parquet export in chunks of up to `batch_rows` rows
+
+    parquet_path: Single parquet file or dataset directory of split recordings
+
+    Only the given columns and the time stamps are read. Each chunk is a
+    SampleStore of its (columns, rows) samples in the common dtype of the
+    columns.
+    """
+    columns = list(columns)
+    for path in _parquet_files(pathlib.Path(parquet_path)):
+        batches = pq.ParquetFile(path).iter_batches(
+            batch_size=batch_rows, columns=[*columns, "time_stamps"]
+        )
+        for batch in batches:
+            samples = np.stack([batch.column(column).to_numpy() for column in columns])
+            yield SampleStore(samples, batch.column("time_stamps").to_numpy(), columns)
+
+
+def parquet_channels(parquet_path: pathlib.Path) -> T.List[str]:
+    """Numeric columns of a parquet export, read from its schema only"""
+    path = _parquet_files(pathlib.Path(parquet_path))[0]
+    return _numeric_columns(pq.read_schema(path))
+
+
+def _numeric_columns(schema: pa.Schema) -> T.List[str]:
+    return [
+        field.name
+        for field in schema
+        if field.name != "time_stamps"
+        and not field.name.startswith("__index_level_")
+        and (pa.types.is_floating(field.type) or pa.types.is_integer(field.type))
+    ]
+
+
+def read_parquet_time_stamps(parquet_path: pathlib.Path) -> np.ndarray:
+    """Time stamps of a parquet export, without reading any other column"""
+    parts = [
+        pq.read_table(path, columns=["time_stamps"]).column("time_stamps").to_numpy()
+        for path in _parquet_files(pathlib.Path(parquet_path))
+    ]
+    return np.concatenate(parts)
+
+
+class _TimeIndexer:
+    def __init__(self, store: SampleStore):
+        self.store = store
+
+    def __getitem__(self, key: slice) -> SampleStore:
+        if not isinstance(key, slice) or key.step is not None:
+            raise TypeError("Sample stores only support slicing by time, e.g. loc[start:stop]")
+        start_ts = -np.inf if key.start is None else key.start
+        stop_ts = np.inf if key.stop is None else key.stop
+        return self.store.slice(*self.store.offsets(start_ts, stop_ts))
+
+
+def remove_store(store_path: pathlib.Path):
+    """Removes a sample store including its sidecars, if it exists"""
+    for path in (store_path, time_stamps_path(store_path), channels_path(store_path)):
+        path.unlink(missing_ok=True)
+
+
+def time_stamps_path(store_path: pathlib.Path) -> pathlib.Path:
+    return store_path.with_name(store_path.stem + TIME_STAMPS_SUFFIX)
+
+
+def channels_path(store_path: pathlib.Path) -> pathlib.Path:
+    return store_path.with_name(store_path.stem + CHANNELS_SUFFIX)
+
+
+def _parquet_files(path: pathlib.Path) -> T.List[pathlib.Path]:
+    if path.is_dir():
+        return sorted(path.glob("*.parquet"))
+    return [path]
@@ -5,6 +5,7 @@ Author: Pablo Prietz
 import itertools
 import logging
 import typing as T
+import numpy as np
 import pandas as pd
 
 from processing.shared.markers_example import Periods
@@ -19,7 +20,7 @@ def select_from_data(
     """Yields subsections of data that correspond to period
 
     Input:
-        data: Any extracted xdf stream
+        data: Any extracted xdf stream, or its SampleStore (yields views)
         markers: Extracted marker stream
         period: Period definition
     """
@@ -52,6 +53,82 @@ def select_data_around(
         yield data_slice
 
 
+class Epochs(T.NamedTuple):
+    """Fixed-length epochs around events, see select_epochs_around()"""
+
+    data: np.ndarray
+    '''(events, samples, channels) array, padded with fill_value at the edges'''
+    mask: np.ndarray
+    '''(events, samples) boolean array, False for padded samples'''
+    times: np.ndarray
+    '''(samples,) time relative to the event'''
+    events: pd.DataFrame
+    '''Marker entries of the events'''
+    channels: T.List[str]
+
+
+def select_epochs_around(
+    data,
+    markers: pd.DataFrame,
+    event: Markers,
+    before_s: float = 0.2,
+    after_s: float = 0.5,
+    sampling_rate: T.Optional[float] = None,
+    fill_value: float = np.nan,
+) -> Epochs:
+    """Batched variant of select_data_around()
+
+    Instead of yielding one DataFrame per event, returns all epochs as one
+    contiguous (events, samples, channels) array, built with vectorised index
+    arithmetic. Each epoch starts at the first sample within `before_s` before
+    the event and has the same number of samples, i.e. the stream is assumed
+    to be regularly sampled. Samples outside of the recording are set to
+    fill_value and masked.
+
+    Input:
+        data: Any extracted xdf stream or its SampleStore
+        markers: Extracted marker stream
+        event: Marker to align the epochs to
+        sampling_rate: Defaults to the median sampling interval of data
+    """
+    if isinstance(data, pd.Series):
+        data = data.to_frame()
+    if isinstance(data, pd.DataFrame):
+        time_stamps = data.index.values
+        channels = list(data.columns)
+    else:
+        time_stamps = data.time_stamps
+        channels = list(data.channels)
+    if sampling_rate is None:
+        sampling_rate = 1 / np.median(np.diff(time_stamps))
+
+    events = _marker_entries_event(markers, event)
+    event_ts = events.index.values
+
+    # Like select_data_around(), epochs start at the first sample after
+    # event - before_s. Epochs that start before the recording are anchored
+    # at the event instead.
+    num_before = int(round(before_s * sampling_rate))
+    num_samples = int(round((before_s + after_s) * sampling_rate)) + 1
+    starts = np.searchsorted(time_stamps, event_ts - before_s)
+    before_recording = event_ts - before_s < time_stamps[0]
+    anchors = np.searchsorted(time_stamps, event_ts[before_recording])
+    starts[before_recording] = anchors - num_before
+    indices = starts[:, None] + np.arange(num_samples)
+    mask = (indices >= 0) & (indices < len(time_stamps))
+    indices = indices.clip(0, len(time_stamps) - 1)
+
+    if isinstance(data, pd.DataFrame):
+        epochs = data.to_numpy()[indices]
+    else:
+        epochs = np.moveaxis(data.samples[:, indices], 0, -1)
+    dtype = np.result_type(epochs.dtype, np.asarray(fill_value).dtype)
+    epochs = epochs.astype(dtype, copy=False)
+    epochs[~mask] = fill_value
+    times = np.arange(num_samples) / sampling_rate - before_s
+    return Epochs(epochs, mask, times, events, channels)
+
+
 def intervals_from_period(
     markers: pd.DataFrame, period: Periods
 ) -> T.Iterator[T.Tuple[float, float]]:
@@ -158,18 +235,17 @@ def extract_periods(block, num_task_subblocks=6):
     :return:
     '''
     data, markers = block
-    bline_h = next(select_data(data, markers, Periods.baseline_h))
-    bline_l = next(select_data(data, markers, Periods.baseline_l))
+    bline_h = next(select_from_data(data, markers, Periods.baseline_h))
+    bline_l = next(select_from_data(data, markers, Periods.baseline_l))
 
-    task, _ = next(select_data(data, markers, Periods.task))
+    task, _ = next(select_from_data(data, markers, Periods.task))
     subblocks = split(task, num_periods=num_task_subblocks)
     subblocks = map(lambda groupby: groupby[1], subblocks)
 
     baselines = (bline_h[0], bline_l[0])
     all_periods = itertools.chain(baselines, subblocks)
 
-    period_names = [ "baseline_high", "baseline_low"]
-    period_names += [f"task_subblock_{idx}" for idx in range(num_task_subblocks)]
+    period_names = period_labels(num_task_subblocks)
     period_concat = pd.concat(
         all_periods, keys=period_names, names=["period", data.index.name]
     )
@@ -179,7 +255,7 @@ def extract_periods(block, num_task_subblocks=6):
 def yield_periods(block, num_task_subblocks=6):
     data, markers = block
 
-    task_data, task_markers = next(select_data(data, markers, Periods.task))
+    task_data, task_markers = next(select_from_data(data, markers, Periods.task))
     subblocks = split(task_data, num_periods=num_task_subblocks)
     subblocks = list(map(lambda groupby: groupby[1], subblocks))
     submarkers = split(task_markers, num_periods=num_task_subblocks)
@@ -187,3 +263,111 @@ def yield_periods(block, num_task_subblocks=6):
 
     period_names = [f"task_subblock_{idx}" for idx in range(num_task_subblocks)]
     yield from zip(period_names, subblocks, submarkers)
+
+
+def period_labels(num_task_subblocks=6, baseline_names=("baseline_high", "baseline_low")):
+    """Period names in the order used by extract_periods()"""
+    period_names = list(baseline_names)
+    period_names += [f"task_subblock_{idx}" for idx in range(num_task_subblocks)]
+    return period_names
+
+
+class PeriodSlices(T.NamedTuple):
+    """Sample offsets of periods within a stream
+
+    The samples data[start[i]:stop[i]] belong to the period labels[i].
+    """
+
+    labels: pd.MultiIndex
+    start: np.ndarray
+    stop: np.ndarray
+
+    def items(self) -> T.Iterator[T.Tuple[T.Tuple[str, str], slice]]:
+        for label, start, stop in zip(self.labels, self.start, self.stop):
+            yield label, slice(int(start), int(stop))
+
+    def take(self, data) -> T.Iterator[T.Tuple[T.Tuple[str, str], T.Any]]:
+        """Yields (label, view) for a DataFrame/Series, SampleStore or array
+
+        NumPy arrays are sliced along their last axis, i.e. they are expected
+        to be channel-major like sample stores.
+        """
+        for label, offsets in self.items():
+            if isinstance(data, (pd.DataFrame, pd.Series)):
+                yield label, data.iloc[offsets]
+            elif isinstance(data, np.ndarray):
+                yield label, data[..., offsets]
+            else:
+                yield label, data.slice(offsets.start, offsets.stop)
+
+
+def period_slices(
+    time_stamps: np.ndarray,
+    markers: pd.DataFrame,
+    block_labels: T.Optional[T.Sequence[str]] = None,
+    num_task_subblocks: int = 6,
+    baseline_names: T.Sequence[str] = ("baseline_high", "baseline_low"),
+) -> PeriodSlices:
+    """Resolves all periods of all blocks to sample offsets at once
+
+    Produces the same periods as selecting the blocks with select_from_data()
+    and passing each block to extract_periods(), i.e. the first baseline high,
+    baseline low and task interval of each block, with the task split into
+    `num_task_subblocks` subblocks of equal duration. Instead of slicing the
+    data per interval, all interval edges are resolved with one vectorised
+    searchsorted over the sorted time stamps.
+
+    Input:
+        time_stamps: Sorted time stamps of any extracted xdf stream
+        markers: Extracted marker stream
+        block_labels: Labels of the blocks, e.g. their conditions. Defaults to
+            the block numbers. Surplus blocks are ignored.
+    """
+    time_stamps = np.asarray(time_stamps)
+    block_intervals = list(intervals_from_period(markers, Periods.block))
+    if block_labels is None:
+        block_labels = list(range(len(block_intervals)))
+    block_intervals = block_intervals[: len(block_labels)]
+    block_labels = block_labels[: len(block_intervals)]
+
+    # Marker tables are short, find the relevant intervals per block
+    periods = (Periods.baseline_h, Periods.baseline_l, Periods.task)
+    intervals = []
+    for block_start, block_stop in block_intervals:
+        block_markers = markers.loc[block_start:block_stop]
+        intervals.append((block_start, block_stop))
+        for period in periods:
+            intervals.append(next(intervals_from_period(block_markers, period)))
+    intervals = np.asarray(intervals, dtype=float).reshape(-1, len(periods) + 1, 2)
+
+    # Closed intervals, like data.loc[start:stop]
+    start = np.searchsorted(time_stamps, intervals[..., 0], side="left")
+    stop = np.searchsorted(time_stamps, intervals[..., 1], side="right")
+    # Periods are selected from the block's data
+    start[:, 1:] = np.maximum(start[:, 1:], start[:, :1])
+    stop[:, 1:] = np.minimum(stop[:, 1:], stop[:, :1])
+    baseline_start, baseline_stop = start[:, 1:3], stop[:, 1:3]
+    task_start, task_stop = start[:, 3], stop[:, 3]
+
+    # Task subblocks are left-open intervals of equal duration between the
+    # first and last task sample, see split(). The subblocks of a task
+    # without samples are empty.
+    empty_task = task_stop <= task_start
+    edge_offsets = np.repeat(task_start[:, None], num_task_subblocks + 1, axis=1)
+    if not empty_task.all():
+        task_first = time_stamps[task_start[~empty_task]]
+        task_last = time_stamps[task_stop[~empty_task] - 1]
+        edges = np.linspace(task_first, task_last, num_task_subblocks + 1, axis=1)
+        edge_offsets[~empty_task] = np.clip(
+            np.searchsorted(time_stamps, edges, side="right"),
+            task_start[~empty_task, None],
+            task_stop[~empty_task, None],
+        )
+
+    period_start = np.concatenate([baseline_start, edge_offsets[:, :-1]], axis=1)
+    period_stop = np.concatenate([baseline_stop, edge_offsets[:, 1:]], axis=1)
+    period_names = period_labels(num_task_subblocks, baseline_names)
+    labels = pd.MultiIndex.from_product(
+        [block_labels, period_names], names=["block", "period"]
+    )
+    return PeriodSlices(labels, period_start.reshape(-1), period_stop.reshape(-1))
@@ -0,0 +1,24 @@
+"""
+Names of the recorded lsl streams and of the files they are exported to
+"""
+import enum
+
+
+class STREAM_TYPES:
+    eye_tracking = "pupil_capture"
+    marker = "psychopy_marker"
+    brainvision_eda = "BrainVision RDA"
+    g_tec = "g.USBamp"
+
+
+FILE_SUFFIXES = {
+    STREAM_TYPES.eye_tracking: "_eye_tracking",
+    STREAM_TYPES.marker: "_marker",
+    STREAM_TYPES.brainvision_eda: "_brainvision",
+    STREAM_TYPES.g_tec: "_gtec"
+}
+
+
+class OutputFormat(enum.Enum):
+    CSV = ".csv"
+    PARQUET = ".parquet"
@@ -2,101 +2,540 @@
 Author: Pablo Prietz
 Usage: python xd_convert.py [OPTIONS] [FILENAMES]...
 """
-import enum
+import concurrent.futures
+import functools
+import itertools
+import logging
 import pathlib
+import shutil
 import typing as T
 
 import click
-import pyxdf
+import pyarrow as pa
+import pyarrow.parquet as pq
 import pandas as pd
 
+from processing.shared import backends, profiling
+from processing.shared.manifest import Manifest
 from processing.shared.markers_example import Markers
+from processing.shared.sample_store import SampleStore, STORE_SUFFIX, remove_store
+from processing.shared.streams import STREAM_TYPES, FILE_SUFFIXES, OutputFormat
+from processing.shared.xdf_stream import XDFStreamReader
 
+pyxdf = backends.lazy("pyxdf")
+logger = logging.getLogger(__name__)
 
-class STREAM_TYPES:
-    eye_tracking = "pupil_capture"
-    marker = "psychopy_marker"
-    brainvision_eda = "BrainVision RDA"
-    g_tec = "g.USBamp"
+STREAMS_TO_CONVERT = [
+    STREAM_TYPES.eye_tracking,
+    STREAM_TYPES.marker,
+    STREAM_TYPES.brainvision_eda,
+    STREAM_TYPES.g_tec,
+]
 
+# Streams with numeric samples, which can be written to a sample store
+NUMERIC_STREAMS = [
+    STREAM_TYPES.eye_tracking,
+    STREAM_TYPES.brainvision_eda,
+    STREAM_TYPES.g_tec,
+]
 
-FILE_SUFFIXES = {
-    STREAM_TYPES.eye_tracking: "_eye_tracking",
-    STREAM_TYPES.marker: "_marker",
-    STREAM_TYPES.brainvision_eda: "_brainvision",
-    STREAM_TYPES.g_tec: "_gtec"
-}
+# Number of samples per stream that are buffered before they are written as
+# one parquet row group / csv block in streaming mode
+DEFAULT_CHUNK_SAMPLES = 100_000
 
+# File name of the part files of split parquet exports, see parquet_part_path()
+PARQUET_PART_NAME = "part-{:05d}.parquet"
+PARQUET_PART_GLOB = "part-*.parquet"
 
-class OutputFormat(enum.Enum):
-    CSV = ".csv"
-    PARQUET = ".parquet"
+
+class StorageOptions(T.NamedTuple):
+    """Controls how streams are stored
+
+    sample_dtype: Floating point columns are cast to this dtype, e.g. float32.
+        None keeps the dtype of the recorded stream.
+    compression: Parquet compression codec
+    byte_stream_split: Use the BYTE_STREAM_SPLIT parquet encoding for
+        floating point columns (incl. time stamps), which makes slowly
+        changing values compress considerably better.
+    """
+
+    sample_dtype: T.Optional[str] = None
+    compression: str = "snappy"
+    byte_stream_split: bool = False
+
+    @classmethod
+    def compact(cls, compression: str = "zstd") -> "StorageOptions":
+        return cls(sample_dtype="float32", compression=compression, byte_stream_split=True)
+
+    def cast(self, df: pd.DataFrame) -> pd.DataFrame:
+        if self.sample_dtype is None:
+            return df
+        float_columns = df.select_dtypes(include="floating").columns
+        if float_columns.empty:
+            return df
+        return df.astype({col: self.sample_dtype for col in float_columns})
+
+    def parquet_kwargs(self, df: pd.DataFrame) -> T.Dict[str, T.Any]:
+        kwargs = {"compression": None if self.compression == "none" else self.compression}
+        if self.byte_stream_split:
+            float_columns = df.select_dtypes(include="floating").columns.tolist()
+            other_columns = [col for col in df.columns if col not in float_columns]
+            if df.index.dtype.kind == "f":
+                float_columns.append(df.index.name)
+            kwargs["use_byte_stream_split"] = float_columns
+            # Dictionary encoding takes precedence, only use it for the rest
+            kwargs["use_dictionary"] = other_columns
+        return kwargs
 
 
 @click.command()
 @click.option("--parquet", "format_", default=True, flag_value=OutputFormat.PARQUET)
 @click.option("--csv", "format_", flag_value=OutputFormat.CSV)
+@click.option(
+    "--jobs",
+    "-j",
+    default=1,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Number of subject folders that are converted in parallel",
+)
+@click.option(
+    "--streaming/--in-memory",
+    default=False,
+    show_default=True,
+    help="Read XDF files chunk by chunk and write streams incrementally",
+)
+@click.option(
+    "--chunk-samples",
+    default=DEFAULT_CHUNK_SAMPLES,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Samples per written block in streaming mode",
+)
+@click.option(
+    "--compact",
+    is_flag=True,
+    help="Store float32 samples with zstd compression and float encodings",
+)
+@click.option(
+    "--compression",
+    type=click.Choice(["snappy", "zstd", "gzip", "brotli", "lz4", "none"]),
+    default=None,
+    help="Parquet compression codec [default: snappy, zstd with --compact]",
+)
+@click.option(
+    "--sample-store",
+    is_flag=True,
+    help="Additionally write memory-mappable .npy sample stores (parquet only)",
+)
+@click.option(
+    "--manifest",
+    "manifest_root",
+    type=click.Path(exists=True, file_okay=False),
+    default=None,
+    help="Study root with manifest.json; skips XDF files whose outputs are up to date",
+)
+@profiling.verbose_option
+@profiling.quiet_option
 @click.argument("filenames", nargs=-1, type=click.Path(exists=True))
-def xdf_convert(format_, filenames):
+def xdf_convert(
+    format_,
+    jobs,
+    streaming,
+    chunk_samples,
+    compact,
+    compression,
+    sample_store,
+    manifest_root,
+    verbose,
+    quiet,
+    filenames,
+):
     """Extracts streams from given XDF files and saves them to a defined output format
 
     filenames: List of XDF file paths
 
-    Output: Each stream will be stored as an individual file next to their corresponding XDF file.
+    Output: Each stream will be stored as an individual file next to their
+    corresponding XDF file, and a profile <subject>_convert_profile.json per folder.
     """
-    start_times = {}
+    profiling.configure_logging(verbose, quiet)
+    if sample_store and format_ is not OutputFormat.PARQUET:
+        raise click.UsageError("Sample stores can only be built from parquet exports.")
     filenames = sorted(pathlib.Path(fn).resolve() for fn in filenames)
-    for path in filenames:
-        print(f"Loading {path}")
-
-        # Assumes that the parent folder's name is the subject
-        # Eg. path: .../ARB42/sub-ARB42_ses-S001_task-T1_run-001_eeg.xdf
-        # -> subject_id: ARB42
-        subject_id = path.parent.name
-
-        streams_to_convert = [
-            STREAM_TYPES.eye_tracking,
-            STREAM_TYPES.marker,
-            STREAM_TYPES.brainvision_eda,
-            STREAM_TYPES.g_tec,
-        ]
-        streams = xdf_load_streams_by_name(path, streams_to_convert)
-
-        # In case of split recordings, we have multiple xdf files in the same directory,
-        # i.e. in path.parent. In these cases, we need a common start time for all xdf
-        # files in this folder.
-        # Check, if we calculated a start time for path.parent before. If not, extract
-        # from loaded data frames, see stream_data() for details.
-        start_time = start_times.get(path.parent)
-        previous_split_found = start_time is not None
-        streams_by_name, start_time = stream_data(streams, start_time)
-        # Save calculated start_time in case other splits follow.
-        start_times[path.parent] = start_time
-        for stream_type, df in streams_by_name.items():
-            export_path = path.with_name(subject_id + FILE_SUFFIXES[stream_type])
-            export_path = export_path.with_suffix(format_.value)
-            if format_ is OutputFormat.CSV:
-                if previous_split_found and export_path.exists():
-                    # In this case append to existing csv file
-                    print(f"Appending to {export_path}")
-                    df.to_csv(
-                        export_path, index_label="time_stamps", mode="a", header=False
-                    )
-                else:
-                    print(f"Exporting to {export_path}")
-                    df.to_csv(export_path, index_label="time_stamps")
-            elif format_ is OutputFormat.PARQUET:
-                df.index.rename("time_stamps", inplace=True)
-                if previous_split_found and export_path.exists():
-                    print(f"Appending to {export_path}")
-                    prev_df = pd.read_parquet(export_path)
-                    combined = pd.concat([prev_df, df], axis=0)
-                    combined.to_parquet(export_path, index=True)
-                else:
-                    print(f"Exporting to {export_path}")
-                    df.to_parquet(export_path, index=True)
+    groups = group_by_folder(filenames)
+    if compact:
+        storage = StorageOptions.compact(compression or "zstd")
+    else:
+        storage = StorageOptions(compression=compression or "snappy")
+    convert = functools.partial(
+        profiled_convert_folder,
+        format_=format_,
+        streaming=streaming,
+        chunk_samples=chunk_samples,
+        storage=storage,
+        sample_store=sample_store,
+    )
+
+    manifest = None
+    if manifest_root is not None:
+        manifest = Manifest.load(manifest_root)
+        outside = [group[0].parent for group in groups if not manifest.contains(group[0].parent)]
+        if outside:
+            raise click.UsageError(
+                f"Folders outside of the manifest root {manifest.root}: "
+                + ", ".join(str(folder) for folder in outside)
+            )
+        options = {
+            "format": format_.value,
+            "streaming": streaming,
+            "storage": storage._asdict(),
+            "sample_store": sample_store,
+        }
+        outdated = []
+        for group in groups:
+            if manifest.is_up_to_date(group, options):
+                logger.info(f"Skipping {group[0].parent}, outputs are up to date")
             else:
-                raise ValueError(f"Don't know how to handle format: {format_}")
+                outdated.append(group)
+        groups = outdated
+
+    def finished(group):
+        logger.info(f"Finished {group[0].parent}")
+        if manifest is not None:
+            manifest.update_recording(group[0].parent, group, options)
+            manifest.save()
+
+    if jobs == 1 or len(groups) <= 1:
+        for group in groups:
+            convert(group)
+            finished(group)
+        return
+
+    # Split recordings of the same folder share a start time and are appended to
+    # each other. Therefore, only whole folders are distributed across workers.
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(convert, group): group for group in groups}
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
+            finished(futures[future])
+
+
+def group_by_folder(paths: T.Iterable[pathlib.Path]) -> T.List[T.List[pathlib.Path]]:
+    """Groups sorted XDF paths by their parent folder, keeping their order"""
+    groups = itertools.groupby(sorted(paths), key=lambda path: path.parent)
+    return [list(group) for _, group in groups]
+
+
+def convert_folder(
+    paths: T.Sequence[pathlib.Path],
+    format_: OutputFormat,
+    streaming: bool = False,
+    chunk_samples: int = DEFAULT_CHUNK_SAMPLES,
+    storage: StorageOptions = StorageOptions(),
+    sample_store: bool = False,
+):
+    """Converts all XDF files of one folder in order
+
+    All paths are expected to share the same parent folder, i.e. to be split
+    recordings of the same subject. If sample_store is set, the numeric
+    streams are written to sample stores once all splits are converted.
+    """
+    # Stores of a previous conversion would shadow the new exports
+    remove_sample_stores(paths[0], format_)
+    start_time = None
+    for idx, path in enumerate(paths):
+        if streaming:
+            start_time = stream_convert_file(
+                path,
+                format_,
+                start_time=start_time,
+                previous_split_found=idx > 0,
+                chunk_samples=chunk_samples,
+                storage=storage,
+            )
+        else:
+            start_time = convert_file(
+                path,
+                format_,
+                start_time=start_time,
+                previous_split_found=idx > 0,
+                storage=storage,
+            )
+    if sample_store:
+        with profiling.span("sample_stores"):
+            write_sample_stores(paths[0], format_)
+
+
+def profiled_convert_folder(paths: T.Sequence[pathlib.Path], **kwargs):
+    """convert_folder() that writes a profile next to the exports, see shared.profiling"""
+    subject_id = paths[0].parent.name
+    with profiling.Profiler() as profiler, profiling.span("convert"):
+        convert_folder(paths, **kwargs)
+    path = profiling.profile_path(paths[0].parent, subject_id, "convert")
+    profiler.write(path, vp_code=subject_id, command="convert")
+
+
+def remove_sample_stores(path: pathlib.Path, format_: OutputFormat):
+    """Removes the sample stores of all numeric streams exported next to path"""
+    subject_id = path.parent.name
+    for stream_type in NUMERIC_STREAMS:
+        export_path = stream_export_path(path, subject_id, stream_type, format_)
+        remove_store(export_path.with_suffix(STORE_SUFFIX))
+
+
+def write_sample_stores(path: pathlib.Path, format_: OutputFormat):
+    """Writes sample stores for all numeric streams exported next to path"""
+    subject_id = path.parent.name
+    for stream_type in NUMERIC_STREAMS:
+        export_path = stream_export_path(path, subject_id, stream_type, format_)
+        if not export_path.exists():
+            continue
+        logger.info(f"Writing sample store for {export_path}")
+        SampleStore.from_parquet(export_path)
+
+
+def convert_file(
+    path: pathlib.Path,
+    format_: OutputFormat,
+    start_time: T.Optional[float] = None,
+    previous_split_found: bool = False,
+    storage: StorageOptions = StorageOptions(),
+) -> float:
+    """Converts a single XDF file and returns the start time that was used"""
+    logger.info(f"Loading {path}")
+
+    # Assumes that the parent folder's name is the subject
+    # Eg. path: .../ARB42/sub-ARB42_ses-S001_task-T1_run-001_eeg.xdf
+    # -> subject_id: ARB42
+    subject_id = path.parent.name
+
+    with profiling.span("load") as span:
+        streams = xdf_load_streams_by_name(path, STREAMS_TO_CONVERT)
+        span.samples = sum(len(stream["time_stamps"]) for stream in streams)
+
+    # In case of split recordings, we have multiple xdf files in the same directory,
+    # i.e. in path.parent. In these cases, we need a common start time for all xdf
+    # files in this folder. If no start time was passed from a previous split,
+    # extract it from the loaded data frames, see stream_data() for details.
+    with profiling.span("dataframes"):
+        streams_by_name, start_time = stream_data(streams, start_time)
+
+    # Streams are written to independent files, export them concurrently.
+    max_workers = max(len(streams_by_name), 1)
+    num_samples = sum(len(df) for df in streams_by_name.values())
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    with profiling.span("export", samples=num_samples), executor:
+        futures = [
+            executor.submit(
+                export_stream,
+                df,
+                stream_export_path(path, subject_id, stream_type, format_),
+                format_,
+                previous_split_found,
+                storage,
+            )
+            for stream_type, df in streams_by_name.items()
+        ]
+        for future in futures:
+            future.result()
+    return start_time
+
+
+def stream_convert_file(
+    path: pathlib.Path,
+    format_: OutputFormat,
+    start_time: T.Optional[float] = None,
+    previous_split_found: bool = False,
+    chunk_samples: int = DEFAULT_CHUNK_SAMPLES,
+    storage: StorageOptions = StorageOptions(),
+) -> float:
+    """Converts a single XDF file chunk by chunk and returns the used start time
+
+    Produces the same output files as convert_file(), but never holds more than
+    `chunk_samples` samples per stream in memory. Time stamps are clock
+    synchronized but, unlike pyxdf.load_xdf(), not dejittered.
+    """
+    logger.info(f"Streaming {path}")
+    subject_id = path.parent.name
+
+    reader = XDFStreamReader(path, STREAMS_TO_CONVERT)
+    headers = reader.scan()
+    if start_time is None:
+        # The marker stream is small, load it completely to find the start time
+        marker_id = next(
+            stream_id
+            for stream_id, header in headers.items()
+            if header.name == STREAM_TYPES.marker
+        )
+        time_stamps, values = reader.read_stream(marker_id)
+        marker_df = pd.DataFrame(
+            values, index=time_stamps, columns=headers[marker_id].columns
+        )
+        start_time = extract_start_time(marker_df)
+    logger.info(f"Using {start_time} as start time:")
+
+    writers = {
+        stream_id: StreamWriter(
+            stream_export_path(path, subject_id, header.name, format_),
+            format_,
+            header.columns,
+            append=previous_split_found,
+            chunk_samples=chunk_samples,
+            storage=storage,
+        )
+        for stream_id, header in headers.items()
+    }
+    try:
+        with profiling.span("stream") as span:
+            span.samples = 0
+            for stream_id, time_stamps, values in reader.iter_samples():
+                writers[stream_id].write(time_stamps - start_time, values)
+                span.samples += len(time_stamps)
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return start_time
+
+
+class StreamWriter:
+    """Buffers sample chunks of one stream and writes them block-wise
+
+    Parquet blocks are written as row groups, csv blocks are appended to the
+    file. When appending to an existing parquet export, a new part file is
+    added to it, see parquet_part_path().
+    """
+
+    def __init__(
+        self,
+        export_path: pathlib.Path,
+        format_: OutputFormat,
+        columns: T.List[str],
+        append: bool = False,
+        chunk_samples: int = DEFAULT_CHUNK_SAMPLES,
+        storage: StorageOptions = StorageOptions(),
+    ):
+        self.export_path = export_path
+        self.format_ = format_
+        self.columns = columns
+        self.append = append and export_path.exists()
+        self.chunk_samples = chunk_samples
+        self.storage = storage
+        self._buffer: T.List[pd.DataFrame] = []
+        self._buffered_samples = 0
+        self._writer = None
+        self._schema = None
+        self._num_written = 0
+        if format_ not in (OutputFormat.CSV, OutputFormat.PARQUET):
+            raise ValueError(f"Don't know how to handle format: {format_}")
+        action = "Appending to" if self.append else "Exporting to"
+        logger.info(f"{action} {export_path}")
+
+    def write(self, time_stamps, values):
+        df = pd.DataFrame(values, index=time_stamps, columns=self.columns)
+        df.index.rename("time_stamps", inplace=True)
+        self._buffer.append(df)
+        self._buffered_samples += len(df)
+        if self._buffered_samples >= self.chunk_samples:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            block = pd.concat(self._buffer, axis=0)
+        elif self._num_written == 0:
+            # Make sure that empty streams are exported as well
+            block = pd.DataFrame(columns=self.columns, index=pd.Index([], name="time_stamps"))
+        else:
+            return
+        self._buffer = []
+        self._buffered_samples = 0
+        block = self.storage.cast(block)
+        if self.format_ is OutputFormat.CSV:
+            header = self._num_written == 0 and not self.append
+            mode = "w" if header else "a"
+            block.to_csv(
+                self.export_path, index_label="time_stamps", mode=mode, header=header
+            )
+        else:
+            self._write_parquet(block)
+        self._num_written += len(block)
+
+    def _write_parquet(self, block: pd.DataFrame):
+        table = pa.Table.from_pandas(block, schema=self._schema, preserve_index=True)
+        if self._writer is None:
+            self._schema = table.schema
+            target_path = parquet_part_path(self.export_path, self.append)
+            self._writer = pq.ParquetWriter(
+                target_path, self._schema, **self.storage.parquet_kwargs(block)
+            )
+        self._writer.write_table(table)
+
+    def close(self):
+        self.flush()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+def parquet_part_path(export_path: pathlib.Path, append: bool) -> pathlib.Path:
+    """Path to write the next (part of a) parquet export to
+
+    A recording without splits is exported to a single parquet file. Once a
+    split recording is appended, the export becomes a parquet dataset, i.e. a
+    directory with the same name that holds one part file per split:
+
+        ABC12_gtec.parquet/part-00000.parquet
+        ABC12_gtec.parquet/part-00001.parquet
+
+    pd.read_parquet() reads both layouts transparently as one table.
+    """
+    if not append:
+        if export_path.is_dir():
+            shutil.rmtree(export_path)
+        return export_path
+    if export_path.is_file():
+        # Promote the single file export to a dataset directory
+        first_part = export_path.with_name(export_path.name + ".tmp")
+        export_path.replace(first_part)
+        export_path.mkdir()
+        first_part.replace(export_path / PARQUET_PART_NAME.format(0))
+    num_parts = len(list(export_path.glob(PARQUET_PART_GLOB)))
+    return export_path / PARQUET_PART_NAME.format(num_parts)
+
+
+def stream_export_path(
+    path: pathlib.Path, subject_id: str, stream_type: str, format_: OutputFormat
+) -> pathlib.Path:
+    export_path = path.with_name(subject_id + FILE_SUFFIXES[stream_type])
+    return export_path.with_suffix(format_.value)
+
+
+def export_stream(
+    df: pd.DataFrame,
+    export_path: pathlib.Path,
+    format_: OutputFormat,
+    previous_split_found: bool = False,
+    storage: StorageOptions = StorageOptions(),
+):
+    df = storage.cast(df)
+    if format_ is OutputFormat.CSV:
+        if previous_split_found and export_path.exists():
+            # In this case append to existing csv file
+            logger.info(f"Appending to {export_path}")
+            df.to_csv(export_path, index_label="time_stamps", mode="a", header=False)
+        else:
+            logger.info(f"Exporting to {export_path}")
+            df.to_csv(export_path, index_label="time_stamps")
+    elif format_ is OutputFormat.PARQUET:
+        df.index.rename("time_stamps", inplace=True)
+        append = previous_split_found and export_path.exists()
+        logger.info(f"{'Appending to' if append else 'Exporting to'} {export_path}")
+        df.to_parquet(
+            parquet_part_path(export_path, append),
+            index=True,
+            **storage.parquet_kwargs(df),
+        )
+    else:
+        raise ValueError(f"Don't know how to handle format: {format_}")
 
 
 def xdf_load_streams_by_name(path, names=None):
@@ -132,7 +571,7 @@ def dataframe_from_stream(
     if header_replacement is not None:
         df.rename(columns=header_replacement, inplace=True)
     if None in df.columns:
-        print(f"Dropping unlabeled column(s) in stream {name}.")
+        logger.warning(f"Dropping unlabeled column(s) in stream {name}.")
         df.drop(columns=[None], inplace=True)
     headers_as_str = {col: str(col) for col in df.columns if not isinstance(col, str)}
     if headers_as_str:
@@ -142,13 +581,13 @@ def dataframe_from_stream(
 
 
 def extract_start_time(marker_df):
-    start_marker_mask = marker_df["0"] == str(MarkersV2.start.value)
+    start_marker_mask = marker_df["0"] == str(Markers.block_start.value)
     start_ts = marker_df[start_marker_mask]["0"].index[0]
     return start_ts
 
 
 def normalize_index(dfs, start_time):
-    print(f"Using {start_time} as start time:")
+    logger.info(f"Using {start_time} as start time:")
     for df in dfs:
         df.index -= start_time
 
@@ -0,0 +1,484 @@
+"""
+Incremental XDF reader and writer
+
+Reads XDF files chunk by chunk instead of loading all streams at once, see
+https://github.com/sccn/xdf/wiki/Specifications for the file format.
+Sample chunks are decoded one at a time, such that memory usage is bounded by
+the size of the largest chunk instead of the length of the recording.
+
+XDFWriter writes files the same way, e.g. synthetic recordings for tests and
+benchmarks, see processing.synthetic.
+"""
+import dataclasses
+import enum
+import pathlib
+import struct
+import typing as T
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+
+import numpy as np
+
+XDF_MAGIC = b"XDF:"
+FILE_HEADER_XML = b"<?xml version='1.0'?><info><version>1.0</version></info>"
+
+
+class ChunkTag(enum.IntEnum):
+    file_header = 1
+    stream_header = 2
+    samples = 3
+    clock_offset = 4
+    boundary = 5
+    stream_footer = 6
+
+
+TAGS_WITH_STREAM_ID = (
+    ChunkTag.stream_header,
+    ChunkTag.samples,
+    ChunkTag.clock_offset,
+    ChunkTag.stream_footer,
+)
+
+CHANNEL_FORMATS = {
+    "double64": np.dtype("<f8"),
+    "float32": np.dtype("<f4"),
+    "int64": np.dtype("<i8"),
+    "int32": np.dtype("<i4"),
+    "int16": np.dtype("<i2"),
+    "int8": np.dtype("<i1"),
+    "string": None,
+}
+
+
+@dataclasses.dataclass
+class StreamHeader:
+    stream_id: int
+    name: str
+    channel_format: str
+    channel_count: int
+    nominal_srate: float
+    channel_labels: T.Optional[T.List[str]] = None
+    clock_times: T.List[float] = dataclasses.field(default_factory=list)
+    clock_values: T.List[float] = dataclasses.field(default_factory=list)
+
+    @classmethod
+    def from_xml(cls, stream_id: int, xml: bytes) -> "StreamHeader":
+        info = ET.fromstring(xml.decode("utf-8", "replace"))
+        labels = [
+            label.text for label in info.findall("./desc/channels/channel/label")
+        ]
+        return cls(
+            stream_id=stream_id,
+            name=info.findtext("name"),
+            channel_format=info.findtext("channel_format"),
+            channel_count=int(info.findtext("channel_count")),
+            nominal_srate=float(info.findtext("nominal_srate")),
+            channel_labels=labels or None,
+        )
+
+    @property
+    def dtype(self) -> T.Optional[np.dtype]:
+        return CHANNEL_FORMATS[self.channel_format]
+
+    @property
+    def tdiff(self) -> float:
+        """Nominal sampling interval, used to deduce omitted time stamps"""
+        return 1.0 / self.nominal_srate if self.nominal_srate > 0 else 0.0
+
+    @property
+    def columns(self) -> T.List[str]:
+        """Column names as produced by xdf_convert.dataframe_from_stream()"""
+        if self.channel_labels is None:
+            return [str(idx) for idx in range(self.channel_count)]
+        return [str(label) for label in self.channel_labels]
+
+    def clock_correction(self) -> T.Tuple[float, float]:
+        """Linear clock offset model (intercept, slope) fitted to the clock offsets
+
+        Unlike pyxdf, clock resets are not detected and a plain least squares
+        fit is used.
+        """
+        if not self.clock_times:
+            return 0.0, 0.0
+        if len(self.clock_times) == 1:
+            return self.clock_values[0], 0.0
+        slope, intercept = np.polyfit(self.clock_times, self.clock_values, deg=1)
+        return intercept, slope
+
+
+class XDFStreamReader:
+    """Reads XDF files incrementally
+
+    Usage:
+        reader = XDFStreamReader(path, names=["psychopy_marker"])
+        headers = reader.scan()
+        for stream_id, time_stamps, values in reader.iter_samples():
+            ...
+
+    scan() only reads stream headers and clock offsets and skips over the
+    sample chunks. iter_samples() then decodes one sample chunk at a time.
+    """
+
+    def __init__(
+        self,
+        path: T.Union[pathlib.Path, str],
+        names: T.Optional[T.Iterable[str]] = None,
+    ):
+        self.path = pathlib.Path(path)
+        self.names = set(names) if names is not None else None
+        self.headers: T.Dict[int, StreamHeader] = {}
+
+    def scan(self) -> T.Dict[int, StreamHeader]:
+        """Reads stream headers and clock offsets of the selected streams"""
+        headers = {}
+        with self.path.open("rb") as f:
+            for tag, stream_id, payload in _iter_chunks(f, skip_samples=True):
+                if tag is ChunkTag.stream_header:
+                    header = StreamHeader.from_xml(stream_id, payload)
+                    if self.names is None or header.name in self.names:
+                        headers[stream_id] = header
+                elif tag is ChunkTag.clock_offset and stream_id in headers:
+                    clock_time, clock_value = struct.unpack("<dd", payload)
+                    headers[stream_id].clock_times.append(clock_time)
+                    headers[stream_id].clock_values.append(clock_value)
+        self.headers = headers
+        return headers
+
+    def iter_samples(
+        self, stream_ids: T.Optional[T.Iterable[int]] = None, clock_sync: bool = True
+    ) -> T.Iterator[T.Tuple[int, np.ndarray, T.Union[np.ndarray, T.List[list]]]]:
+        """Yields (stream_id, time_stamps, values) for each sample chunk
+
+        Numeric values are returned as (samples, channels) arrays, string values
+        as list of lists.
+        """
+        if not self.headers:
+            self.scan()
+        if stream_ids is None:
+            stream_ids = self.headers.keys()
+        stream_ids = set(stream_ids)
+        corrections = {
+            stream_id: self.headers[stream_id].clock_correction()
+            for stream_id in stream_ids
+        }
+        last_timestamps = {stream_id: 0.0 for stream_id in stream_ids}
+        with self.path.open("rb") as f:
+            chunks = _iter_chunks(f, skip_samples=True, read_samples_of=stream_ids)
+            for tag, stream_id, payload in chunks:
+                if tag is not ChunkTag.samples or stream_id not in stream_ids:
+                    continue
+                header = self.headers[stream_id]
+                time_stamps, values = decode_samples(
+                    payload, header, last_timestamps[stream_id]
+                )
+                if not len(time_stamps):
+                    continue
+                last_timestamps[stream_id] = time_stamps[-1]
+                if clock_sync:
+                    intercept, slope = corrections[stream_id]
+                    time_stamps = time_stamps + intercept + slope * time_stamps
+                yield stream_id, time_stamps, values
+
+    def read_stream(
+        self, stream_id: int, clock_sync: bool = True
+    ) -> T.Tuple[np.ndarray, T.Union[np.ndarray, T.List[list]]]:
+        """Reads a complete stream, meant for small streams, e.g. markers"""
+        header = self.headers[stream_id]
+        all_stamps, all_values = [], []
+        for _, time_stamps, values in self.iter_samples([stream_id], clock_sync):
+            all_stamps.append(time_stamps)
+            all_values.append(values)
+        if not all_stamps:
+            empty = [] if header.dtype is None else np.empty((0, header.channel_count))
+            return np.empty(0), empty
+        time_stamps = np.concatenate(all_stamps)
+        if header.dtype is None:
+            values = [sample for chunk in all_values for sample in chunk]
+        else:
+            values = np.concatenate(all_values)
+        return time_stamps, values
+
+
+class XDFWriter:
+    """Writes XDF files incrementally
+
+    Usage:
+        with XDFWriter(path) as writer:
+            stream_id = writer.add_stream("g.USBamp", "float32", labels, 256)
+            for time_stamps, values in chunks:
+                writer.write_samples(stream_id, time_stamps, values)
+
+    Like LabRecorder, only the first sample of a numeric chunk carries a time
+    stamp if the stream has a nominal sampling rate; readers deduce the others.
+    Stream footers are written on close().
+    """
+
+    def __init__(self, path: T.Union[pathlib.Path, str]):
+        self.path = pathlib.Path(path)
+        self.headers: T.Dict[int, StreamHeader] = {}
+        # First and last time stamp and sample count per stream, for the footers
+        self._footers: T.Dict[int, T.Tuple[float, float, int]] = {}
+        self._file = self.path.open("wb")
+        self._file.write(XDF_MAGIC)
+        self._write_chunk(ChunkTag.file_header, FILE_HEADER_XML)
+
+    def __enter__(self) -> "XDFWriter":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add_stream(
+        self,
+        name: str,
+        channel_format: str,
+        channel_labels: T.Optional[T.Sequence[str]] = None,
+        nominal_srate: float = 0.0,
+        channel_count: T.Optional[int] = None,
+    ) -> int:
+        """Writes a stream header and returns the id of the new stream
+
+        Streams without channel labels, e.g. markers, need a channel_count.
+        """
+        if channel_count is None:
+            channel_count = len(channel_labels)
+        stream_id = len(self.headers) + 1
+        header = StreamHeader(
+            stream_id,
+            name,
+            channel_format,
+            channel_count,
+            float(nominal_srate),
+            list(channel_labels) if channel_labels is not None else None,
+        )
+        channels = "".join(
+            f"<channel><label>{escape(str(label))}</label></channel>"
+            for label in header.channel_labels or ()
+        )
+        xml = (
+            f"<?xml version='1.0'?><info><name>{escape(name)}</name><type>{escape(name)}</type>"
+            f"<channel_count>{channel_count}</channel_count>"
+            f"<nominal_srate>{header.nominal_srate}</nominal_srate>"
+            f"<channel_format>{channel_format}</channel_format>"
+            f"<desc><channels>{channels}</channels></desc></info>"
+        )
+        self._write_chunk(ChunkTag.stream_header, xml.encode(), stream_id)
+        self.headers[stream_id] = header
+        return stream_id
+
+    def write_samples(
+        self,
+        stream_id: int,
+        time_stamps: np.ndarray,
+        values: T.Union[np.ndarray, T.Sequence[T.Sequence[str]]],
+    ):
+        """Writes one Samples chunk, values are (samples, channels)"""
+        header = self.headers[stream_id]
+        time_stamps = np.asarray(time_stamps, dtype="<f8")
+        num_samples = time_stamps.size
+        if not num_samples:
+            return
+        if header.dtype is None:
+            content = b"".join(
+                b"\x08" + struct.pack("<d", time_stamp)
+                + b"".join(_pack_varlen(len(raw)) + raw for raw in map(str.encode, sample))
+                for time_stamp, sample in zip(time_stamps, values)
+            )
+        elif header.nominal_srate > 0:
+            values = np.asarray(values, dtype=header.dtype).reshape(num_samples, -1)
+            records = np.zeros(num_samples, dtype=_record_dtype(header.dtype, header, False))
+            records["values"] = values
+            first = b"\x08" + struct.pack("<d", time_stamps[0]) + values[0].tobytes()
+            content = first + records[1:].tobytes()
+        else:
+            values = np.asarray(values, dtype=header.dtype).reshape(num_samples, -1)
+            records = np.zeros(num_samples, dtype=_record_dtype(header.dtype, header, True))
+            records["flag"] = 8
+            records["ts"] = time_stamps
+            records["values"] = values
+            content = records.tobytes()
+        self._write_chunk(ChunkTag.samples, _pack_varlen(num_samples) + content, stream_id)
+        first, _, count = self._footers.get(stream_id, (time_stamps[0], None, 0))
+        self._footers[stream_id] = (first, time_stamps[-1], count + num_samples)
+
+    def write_clock_offset(self, stream_id: int, collection_time: float, offset: float):
+        content = struct.pack("<dd", collection_time, offset)
+        self._write_chunk(ChunkTag.clock_offset, content, stream_id)
+        self.headers[stream_id].clock_times.append(collection_time)
+        self.headers[stream_id].clock_values.append(offset)
+
+    def close(self):
+        if self._file.closed:
+            return
+        for stream_id in self.headers:
+            first, last, count = self._footers.get(stream_id, (0.0, 0.0, 0))
+            xml = (
+                "<?xml version='1.0'?><info>"
+                f"<first_timestamp>{float(first)!r}</first_timestamp>"
+                f"<last_timestamp>{float(last)!r}</last_timestamp>"
+                f"<sample_count>{count}</sample_count>"
+                "</info>"
+            )
+            self._write_chunk(ChunkTag.stream_footer, xml.encode(), stream_id)
+        self._file.close()
+
+    def _write_chunk(self, tag: ChunkTag, content: bytes, stream_id: T.Optional[int] = None):
+        body = struct.pack("<H", tag)
+        if stream_id is not None:
+            body += struct.pack("<I", stream_id)
+        self._file.write(_pack_varlen(len(body) + len(content)))
+        self._file.write(body)
+        self._file.write(content)
+
+
+def decode_samples(
+    payload: bytes, header: StreamHeader, last_timestamp: float = 0.0
+) -> T.Tuple[np.ndarray, T.Union[np.ndarray, T.List[list]]]:
+    """Decodes the content of a Samples chunk (without the stream id)
+
+    Omitted time stamps are deduced from the previous time stamp and the
+    nominal sampling rate.
+    """
+    num_samples, offset = _varlen_int_from_buffer(payload, 0)
+    if header.dtype is None:
+        return _decode_string_samples(payload, offset, num_samples, header, last_timestamp)
+
+    dtype = header.dtype
+    sample_bytes = dtype.itemsize * header.channel_count
+    body = memoryview(payload)[offset:]
+    flags = body[0] if len(body) else 0
+
+    # Fast path 1: every sample carries its own time stamp
+    if len(body) == num_samples * (9 + sample_bytes):
+        records = np.frombuffer(body, dtype=_record_dtype(dtype, header, True))
+        if np.all(records["flag"] == 8):
+            return records["ts"].astype(float), records["values"].astype(dtype.newbyteorder("="))
+
+    # Fast path 2: only the first sample carries a time stamp (e.g. LabRecorder)
+    stamped_first = 9 + sample_bytes + (num_samples - 1) * (1 + sample_bytes)
+    if flags == 8 and len(body) == stamped_first:
+        first_ts = struct.unpack_from("<d", body, 1)[0]
+        first_values = np.frombuffer(body[9 : 9 + sample_bytes], dtype=dtype)
+        records = np.frombuffer(
+            body[9 + sample_bytes :], dtype=_record_dtype(dtype, header, False)
+        )
+        if np.all(records["flag"] == 0):
+            values = np.empty((num_samples, header.channel_count), dtype=dtype.newbyteorder("="))
+            values[0] = first_values
+            values[1:] = records["values"]
+            time_stamps = first_ts + header.tdiff * np.arange(num_samples)
+            return time_stamps, values
+
+    # Fast path 3: no time stamps at all
+    if len(body) == num_samples * (1 + sample_bytes):
+        records = np.frombuffer(body, dtype=_record_dtype(dtype, header, False))
+        if np.all(records["flag"] == 0):
+            time_stamps = last_timestamp + header.tdiff * np.arange(1, num_samples + 1)
+            return time_stamps, records["values"].astype(dtype.newbyteorder("="))
+
+    # General case: mixed time stamp flags
+    time_stamps = np.empty(num_samples)
+    values = np.empty((num_samples, header.channel_count), dtype=dtype.newbyteorder("="))
+    pos = 0
+    for idx in range(num_samples):
+        if body[pos] != 0:
+            last_timestamp = struct.unpack_from("<d", body, pos + 1)[0]
+            pos += 9
+        else:
+            last_timestamp += header.tdiff
+            pos += 1
+        time_stamps[idx] = last_timestamp
+        values[idx] = np.frombuffer(body[pos : pos + sample_bytes], dtype=dtype)
+        pos += sample_bytes
+    return time_stamps, values
+
+
+def _decode_string_samples(payload, offset, num_samples, header, last_timestamp):
+    time_stamps = np.empty(num_samples)
+    values = []
+    for idx in range(num_samples):
+        if payload[offset] != 0:
+            last_timestamp = struct.unpack_from("<d", payload, offset + 1)[0]
+            offset += 9
+        else:
+            last_timestamp += header.tdiff
+            offset += 1
+        time_stamps[idx] = last_timestamp
+        sample = []
+        for _ in range(header.channel_count):
+            length, offset = _varlen_int_from_buffer(payload, offset)
+            sample.append(payload[offset : offset + length].decode(errors="replace"))
+            offset += length
+        values.append(sample)
+    return time_stamps, values
+
+
+def _record_dtype(dtype, header, with_timestamp):
+    fields = [("flag", "u1")]
+    if with_timestamp:
+        fields.append(("ts", "<f8"))
+    fields.append(("values", dtype, (header.channel_count,)))
+    return np.dtype(fields)
+
+
+def _iter_chunks(
+    f: T.BinaryIO,
+    skip_samples: bool = False,
+    read_samples_of: T.Optional[T.Container[int]] = None,
+) -> T.Iterator[T.Tuple[ChunkTag, T.Optional[int], T.Optional[bytes]]]:
+    """Yields (tag, stream_id, content) for each chunk of an open XDF file
+
+    If skip_samples is set, the content of Samples chunks is skipped over
+    (yielding None) unless their stream id is in read_samples_of.
+    """
+    if f.read(4) != XDF_MAGIC:
+        raise ValueError(f"Not an XDF file: {getattr(f, 'name', f)}")
+    while True:
+        try:
+            chunk_len = _read_varlen_int(f)
+        except EOFError:
+            return
+        tag = ChunkTag(struct.unpack("<H", f.read(2))[0])
+        content_len = chunk_len - 2
+        stream_id = None
+        if tag in TAGS_WITH_STREAM_ID:
+            stream_id = struct.unpack("<I", f.read(4))[0]
+            content_len -= 4
+        if (
+            tag is ChunkTag.samples
+            and skip_samples
+            and (read_samples_of is None or stream_id not in read_samples_of)
+        ):
+            f.seek(content_len, 1)
+            yield tag, stream_id, None
+            continue
+        yield tag, stream_id, f.read(content_len)
+
+
+def _read_varlen_int(f: T.BinaryIO) -> int:
+    num_bytes = f.read(1)
+    if not num_bytes:
+        raise EOFError()
+    return _unpack_varlen(num_bytes[0], f.read(num_bytes[0]))
+
+
+def _varlen_int_from_buffer(buffer, offset: int) -> T.Tuple[int, int]:
+    num_bytes = buffer[offset]
+    start = offset + 1
+    value = _unpack_varlen(num_bytes, buffer[start : start + num_bytes])
+    return value, start + num_bytes
+
+
+def _pack_varlen(value: int) -> bytes:
+    for num_bytes, fmt in ((1, "<B"), (4, "<I"), (8, "<Q")):
+        if value < 1 << (8 * num_bytes):
+            return bytes([num_bytes]) + struct.pack(fmt, value)
+    raise ValueError(f"Value too large for a variable-length integer: {value}")
+
+
+def _unpack_varlen(num_bytes: int, raw: bytes) -> int:
+    try:
+        fmt = {1: "<B", 4: "<I", 8: "<Q"}[num_bytes]
+    except KeyError:
+        raise RuntimeError("Invalid variable-length integer encountered.") from None
+    return struct.unpack(fmt, raw)[0]
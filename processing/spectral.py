@@ -0,0 +1,175 @@
+'''
+Streaming Welch band power
+
+The power spectral density of consecutive signal segments is computed like
+mne.time_frequency.psd_array_welch(..., average=None) does, i.e. with a
+hamming window, per-segment mean removal and density scaling. Instead of the
+full (channels, freqs, segments) spectrum only the mean power per frequency
+band is kept, i.e. a (channels, bands, segments) matrix.
+
+period_mean() then reduces that matrix to (periods, channels, bands) for all
+periods of a recording at once.
+'''
+import typing as T
+
+import numpy as np
+
+from processing.shared import backends
+
+scipy_signal = backends.lazy("scipy.signal")
+
+FREQ_BANDS = {
+    "Delta": (0, 4),
+    "Theta": (4, 8),
+    "Alpha": (8, 12),
+    "Beta": (12, 30),
+    "Gamma": (30, 45),
+}
+
+# Number of segments transformed at once, bounds the temporary spectrum size
+DEFAULT_SEGMENTS_PER_CHUNK = 1024
+
+
+def band_bins(
+    freqs: np.ndarray,
+    bands: T.Mapping[str, T.Tuple[float, float]] = FREQ_BANDS,
+    fmin: float = 1.0,
+    fmax: float = 48.0,
+) -> np.ndarray:
+    """Maps frequency bands to frequency bin ranges
+
+    A band (low, high) includes all bins with low <= freq < high that also lie
+    within [fmin, fmax].
+
+    Output: (bands, 2) array of [start, stop) bin indices
+    """
+    freqs = np.asarray(freqs)
+    bins = []
+    for name, (low, high) in bands.items():
+        selected = np.flatnonzero(
+            (freqs >= max(low, fmin)) & (freqs < high) & (freqs <= fmax)
+        )
+        if selected.size == 0:
+            raise ValueError(f"Frequency band {name} {low}-{high} Hz contains no frequency bins")
+        bins.append((selected[0], selected[-1] + 1))
+    return np.array(bins, dtype=np.intp)
+
+
+class BandPowerAccumulator:
+    """Welch band power of a signal that is fed in consecutive chunks
+
+    Usage:
+        accumulator = BandPowerAccumulator(sfreq=256)
+        for chunk in chunks:  # (channels, samples)
+            accumulator.update(chunk)
+        band_power = accumulator.result()  # (channels, bands, segments)
+
+    Segments start every `n_fft - n_overlap` samples from the first sample;
+    samples after the last complete segment are ignored.
+    """
+
+    def __init__(
+        self,
+        sfreq: float,
+        bands: T.Mapping[str, T.Tuple[float, float]] = FREQ_BANDS,
+        n_fft: int = 256,
+        n_overlap: int = 0,
+        window: str = "hamming",
+        fmin: float = 1.0,
+        fmax: float = 48.0,
+        segments_per_chunk: int = DEFAULT_SEGMENTS_PER_CHUNK,
+    ):
+        if not 0 <= n_overlap < n_fft:
+            raise ValueError("n_overlap must be smaller than n_fft")
+        self.sfreq = sfreq
+        self.bands = list(bands)
+        self.n_fft = n_fft
+        self.step = n_fft - n_overlap
+        self.segments_per_chunk = segments_per_chunk
+        self.freqs = np.fft.rfftfreq(n_fft, 1.0 / sfreq)
+        self.band_bins = band_bins(self.freqs, bands, fmin, fmax)
+
+        self._window = scipy_signal.get_window(window, n_fft)
+        # One-sided density scaling like scipy_signal.welch(scaling="density")
+        self._scale = np.full(self.freqs.size, 2.0 / (sfreq * (self._window ** 2).sum()))
+        self._scale[0] /= 2
+        if n_fft % 2 == 0:
+            self._scale[-1] /= 2
+        self._pending: T.Optional[np.ndarray] = None
+        self._results: T.List[np.ndarray] = []
+        self._num_drained = 0
+
+    @property
+    def num_segments(self) -> int:
+        """Number of complete segments so far, including drained ones"""
+        return self._num_drained + sum(result.shape[-1] for result in self._results)
+
+    def segment_offsets(self) -> np.ndarray:
+        """Sample offset of the first sample of each segment in result()"""
+        return np.arange(self._num_drained, self.num_segments) * self.step
+
+    def update(self, samples: np.ndarray):
+        """Adds the next (channels, samples) chunk of the signal"""
+        samples = np.asarray(samples, dtype=np.float64)
+        if self._pending is not None and self._pending.shape[-1]:
+            samples = np.concatenate([self._pending, samples], axis=-1)
+        num_segments = max((samples.shape[-1] - self.n_fft) // self.step + 1, 0)
+        for start in range(0, num_segments, self.segments_per_chunk):
+            stop = min(start + self.segments_per_chunk, num_segments)
+            chunk = samples[:, start * self.step : (stop - 1) * self.step + self.n_fft]
+            self._results.append(self._band_power(chunk))
+        # Keep the samples of the next, incomplete segment
+        self._pending = samples[:, num_segments * self.step :].copy()
+
+    def result(self) -> np.ndarray:
+        """(channels, bands, segments) mean power per band and segment"""
+        if not self._results:
+            num_channels = 0 if self._pending is None else self._pending.shape[0]
+            return np.empty((num_channels, len(self.bands), 0))
+        return np.concatenate(self._results, axis=-1)
+
+    def drain(self) -> np.ndarray:
+        """Like result(), but only the segments completed since the last drain()
+
+        Drained segments are not kept, i.e. online consumers use constant memory.
+        result() then only returns the segments completed since.
+        """
+        band_power = self.result()
+        self._num_drained += band_power.shape[-1]
+        self._results = []
+        return band_power
+
+    def _band_power(self, chunk: np.ndarray) -> np.ndarray:
+        segments = np.lib.stride_tricks.sliding_window_view(chunk, self.n_fft, axis=-1)
+        segments = segments[:, :: self.step]
+        segments = segments - segments.mean(axis=-1, keepdims=True)
+        spectrum = np.fft.rfft(segments * self._window, axis=-1)
+        psd = (spectrum.real ** 2 + spectrum.imag ** 2) * self._scale
+
+        # Mean over the bins of each band from cumulative sums over frequencies
+        cumsum = np.zeros(psd.shape[:-1] + (psd.shape[-1] + 1,))
+        np.cumsum(psd, axis=-1, out=cumsum[..., 1:])
+        start, stop = self.band_bins.T
+        band_power = (cumsum[..., stop] - cumsum[..., start]) / (stop - start)
+        # (channels, segments, bands) -> (channels, bands, segments)
+        return band_power.transpose(0, 2, 1)
+
+
+def period_mean(values: np.ndarray, start: np.ndarray, stop: np.ndarray) -> np.ndarray:
+    """Means over the segment ranges [start[i], stop[i]) of the last axis
+
+    values: (..., segments) array, e.g. (channels, bands, segments) band power
+    start, stop: Segment offsets of each period, e.g. from PeriodSlices
+
+    Output: (periods, ...) array, NaN for empty periods
+
+    All periods are reduced with a single cumulative sum over the segments,
+    independent of their number, length and overlap.
+    """
+    start = np.asarray(start, dtype=np.intp)
+    stop = np.maximum(np.asarray(stop, dtype=np.intp), start)
+    cumsum = np.zeros(values.shape[:-1] + (values.shape[-1] + 1,))
+    np.cumsum(values, axis=-1, out=cumsum[..., 1:])
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = (cumsum[..., stop] - cumsum[..., start]) / (stop - start)
+    return np.moveaxis(means, -1, 0)
@@ -0,0 +1,402 @@
+'''
+Synthetic recordings with known ground truth, for tests and benchmarks
+
+A recording has the streams and the block structure of the study:
+
+    psychopy_marker  3 blocks of baseline high, baseline low and a task with
+                     stimulus/response markers, see markers_example.Markers
+    BrainVision RDA  1 kHz ECG with known R-peaks, and EDA
+    g.USBamp         14 channel 256 Hz EEG, sinusoids with known band power
+                     plus white noise, see expected_band_power()
+    pupil_capture    120 Hz pupil diameter and gaze with known blinks
+
+The heart rate and pupil diameter are raised during tasks. All streams are
+generated chunk by chunk, such that memory use does not depend on the
+duration, and written as XDF file and/or as converted parquet exports:
+
+    python -m processing.synthetic --duration 3600 --parquet study/ ABC12
+'''
+import logging
+import pathlib
+import typing as T
+
+import click
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from processing.eeg2mne import ELECTRODE_SITES, SFREQ
+from processing.spectral import FREQ_BANDS, band_bins
+from processing.shared import profiling
+from processing.shared.markers_example import Markers
+from processing.shared.streams import FILE_SUFFIXES, STREAM_TYPES, OutputFormat
+from processing.shared.xdf_stream import XDFWriter
+
+ECG_RATE = 1000
+PUPIL_RATE = 120
+ECG_CHANNELS = ["ECG", "EDA"]
+PUPIL_CHANNELS = [
+    "confidence",
+    "norm_pos_x",
+    "norm_pos_y",
+    "diameter0_2d",
+    "diameter1_2d",
+    "diameter0_3d",
+    "diameter1_3d",
+]
+
+# Sampling rate and number of channels of the numeric streams
+STREAM_SHAPES = {
+    STREAM_TYPES.brainvision_eda: (ECG_RATE, len(ECG_CHANNELS)),
+    STREAM_TYPES.g_tec: (SFREQ, len(ELECTRODE_SITES)),
+    STREAM_TYPES.eye_tracking: (PUPIL_RATE, len(PUPIL_CHANNELS)),
+}
+
+# Frequency and amplitude of the sinusoid of each band. The frequencies lie on
+# the 1 Hz grid of the Welch segments, away from the band edges, i.e. all
+# power of a sinusoid falls into its band.
+BAND_FREQS = {"Delta": 2, "Theta": 6, "Alpha": 10, "Beta": 20, "Gamma": 40}
+BAND_AMPLITUDES = {"Delta": 20.0, "Theta": 10.0, "Alpha": 15.0, "Beta": 5.0, "Gamma": 2.0}
+
+# Marker time line of a block, in s
+BLOCK_MARGIN_S = 2.0
+MAX_BASELINE_S = 60.0
+MIN_DURATION_S = 60.0
+
+# Interval between clock offset chunks, like LabRecorder
+CLOCK_OFFSET_INTERVAL_S = 5.0
+
+XDF_NAME = "sub-{vp_code}_ses-S001_task-T1_run-001_eeg.xdf"
+
+logger = logging.getLogger(__name__)
+
+
+class SyntheticOptions(T.NamedTuple):
+    duration_s: float = 600.0
+    seed: int = 0
+    start_ts: float = 1000.0
+    '''LSL time stamp of the first sample'''
+    heart_rate_bpm: float = 70.0
+    task_heart_rate_bpm: float = 78.0
+    eeg_noise: float = 2.0
+    '''Standard deviation of the white EEG noise'''
+    chunk_s: float = 1.0
+    '''Duration of the written sample chunks'''
+
+
+class SyntheticRecording:
+    def __init__(self, options: SyntheticOptions = SyntheticOptions()):
+        if options.duration_s < MIN_DURATION_S:
+            raise ValueError(f"Synthetic recordings last at least {MIN_DURATION_S} s")
+        self.options = options
+        self.stop_ts = options.start_ts + options.duration_s
+        rng = np.random.default_rng(options.seed)
+        self.markers = self._marker_table(rng)
+        task = self.markers.id.isin([Markers.task_start.value, Markers.task_end.value])
+        self.task_intervals = self.markers.index[task].to_numpy().reshape(-1, 2)
+        self.rpeak_ts = self._rpeaks(rng)
+        self.blinks = self._blinks(rng)
+        self.channel_gains = 1 + 0.05 * np.arange(len(ELECTRODE_SITES))
+
+    @property
+    def start_time(self) -> float:
+        """Time stamp of the first block start, time zero of converted exports"""
+        return self.markers.index[0]
+
+    def num_samples(self, stream_type: str) -> int:
+        rate, _ = STREAM_SHAPES[stream_type]
+        return int(self.options.duration_s * rate)
+
+    def in_task(self, time_stamps: np.ndarray) -> np.ndarray:
+        """Whether time stamps lie within a task period"""
+        idx = np.searchsorted(self.task_intervals.ravel(), time_stamps, side="right")
+        return idx % 2 == 1
+
+    def ecg(self, start: int, stop: int) -> T.Tuple[np.ndarray, np.ndarray]:
+        """Time stamps and (samples, [ECG, EDA]) values of samples [start, stop)"""
+        noise = self._noise(STREAM_TYPES.brainvision_eda, start, stop)
+        time_stamps = self.options.start_ts + np.arange(start, stop) / ECG_RATE
+        t = time_stamps - self.options.start_ts
+        ecg = 0.2 * np.sin(2 * np.pi * 0.2 * t) + 0.02 * noise[:, 0]
+        template_start, template = _beat_template()
+        beat_idx = np.round((self.rpeak_ts - self.options.start_ts) * ECG_RATE).astype(int)
+        first, last = np.searchsorted(
+            beat_idx, [start - template.size - template_start, stop - template_start]
+        )
+        for idx in beat_idx[first:last]:
+            lo = idx + template_start
+            clip_lo, clip_hi = max(lo, start), min(lo + template.size, stop)
+            ecg[clip_lo - start : clip_hi - start] += template[clip_lo - lo : clip_hi - lo]
+        eda = 2 + 0.5 * np.sin(2 * np.pi * t / 300) + 0.3 * self.in_task(time_stamps)
+        eda += 0.01 * noise[:, 1]
+        return time_stamps, np.stack([ecg, eda], axis=1).astype(np.float32)
+
+    def ecg_signal(self, sampling_rate: int = ECG_RATE) -> T.Tuple[np.ndarray, np.ndarray]:
+        """Time stamps and ECG channel of the whole recording
+
+        Lower sampling rates must divide ECG_RATE and keep every n-th sample.
+        """
+        if ECG_RATE % sampling_rate:
+            raise ValueError(f"The sampling rate must divide {ECG_RATE} Hz")
+        time_stamps, values = self.ecg(0, self.num_samples(STREAM_TYPES.brainvision_eda))
+        step = ECG_RATE // sampling_rate
+        return time_stamps[::step], values[::step, 0].astype(np.float64)
+
+    def eeg(self, start: int, stop: int) -> T.Tuple[np.ndarray, np.ndarray]:
+        """Time stamps and (samples, channels) values of samples [start, stop)"""
+        noise = self._noise(STREAM_TYPES.g_tec, start, stop)
+        time_stamps = self.options.start_ts + np.arange(start, stop) / SFREQ
+        # Phases from the sample index, such that they do not depend on the chunking
+        phase = 2 * np.pi * (np.arange(start, stop) % SFREQ) / SFREQ
+        signal = sum(
+            BAND_AMPLITUDES[band] * np.sin(BAND_FREQS[band] * phase) for band in BAND_FREQS
+        )
+        values = signal[:, np.newaxis] * self.channel_gains
+        values += self.options.eeg_noise * noise
+        return time_stamps, values.astype(np.float32)
+
+    def pupil(self, start: int, stop: int) -> T.Tuple[np.ndarray, np.ndarray]:
+        """Time stamps and (samples, PUPIL_CHANNELS) values of samples [start, stop)"""
+        noise = self._noise(STREAM_TYPES.eye_tracking, start, stop)
+        time_stamps = self.options.start_ts + np.arange(start, stop) / PUPIL_RATE
+        t = time_stamps - self.options.start_ts
+        diameter = 3.5 + 0.4 * self.in_task(time_stamps) + 0.1 * np.sin(2 * np.pi * t / 60)
+        values = np.empty((t.size, len(PUPIL_CHANNELS)))
+        values[:, 0] = np.clip(0.95 + 0.02 * noise[:, 0], 0, 1)
+        values[:, 1:3] = 0.5 + 0.05 * noise[:, 1:3]
+        values[:, 3:5] = 12 * diameter[:, np.newaxis] + 0.5 * noise[:, 3:5]
+        values[:, 5:7] = diameter[:, np.newaxis] + 0.02 * noise[:, 5:7]
+        # Pupil Capture reports blinks as samples with zero confidence
+        idx = np.searchsorted(self.blinks.ravel(), time_stamps, side="right")
+        values[idx % 2 == 1] = 0
+        return time_stamps, values.astype(np.float32)
+
+    def expected_band_power(self) -> pd.DataFrame:
+        """Band power per channel and band as computed by eeg_freq
+
+        Each band holds the power of its sinusoid, spread evenly over its
+        frequency bins, plus the density of the white noise.
+        """
+        freqs = np.fft.rfftfreq(SFREQ, 1.0 / SFREQ)
+        bins = band_bins(freqs)
+        num_bins = bins[:, 1] - bins[:, 0]
+        df = freqs[1] - freqs[0]
+        amplitudes = np.array([BAND_AMPLITUDES[band] for band in FREQ_BANDS])
+        sine_power = (amplitudes * self.channel_gains[:, np.newaxis]) ** 2 / 2
+        noise_density = 2 * self.options.eeg_noise ** 2 / SFREQ
+        power = sine_power / (num_bins * df) + noise_density
+        return pd.DataFrame(
+            power,
+            index=pd.Index(ELECTRODE_SITES, name="Channels"),
+            columns=pd.Index(list(FREQ_BANDS), name="Freq Bands"),
+        )
+
+    def iter_chunks(
+        self, chunk_s: T.Optional[float] = None
+    ) -> T.Iterator[T.Tuple[str, np.ndarray, T.Union[np.ndarray, T.List[T.List[str]]]]]:
+        """Yields (stream type, time stamps, values) chunks in time order"""
+        chunk_s = chunk_s or self.options.chunk_s
+        generators = {
+            STREAM_TYPES.brainvision_eda: self.ecg,
+            STREAM_TYPES.g_tec: self.eeg,
+            STREAM_TYPES.eye_tracking: self.pupil,
+        }
+        marker_ts = self.markers.index.to_numpy()
+        for chunk_start in np.arange(0, self.options.duration_s, chunk_s):
+            chunk_stop = min(chunk_start + chunk_s, self.options.duration_s)
+            for stream_type, generate in generators.items():
+                rate, _ = STREAM_SHAPES[stream_type]
+                start, stop = int(round(chunk_start * rate)), int(round(chunk_stop * rate))
+                if stop > start:
+                    yield (stream_type, *generate(start, stop))
+            first, last = np.searchsorted(
+                marker_ts, self.options.start_ts + np.array([chunk_start, chunk_stop])
+            )
+            if last > first:
+                markers = self.markers.iloc[first:last]
+                values = [[str(id_), label] for id_, label in zip(markers.id, markers.label)]
+                yield STREAM_TYPES.marker, markers.index.to_numpy(), values
+
+    def write_xdf(self, path: pathlib.Path) -> pathlib.Path:
+        with XDFWriter(path) as writer:
+            stream_ids = {
+                STREAM_TYPES.marker: writer.add_stream(STREAM_TYPES.marker, "string", channel_count=2),
+                STREAM_TYPES.brainvision_eda: writer.add_stream(
+                    STREAM_TYPES.brainvision_eda, "float32", ECG_CHANNELS, ECG_RATE
+                ),
+                STREAM_TYPES.g_tec: writer.add_stream(
+                    STREAM_TYPES.g_tec, "float32", ELECTRODE_SITES, SFREQ
+                ),
+                STREAM_TYPES.eye_tracking: writer.add_stream(
+                    STREAM_TYPES.eye_tracking, "float32", PUPIL_CHANNELS, PUPIL_RATE
+                ),
+            }
+            next_offset_ts = self.options.start_ts
+            for stream_type, time_stamps, values in self.iter_chunks():
+                if time_stamps[-1] >= next_offset_ts:
+                    for stream_id in stream_ids.values():
+                        writer.write_clock_offset(stream_id, next_offset_ts, 0.0)
+                    next_offset_ts += CLOCK_OFFSET_INTERVAL_S
+                writer.write_samples(stream_ids[stream_type], time_stamps, values)
+            for stream_id in stream_ids.values():
+                writer.write_clock_offset(stream_id, self.stop_ts, 0.0)
+        return path
+
+    def write_parquet(
+        self, directory: pathlib.Path, vp_code: str, chunk_s: float = 60.0
+    ) -> T.List[pathlib.Path]:
+        """Writes the streams like xdf_convert exports them, see convert_file()"""
+        columns = {
+            STREAM_TYPES.marker: ["0", "1"],
+            STREAM_TYPES.brainvision_eda: ECG_CHANNELS,
+            STREAM_TYPES.g_tec: ELECTRODE_SITES,
+            STREAM_TYPES.eye_tracking: PUPIL_CHANNELS,
+        }
+        paths = {
+            stream_type: directory / f"{vp_code}{FILE_SUFFIXES[stream_type]}{OutputFormat.PARQUET.value}"
+            for stream_type in columns
+        }
+        writers = {}
+        try:
+            for stream_type, time_stamps, values in self.iter_chunks(chunk_s):
+                index = pd.Index(time_stamps - self.start_time, name="time_stamps")
+                df = pd.DataFrame(values, index=index, columns=columns[stream_type])
+                table = pa.Table.from_pandas(df, preserve_index=True)
+                if stream_type not in writers:
+                    writers[stream_type] = pq.ParquetWriter(paths[stream_type], table.schema)
+                writers[stream_type].write_table(table)
+        finally:
+            for writer in writers.values():
+                writer.close()
+        return list(paths.values())
+
+    def _marker_table(self, rng: np.random.Generator) -> pd.DataFrame:
+        block_s = (self.options.duration_s - 4 * BLOCK_MARGIN_S) / 3
+        baseline_s = min(MAX_BASELINE_S, 0.15 * block_s)
+        events = []
+        block_start = self.options.start_ts + 2 * BLOCK_MARGIN_S
+        for _ in range(3):
+            ts = block_start
+            events.append((ts, Markers.block_start))
+            for start, end in (
+                (Markers.baseline_high_start, Markers.baseline_high_end),
+                (Markers.baseline_low_start, Markers.baseline_low_end),
+            ):
+                ts += BLOCK_MARGIN_S
+                events.append((ts, start))
+                ts += baseline_s
+                events.append((ts, end))
+            ts += BLOCK_MARGIN_S
+            events.append((ts, Markers.task_start))
+            task_end = block_start + block_s - BLOCK_MARGIN_S
+            stimulus = ts + rng.uniform(1, 2)
+            while stimulus + 1 < task_end:
+                events.append((stimulus, Markers.stimulus_on))
+                events.append((stimulus + rng.uniform(0.3, 0.9), Markers.response))
+                stimulus += rng.uniform(2, 4)
+            events.append((task_end, Markers.task_end))
+            events.append((block_start + block_s, Markers.block_end))
+            block_start += block_s
+        time_stamps, markers = zip(*events)
+        return pd.DataFrame(
+            {"id": [marker.value for marker in markers], "label": [marker.name for marker in markers]},
+            index=pd.Index(time_stamps, name="time_stamps"),
+        )
+
+    def _rpeaks(self, rng: np.random.Generator) -> np.ndarray:
+        options = self.options
+        num_beats = int(options.duration_s * max(options.heart_rate_bpm, options.task_heart_rate_bpm) / 60 * 1.2) + 2
+        # Heart rate at approximate beat times, with respiratory sinus arrhythmia
+        approx_ts = options.start_ts + np.arange(num_beats) * 60 / options.heart_rate_bpm
+        heart_rate = np.where(
+            self.in_task(approx_ts), options.task_heart_rate_bpm, options.heart_rate_bpm
+        )
+        rr_s = 60 / heart_rate + 0.03 * np.sin(2 * np.pi * 0.25 * approx_ts)
+        rr_s += rng.normal(0, 0.015, num_beats)
+        rpeak_ts = options.start_ts + 0.5 + np.cumsum(rr_s)
+        rpeak_ts = rpeak_ts[rpeak_ts < self.stop_ts - 0.5]
+        # R-peaks lie on samples
+        return options.start_ts + np.round((rpeak_ts - options.start_ts) * ECG_RATE) / ECG_RATE
+
+    def _blinks(self, rng: np.random.Generator) -> np.ndarray:
+        """(blinks, 2) start and end time stamps, every 4 s on average"""
+        num_blinks = int(self.options.duration_s / 4 * 1.5) + 1
+        starts = self.options.start_ts + np.cumsum(rng.exponential(4, num_blinks))
+        starts = starts[starts < self.stop_ts - 1]
+        return np.stack([starts, starts + rng.uniform(0.1, 0.3, starts.size)], axis=1)
+
+    def _noise(self, stream_type: str, start: int, stop: int) -> np.ndarray:
+        """(samples, channels) standard normal noise of samples [start, stop)
+
+        Noise is drawn in blocks of one second with a seed per block, such
+        that samples do not depend on how a recording is chunked.
+        """
+        rate, num_channels = STREAM_SHAPES[stream_type]
+        stream_idx = list(FILE_SUFFIXES).index(stream_type)
+        first, last = start // rate, (stop - 1) // rate + 1
+        blocks = [
+            np.random.default_rng([self.options.seed, stream_idx, block]).standard_normal(
+                (rate, num_channels)
+            )
+            for block in range(first, last)
+        ]
+        return np.concatenate(blocks)[start - first * rate : stop - first * rate]
+
+
+def _beat_template() -> T.Tuple[int, np.ndarray]:
+    """Offset of the first sample relative to the R-peak and a PQRST waveform"""
+    offsets = np.arange(-0.3, 0.45, 1 / ECG_RATE)
+    template = (
+        0.15 * np.exp(-(((offsets + 0.16) / 0.02) ** 2))  # P
+        - 0.1 * np.exp(-(((offsets + 0.03) / 0.008) ** 2))  # Q
+        + np.exp(-((offsets / 0.01) ** 2))  # R
+        - 0.2 * np.exp(-(((offsets - 0.03) / 0.01) ** 2))  # S
+        + 0.3 * np.exp(-(((offsets - 0.25) / 0.05) ** 2))  # T
+    )
+    return int(round(offsets[0] * ECG_RATE)), template
+
+
+def generate_subject(
+    root: pathlib.Path,
+    vp_code: str,
+    options: SyntheticOptions = SyntheticOptions(),
+    xdf: bool = True,
+    parquet: bool = False,
+) -> SyntheticRecording:
+    """Writes a synthetic recording to root/<vp_code>/"""
+    directory = pathlib.Path(root) / vp_code
+    directory.mkdir(parents=True, exist_ok=True)
+    recording = SyntheticRecording(options)
+    if xdf:
+        recording.write_xdf(directory / XDF_NAME.format(vp_code=vp_code))
+    if parquet:
+        recording.write_parquet(directory, vp_code)
+    return recording
+
+
+@click.command()
+@click.option("--duration", "duration_s", default=SyntheticOptions().duration_s, show_default=True, help="Recording length in s")
+@click.option("--seed", default=0, show_default=True, help="Seed of the first subject, incremented per subject")
+@click.option("--xdf/--no-xdf", default=True, show_default=True, help="Write an XDF file")
+@click.option("--parquet", is_flag=True, help="Write converted parquet exports")
+@profiling.verbose_option
+@profiling.quiet_option
+@click.argument("root", type=click.Path(file_okay=False))
+@click.argument("vp_codes", nargs=-1, required=True)
+def main(duration_s, seed, xdf, parquet, verbose, quiet, root, vp_codes):
+    """Generates synthetic recordings
+
+    root: Study folder, recordings are written to root/<vp_code>/
+
+    vp_codes: Subject codes, e.g. codes of the lookup tables in processing/data
+    """
+    profiling.configure_logging(verbose, quiet)
+    for idx, vp_code in enumerate(vp_codes):
+        logger.info(f"Generating {vp_code}")
+        options = SyntheticOptions(duration_s=duration_s, seed=seed + idx)
+        generate_subject(pathlib.Path(root), vp_code, options, xdf, parquet)
+
+
+if __name__ == "__main__":
+    main()
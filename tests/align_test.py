@@ -0,0 +1,160 @@
+import pathlib
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from processing.synthetic import SyntheticOptions, generate_subject
+from processing.shared import align
+from processing.shared.align import AlignedStore, CommonGrid, Method
+from processing.shared.recording import Recording
+from processing.shared.select_data import period_slices
+from processing.shared.streams import STREAM_TYPES
+
+
+class ClockTestCase(unittest.TestCase):
+    def test_fit_clock(self):
+        rng = np.random.default_rng(0)
+        rate = 256 * (1 + 50e-6)
+        true_ts = 2.0 + np.arange(100_000) / rate
+        # A dropout of five seconds halfway through
+        true_ts[50_000:] += 5.0
+        time_stamps = true_ts + rng.normal(0, 1e-4, true_ts.size)
+
+        clock, fitted = align.fit_clock(time_stamps, nominal_rate=256)
+        self.assertEqual(clock.segments, 2)
+        self.assertAlmostEqual(clock.drift_ppm, 50, delta=1)
+        self.assertAlmostEqual(clock.jitter_s, 1e-4, delta=1e-5)
+        self.assertAlmostEqual(clock.offset_s, 2.0, delta=1e-5)
+        self.assertTrue(clock.regular)
+        np.testing.assert_allclose(fitted, true_ts, atol=1e-5)
+
+    def test_too_few_samples(self):
+        for time_stamps in ([], [1.0], [1.0, 10.0]):
+            with self.subTest(time_stamps=time_stamps):
+                with self.assertRaises(ValueError):
+                    align.fit_clock(np.array(time_stamps), nominal_rate=256)
+
+    def test_resample_to_grid(self):
+        # 1 kHz with drift down to 250 Hz, and 120 Hz with a gap up to 250 Hz
+        grid = CommonGrid.spanning([(0.5, 20.0)], 250)
+        grid_ts = grid.time_stamps()
+        self.assertEqual(grid_ts[0], 0.5)
+        self.assertEqual(grid_ts[-1], 20.0)
+
+        ecg_ts = np.arange(20_000) / 1000.02
+        resampled = align.resample_to_grid(
+            np.sin(2 * np.pi * 3 * ecg_ts), ecg_ts, grid, Method.poly, source_rate=1000
+        )
+        # Excluding the filter transient at the end and the last grid point,
+        # which lies after the last sample of the slower clock
+        expected = np.sin(2 * np.pi * 3 * grid_ts)
+        np.testing.assert_allclose(resampled[:-50], expected[:-50], atol=1e-3)
+
+        pupil_ts = np.arange(2400) / 120
+        pupil_ts = np.delete(pupil_ts, np.s_[1000:1200])
+        resampled = align.resample_to_grid(np.sin(2 * np.pi * 3 * pupil_ts), pupil_ts, grid)
+        missing = (grid_ts > pupil_ts[999]) & (grid_ts < pupil_ts[1000])
+        missing |= grid_ts > pupil_ts[-1]
+        np.testing.assert_array_equal(np.isnan(resampled), missing)
+        np.testing.assert_allclose(
+            resampled[~missing], np.sin(2 * np.pi * 3 * grid_ts[~missing]), atol=5e-3
+        )
+
+
+class AlignRecordingTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.TemporaryDirectory()
+        cls.root = pathlib.Path(cls.tmp_dir.name)
+        cls.recording = generate_subject(
+            cls.root, "ABC12", SyntheticOptions(duration_s=120), xdf=False, parquet=True
+        )
+        cls.R = Recording(cls.root / "ABC12")
+        cls.aligned = align.align_recording(cls.R)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp_dir.cleanup()
+
+    def test_streams(self):
+        aligned = AlignedStore.open(align.aligned_path(self.R))
+        self.assertEqual(aligned.store.channels, self.aligned.store.channels)
+        self.assertEqual(aligned.methods[STREAM_TYPES.brainvision_eda], Method.poly)
+        self.assertEqual(aligned.methods[STREAM_TYPES.eye_tracking], Method.linear)
+        self.assertAlmostEqual(aligned.clocks[STREAM_TYPES.g_tec].drift_ppm, 0, places=3)
+
+        # The EEG is sampled at the grid rate and on the grid points
+        eeg = self.R.read_stream(STREAM_TYPES.g_tec)
+        aligned_eeg = aligned.stream(STREAM_TYPES.g_tec)
+        self.assertEqual(aligned_eeg.channels, list(eeg.columns))
+        first, stop = aligned_eeg.offsets(eeg.index[0], eeg.index[-1])
+        np.testing.assert_allclose(aligned_eeg.samples[:, first:stop], eeg.to_numpy().T, atol=1e-4)
+
+        # EDA low pass filtered and downsampled from 1 kHz, away from the
+        # steps at the task boundaries and within six standard deviations of
+        # the remaining noise
+        grid_ts = aligned.store.time_stamps + self.recording.start_time
+        t = grid_ts - self.recording.options.start_ts
+        expected = 2 + 0.5 * np.sin(2 * np.pi * t / 300) + 0.3 * self.recording.in_task(grid_ts)
+        steps = self.recording.task_intervals.ravel()
+        distance = np.abs(grid_ts[:, np.newaxis] - steps).min(axis=1)
+        eda = aligned.stream(STREAM_TYPES.brainvision_eda).channel("EDA")
+        usable = (distance > 0.1) & np.isfinite(eda)
+        self.assertGreater(usable.mean(), 0.95)
+        np.testing.assert_allclose(eda[usable], expected[usable], atol=0.03)
+
+    def test_periods(self):
+        markers = self.R.read_markers()
+        condition_labels = [cond.value for cond in self.R.condition_order()]
+        eeg_ts = self.R.read_time_stamps(STREAM_TYPES.g_tec)
+        eeg_slices = period_slices(eeg_ts, markers, condition_labels)
+
+        periods = list(self.aligned.periods(markers, condition_labels))
+        self.assertEqual([label for label, _ in periods], list(eeg_slices.labels))
+        for (label, period), (_, offsets) in zip(periods, eeg_slices.items()):
+            with self.subTest(period=label):
+                self.assertEqual(period.channels, self.aligned.store.channels)
+                np.testing.assert_allclose(period.time_stamps, eeg_ts[offsets])
+                self.assertFalse(np.isnan(period.samples).any())
+
+
+class MissingStreamTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        root = pathlib.Path(self.tmp_dir.name)
+        generate_subject(root, "ABC12", SyntheticOptions(duration_s=60), xdf=False, parquet=True)
+        self.R = Recording(root / "ABC12")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_session_without_eye_tracking(self):
+        self.R.eye_tracking_path().unlink()
+        with self.assertLogs(align.logger, "WARNING") as logs:
+            aligned = align.align_recording(self.R)
+        self.assertIn(STREAM_TYPES.eye_tracking, logs.output[0])
+        streams = [STREAM_TYPES.brainvision_eda, STREAM_TYPES.g_tec]
+        self.assertEqual(list(aligned.clocks), streams)
+        expected = [
+            align.stream_channel(stream_type, channel)
+            for stream_type in streams
+            for channel in self.R.stream_channels(stream_type)
+        ]
+        self.assertEqual(aligned.store.channels, expected)
+        eeg_ts = self.R.read_time_stamps(STREAM_TYPES.g_tec)
+        self.assertEqual(aligned.store.time_stamps[-1], eeg_ts[-1])
+
+    def test_too_short_stream(self):
+        path = self.R.eye_tracking_path()
+        pd.read_parquet(path).iloc[:1].to_parquet(path)
+        with self.assertLogs(align.logger, "WARNING"):
+            aligned = align.align_recording(self.R)
+        self.assertNotIn(STREAM_TYPES.eye_tracking, aligned.clocks)
+        with self.assertRaisesRegex(ValueError, STREAM_TYPES.eye_tracking):
+            align.align_recording(self.R, stream_types=[STREAM_TYPES.eye_tracking])
+
+
+if __name__ == "__main__":
+    unittest.main()
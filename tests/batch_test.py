@@ -0,0 +1,71 @@
+import os
+import pathlib
+import tempfile
+import unittest
+from unittest import mock
+
+from processing import batch, ecg_process
+from processing.batch import BatchOptions, Stage, Status, Subject
+from processing.shared import profiling
+from processing.shared.recording import Recording
+
+
+class BatchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.directory = pathlib.Path(self.tmp_dir.name) / "ABC12"
+        self.directory.mkdir()
+        self.marker_path = self.directory / "ABC12_marker.parquet"
+        self.ecg_path = self.directory / "ABC12_brainvision.parquet"
+        for path in (self.marker_path, self.ecg_path):
+            path.write_bytes(b"stream")
+            os.utime(path, (1000, 1000))
+        self.subject = Subject(self.directory, [])
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write_result(self, mtime):
+        path = ecg_process.result_path(Recording(self.directory))
+        path.parent.mkdir(exist_ok=True)
+        path.write_text("vp_code\n")
+        os.utime(path, (mtime, mtime))
+
+    def test_up_to_date(self):
+        self.assertFalse(batch.is_up_to_date(Stage.ECG, self.subject))
+        self.write_result(2000)
+        self.assertTrue(batch.is_up_to_date(Stage.ECG, self.subject))
+
+        os.utime(self.ecg_path, (3000, 3000))
+        self.assertFalse(batch.is_up_to_date(Stage.ECG, self.subject))
+
+        # Missing inputs of the EEG stage
+        self.assertFalse(batch.is_up_to_date(Stage.EEG, self.subject))
+        # Exports without XDF files need no conversion
+        self.assertTrue(batch.is_up_to_date(Stage.CONVERT, self.subject))
+
+    def test_failure_isolation(self):
+        def run_stage(stage, subject, options):
+            if stage is failing:
+                raise RuntimeError("broken")
+
+        options = BatchOptions(force=True)
+        with mock.patch.object(batch, "run_stage", run_stage), mock.patch.object(batch, "logger"):
+            failing = Stage.ECG
+            statuses = [result.status for result in batch.process_subject(self.subject, options)]
+            self.assertEqual(statuses, [Status.DONE, Status.FAILED, Status.DONE])
+
+            failing = Stage.CONVERT
+            results = batch.process_subject(self.subject, options)
+            self.assertEqual(
+                [result.status for result in results],
+                [Status.FAILED, Status.BLOCKED, Status.BLOCKED],
+            )
+            self.assertEqual(results[0].message, "RuntimeError: broken")
+
+        profile = profiling.read_profile(batch.profile_path(self.subject))
+        self.assertEqual([span["path"] for span in profile["spans"]], ["convert"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+import os
+import pathlib
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from processing.shared.cache import CACHE_DIR_NAME, StageCache
+
+
+class StageCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.root = pathlib.Path(self.tmp_dir.name)
+        self.input_path = self.root / "ABC12_gtec.parquet"
+        self.input_path.write_bytes(b"samples")
+        self.calls = 0
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def compute(self):
+        self.calls += 1
+        return {"values": np.arange(1000, dtype=float) * self.calls}
+
+    def cache(self, **kwargs):
+        return StageCache.for_recording(self.root, [self.input_path], **kwargs)
+
+    def test_hit_and_miss(self):
+        first = self.cache().cached("stage", {"n": 1}, self.compute)
+        second = self.cache().cached("stage", {"n": 1}, self.compute)
+        np.testing.assert_array_equal(first["values"], second["values"])
+        self.assertEqual(self.calls, 1)
+        self.assertTrue((self.root / CACHE_DIR_NAME).is_dir())
+
+        self.cache().cached("stage", {"n": 2}, self.compute)
+        self.cache().cached("other_stage", {"n": 1}, self.compute)
+        self.assertEqual(self.calls, 3)
+
+    def test_evicted_while_loading(self):
+        cache = self.cache()
+        cache.cached("stage", {}, self.compute)
+        # Another worker evicts the entry between reading and touching it
+        def evict(path):
+            os.remove(path)
+            raise FileNotFoundError(path)
+
+        with mock.patch("processing.shared.cache.os.utime", side_effect=evict):
+            arrays = cache.load("stage", {})
+        np.testing.assert_array_equal(arrays["values"], np.arange(1000))
+
+    def test_changed_input(self):
+        self.cache().cached("stage", {}, self.compute)
+        self.input_path.write_bytes(b"other samples")
+        self.cache().cached("stage", {}, self.compute)
+        self.assertEqual(self.calls, 2)
+
+    def test_lru_eviction(self):
+        # Fits three entries of about 8 kB each
+        cache = self.cache(max_bytes=30_000)
+        for n in range(3):
+            cache.cached("stage", {"n": n}, self.compute)
+            os.utime(cache.entry_path("stage", {"n": n}), (n, n))
+        cache.load("stage", {"n": 0})
+        cache.cached("stage", {"n": 3}, self.compute)
+        self.assertEqual(len(cache.entries()), 3)
+        self.assertIsNotNone(cache.load("stage", {"n": 0}))
+        self.assertIsNone(cache.load("stage", {"n": 1}))
+
+    def test_clear(self):
+        cache = self.cache()
+        cache.cached("stage", {}, self.compute)
+        cache.clear()
+        self.assertEqual(cache.entries(), [])
+        cache.cached("stage", {}, self.compute)
+        self.assertEqual(self.calls, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,43 @@
+import unittest
+
+import mne
+import numpy as np
+
+from processing.chunked_filter import FILTER_RTOL, ChunkedFIRFilter, bandpass_fir
+
+
+class ChunkedFIRFilterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.sfreq = 256.0
+        self.fir = ChunkedFIRFilter(bandpass_fir(self.sfreq, 1.0, 48.0))
+
+    def assertMatchesMNE(self, signal, filtered):
+        expected = mne.filter.filter_data(
+            signal, self.sfreq, 1.0, 48.0, method="fir", phase="zero",
+            fir_window="hamming", fir_design="firwin", verbose=False,
+        )
+        np.testing.assert_allclose(
+            filtered, expected, rtol=0, atol=FILTER_RTOL * np.abs(signal).max()
+        )
+
+    def test_block_sizes(self):
+        rng = np.random.default_rng(0)
+        signal = 1e-4 + 1e-5 * rng.normal(size=(3, 256 * 20 + 11))
+        for block_samples in (100, 257, 5000, signal.shape[-1]):
+            self.assertMatchesMNE(signal, self.fir.apply(signal, block_samples))
+
+    def test_signal_shorter_than_filter(self):
+        signal = np.random.default_rng(1).normal(size=(2, self.fir.half - 20))
+        with self.assertWarns(RuntimeWarning):
+            self.assertMatchesMNE(signal, self.fir.apply(signal, 100))
+
+    def test_rows(self):
+        signal = np.random.default_rng(2).normal(size=(4, 3000))
+        blocks = list(self.fir.iter_blocks(signal, 1000, rows=[3, 1]))
+        self.assertEqual([start for start, _ in blocks], [0, 1000, 2000])
+        filtered = np.concatenate([block for _, block in blocks], axis=-1)
+        np.testing.assert_allclose(filtered, self.fir.apply(signal)[[3, 1]], atol=1e-12)
+
+
+if __name__ == "__main__":
+    unittest.main()
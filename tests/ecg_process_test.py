@@ -0,0 +1,91 @@
+import pathlib
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+from click.testing import CliRunner
+
+from processing import ecg_process
+from processing.ecg_rpeaks import RPeakOptions
+from processing.synthetic import SyntheticOptions, generate_subject
+from processing.shared.recording import Recording
+from processing.shared.select_data import PeriodSlices
+from processing.shared.streams import STREAM_TYPES
+
+OPTIONS = RPeakOptions(detector="pantompkins")
+
+
+class DetectOnceTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.TemporaryDirectory()
+        root = pathlib.Path(cls.tmp_dir.name)
+        generate_subject(root, "ABC12", SyntheticOptions(duration_s=120), xdf=False, parquet=True)
+        cls.R = Recording(root / "ABC12")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp_dir.cleanup()
+
+    def results(self, detect_once):
+        _, slices, collect_results = ecg_process.submit_folder(
+            self.R.directory, detect_once=detect_once, options=OPTIONS
+        )
+        return pd.DataFrame(collect_results(), index=slices.labels)
+
+    def test_matches_per_period(self):
+        once = self.results(detect_once=True)
+        per_period = self.results(detect_once=False)
+        self.assertEqual(len(once), 3 * 8)
+        self.assertFalse(once.isna().any(axis=None))
+        # Per period, beats right at the period boundaries can be missed
+        np.testing.assert_allclose(once.hr_mean, per_period.hr_mean, rtol=0.05)
+        same = np.isclose(once, per_period).all(axis=1)
+        self.assertGreater(same.mean(), 0.8)
+
+    def test_empty_periods(self):
+        data = self.R.read_stream(STREAM_TYPES.brainvision_eda, columns=[ecg_process.ECG_CHANNEL])
+        num_samples = len(data)
+        # The second period lies after the end of the recording
+        labels = pd.MultiIndex.from_tuples([(0, "first"), (1, "after")])
+        slices = PeriodSlices(
+            labels, np.array([0, num_samples]), np.array([num_samples // 2, num_samples])
+        )
+        first, after = ecg_process.process_ecg_once(data[ecg_process.ECG_CHANNEL], slices, OPTIONS)
+        self.assertGreater(first.hr_mean, 60)
+        self.assertTrue(after.isna().all())
+        self.assertEqual(list(after.index), list(ecg_process.RESULT_COLUMNS.values()))
+
+
+class JobsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.root = pathlib.Path(self.tmp_dir.name)
+        self.folders = [self.root / "ABC12", self.root / "DEF34"]
+        for seed, folder in enumerate(self.folders):
+            options = SyntheticOptions(duration_s=90, seed=seed)
+            generate_subject(self.root, folder.name, options, xdf=False, parquet=True)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def run_main(self, *args):
+        folders = [str(folder) for folder in self.folders]
+        args = ["--detector", "pantompkins", "--no-cache", "--quiet", *args, *folders]
+        result = CliRunner().invoke(ecg_process.main, args)
+        self.assertEqual(result.exit_code, 0, result.output)
+        return [pd.read_csv(ecg_process.result_path(Recording(folder))) for folder in self.folders]
+
+    def test_pool_matches_serial(self):
+        for args in ([], ["--detect-once"]):
+            with self.subTest(args=args):
+                serial = self.run_main("--jobs", "1", *args)
+                pooled = self.run_main("--jobs", "2", *args)
+                for expected, frame in zip(serial, pooled):
+                    self.assertEqual(len(frame), 3 * 8)
+                    pd.testing.assert_frame_equal(frame, expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
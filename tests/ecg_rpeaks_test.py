@@ -0,0 +1,64 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from processing import ecg_process, ecg_rpeaks
+from processing.ecg_rpeaks import RPeakOptions
+from processing.synthetic import SyntheticOptions, SyntheticRecording
+
+
+class RPeakDetectionTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        recording = SyntheticRecording(SyntheticOptions(duration_s=120))
+        cls.time_stamps, cls.signal = recording.ecg_signal()
+        cls.beats = recording.rpeak_ts
+
+    def assertDetected(self, rpeak_ts, tolerance_s):
+        self.assertEqual(rpeak_ts.size, self.beats.size)
+        np.testing.assert_allclose(rpeak_ts, self.beats, atol=tolerance_s)
+
+    def test_infer_sampling_rate(self):
+        jittered = self.time_stamps.copy()
+        jittered[::100] += 1e-4
+        self.assertAlmostEqual(ecg_rpeaks.infer_sampling_rate(jittered), 1000, places=3)
+
+    def test_pan_tompkins(self):
+        options = RPeakOptions(detector="pantompkins")
+        rpeak_ts = ecg_rpeaks.detect_rpeaks(self.signal, self.time_stamps, options)
+        self.assertDetected(rpeak_ts, 0.005)
+
+    def test_default_detector(self):
+        # Without the optional neurokit and biosppy packages
+        rpeak_ts = ecg_rpeaks.detect_rpeaks(self.signal, self.time_stamps)
+        self.assertDetected(rpeak_ts, 0.005)
+
+    def test_decimated(self):
+        for detector in ("pantompkins", "hamilton"):
+            options = RPeakOptions(detector=detector, decimate=4)
+            rpeak_ts = ecg_rpeaks.detect_rpeaks(self.signal, self.time_stamps, options)
+            self.assertDetected(rpeak_ts, 0.008)
+
+    def test_rate_too_low(self):
+        options = RPeakOptions(detector="pantompkins", sampling_rate=250, decimate=4)
+        with self.assertRaises(ValueError):
+            ecg_rpeaks.detect_rpeaks(self.signal, self.time_stamps, options)
+
+
+class ProcessECGTestCase(unittest.TestCase):
+    def test_periods_without_rpeaks(self):
+        options = RPeakOptions(detector="pantompkins", sampling_rate=1000)
+        time_stamps = np.arange(5000) / 1000
+        for data in (
+            pd.Series(np.zeros(5000), index=time_stamps, name="ECG"),
+            pd.Series([], index=time_stamps[:0], name="ECG", dtype=float),
+        ):
+            with self.subTest(samples=len(data)):
+                stats = ecg_process.process_ecg(data, options)
+                self.assertEqual(list(stats.index), list(ecg_process.RESULT_COLUMNS.values()))
+                self.assertTrue(stats.isna().all())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+import unittest
+
+import numpy as np
+
+from processing import hrv
+
+
+def _reference(rpeak_ts, start, stop):
+    peaks = rpeak_ts[(rpeak_ts >= start) & (rpeak_ts <= stop)]
+    rr = np.diff(peaks) * 1000
+    diffs = np.diff(rr)
+    return {
+        "num_rr": rr.size,
+        "mean_rr": rr.mean(),
+        "hr_mean": 60_000 / rr.mean(),
+        "sdnn": rr.std(ddof=1),
+        "rmssd": np.sqrt(np.mean(diffs ** 2)),
+        "sdsd": diffs.std(ddof=1),
+        "pnn50": 100 * np.mean(np.abs(diffs) > 50),
+    }
+
+
+class HRVTestCase(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        rr_s = 0.8 + 0.1 * np.sin(np.arange(2000) / 10) + rng.normal(0, 0.03, 2000)
+        # Absolute time stamps like in LSL recordings
+        self.rpeak_ts = 350_000 + np.cumsum(rr_s)
+
+    def test_matches_direct_computation(self):
+        starts = self.rpeak_ts[0] + np.array([0, 100, 333.3, 900])
+        stops = starts + np.array([60, 250, 10, 600])
+        result = hrv.hrv_windows(self.rpeak_ts, starts, stops)
+        for idx, (start, stop) in enumerate(zip(starts, stops)):
+            expected = _reference(self.rpeak_ts, start, stop)
+            for metric, value in expected.items():
+                self.assertAlmostEqual(result[metric].iloc[idx], value, places=6, msg=metric)
+
+    def test_too_few_beats(self):
+        first, second = self.rpeak_ts[:2]
+        result = hrv.hrv_windows(
+            self.rpeak_ts, [first - 10, first, first], [first - 5, first, second]
+        )
+        self.assertEqual(result["num_rr"].tolist(), [0, 0, 1])
+        self.assertTrue(result["hr_mean"].iloc[:2].isna().all())
+        self.assertAlmostEqual(result["mean_rr"].iloc[2], (second - first) * 1000)
+        self.assertTrue(result[["sdnn", "rmssd", "sdsd", "pnn50"]].isna().all(axis=None))
+
+    def test_windows_at_the_end(self):
+        rpeak_ts = np.arange(0, 100, 0.8)
+        # After the last beat, exactly the last beat, and the last interval
+        starts = [99.5, rpeak_ts[-1], rpeak_ts[-2], 10]
+        stops = [100, 100, 100, 20]
+        result = hrv.hrv_windows(rpeak_ts, starts, stops)
+        self.assertEqual(result["num_rr"].tolist(), [0, 0, 1, 12])
+        self.assertTrue(result["hr_mean"].iloc[:2].isna().all())
+        self.assertAlmostEqual(result["mean_rr"].iloc[2], 800)
+        self.assertTrue(np.isnan(result["rmssd"].iloc[2]))
+        self.assertAlmostEqual(result["hr_mean"].iloc[3], 75)
+
+    def test_sliding_windows(self):
+        starts, stops = hrv.sliding_windows(0, 100, 60, 5)
+        np.testing.assert_allclose(starts, np.arange(0, 45, 5))
+        np.testing.assert_allclose(stops - starts, 60)
+
+        result = hrv.hrv_sliding(self.rpeak_ts, width_s=60, hop_s=5)
+        self.assertEqual(result.index[0], self.rpeak_ts[0])
+        self.assertLessEqual(result.index[-1] + 60, self.rpeak_ts[-1])
+        expected = _reference(self.rpeak_ts, result.index[7], result.index[7] + 60)
+        self.assertAlmostEqual(result["sdnn"].iloc[7], expected["sdnn"], places=6)
+
+
+if __name__ == "__main__":
+    unittest.main()
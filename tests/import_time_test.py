@@ -0,0 +1,89 @@
+import json
+import pathlib
+import subprocess
+import sys
+import time
+import unittest
+
+from processing.shared import backends
+
+ROOT = pathlib.Path(__file__).parents[1]
+
+# Import time budgets in s. pandas and pyarrow alone take about half a
+# second, the budgets leave room for slow machines, but not for mne or
+# scipy.signal, which add another two seconds.
+PACKAGE_BUDGET_S = 0.5
+CLI_BUDGET_S = 2.0
+
+CLI_MODULES = [
+    "processing.shared.xdf_convert",
+    "processing.batch",
+    "processing.ecg_process",
+    "processing.eeg_freq",
+    "processing.online",
+    "processing.pupil_process",
+    "processing.shared.align",
+]
+
+IMPORT_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+from processing.shared import backends
+print(json.dumps({{"seconds": seconds, "backends": backends.loaded()}}))
+"""
+
+
+def import_in_fresh_process(module):
+    result = subprocess.run(
+        [sys.executable, "-c", IMPORT_SCRIPT.format(module=module)],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(result.stdout)
+
+
+class ImportTimeTestCase(unittest.TestCase):
+    def test_package(self):
+        result = import_in_fresh_process("processing")
+        self.assertLess(result["seconds"], PACKAGE_BUDGET_S)
+
+    def test_cli_modules(self):
+        for module in CLI_MODULES:
+            with self.subTest(module=module):
+                result = import_in_fresh_process(module)
+                self.assertEqual(result["backends"], [])
+                self.assertLess(result["seconds"], CLI_BUDGET_S)
+
+    def test_conversion_help(self):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, "-m", "processing.shared.xdf_convert", "--help"],
+            cwd=ROOT,
+            capture_output=True,
+            check=True,
+        )
+        self.assertLess(time.perf_counter() - start, CLI_BUDGET_S)
+
+
+class BackendsTestCase(unittest.TestCase):
+    def test_registry(self):
+        self.assertEqual(backends.backend("biosppy.signals.ecg").package, "biosppy")
+        with self.assertRaises(KeyError):
+            backends.lazy("pandas")
+
+        missing = backends.lazy("neurokit.missing_module")
+        with self.assertRaisesRegex(ImportError, "install the package neurokit"):
+            missing.ecg_preprocess
+
+    def test_lazy_module(self):
+        signal = backends.lazy("scipy.signal")
+        self.assertEqual(signal.__name__, "scipy.signal")
+        self.assertIs(signal.butter, backends.load("scipy.signal").butter)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+import pathlib
+import tempfile
+import unittest
+
+from click.testing import CliRunner
+
+from processing.shared.manifest import Manifest
+from processing.shared.xdf_convert import xdf_convert
+from processing.shared.recording import Recording
+from processing.shared.streams import STREAM_TYPES
+
+
+class ManifestTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.root = pathlib.Path(self.tmp_dir.name)
+        self.directory = self.root / "ABC12"
+        self.directory.mkdir()
+        self.xdf_path = self.directory / "sub-ABC12_run-001_eeg.xdf"
+        self.xdf_path.write_bytes(b"XDF:")
+        (self.directory / "ABC12_gtec.parquet").write_bytes(b"eeg")
+        (self.directory / "ABC12_marker.parquet").write_bytes(b"markers")
+
+        manifest = Manifest.load(self.root)
+        manifest.update_recording(self.directory, [self.xdf_path], {"format": ".parquet"})
+        manifest.save()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_recording_paths(self):
+        recording, = Recording.from_manifest(self.root)
+        self.assertEqual(recording.vp_code, "ABC12")
+        self.assertEqual(recording.eeg_path(), self.directory / "ABC12_gtec.parquet")
+        self.assertIsNone(recording.ecg_path())
+        self.assertIsNone(recording.sample_store_path(STREAM_TYPES.g_tec))
+
+    def test_is_up_to_date(self):
+        manifest = Manifest.load(self.root)
+        self.assertTrue(manifest.is_up_to_date([self.xdf_path], {"format": ".parquet"}))
+        self.assertFalse(manifest.is_up_to_date([self.xdf_path], {"format": ".csv"}))
+
+        self.xdf_path.write_bytes(b"XDF:changed")
+        self.assertFalse(manifest.is_up_to_date([self.xdf_path], {"format": ".parquet"}))
+
+    def test_missing_output(self):
+        (self.directory / "ABC12_gtec.parquet").unlink()
+        manifest = Manifest.load(self.root)
+        self.assertFalse(manifest.is_up_to_date([self.xdf_path], {"format": ".parquet"}))
+
+    def test_folder_outside_root(self):
+        with tempfile.TemporaryDirectory() as other:
+            xdf_path = pathlib.Path(other) / "sub-DEF34_run-001_eeg.xdf"
+            xdf_path.write_bytes(b"XDF:")
+            self.assertFalse(Manifest.load(self.root).contains(xdf_path.parent))
+            result = CliRunner().invoke(
+                xdf_convert, ["--manifest", str(self.root), str(xdf_path)]
+            )
+        self.assertEqual(result.exit_code, 2)
+        self.assertIn("outside of the manifest root", result.output)
+        self.assertTrue(Manifest.load(self.root).contains(self.directory))
+
+
+if __name__ == "__main__":
+    unittest.main()
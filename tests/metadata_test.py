@@ -0,0 +1,75 @@
+import os
+import pathlib
+import tempfile
+import unittest
+from unittest import mock
+
+import pandas as pd
+
+from processing.shared import metadata
+from processing.shared.metadata import Condition, ConditionOrder, SubjectRegistry
+from processing.shared.recording import Recording
+from processing.shared.streams import STREAM_TYPES
+
+
+class SubjectRegistryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.data_dir = pathlib.Path(self.tmp_dir.name)
+        self.conditions_path = self.data_dir / metadata.CONDITION_LOOKUP_NAME
+        self.conditions_path.write_text(
+            "VP-Code,Block0,Block1,Block2\n"
+            "ABC12,hard,control,easy\n"
+            "01234,easy,hard,control\n"
+        )
+        (self.data_dir / metadata.BADS_LOOKUP_NAME).write_text(
+            "VP-Code,Bad\nABC12,F3\nABC12,F4\n01234,Cz\n\n\n"
+        )
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_lookup(self):
+        registry = SubjectRegistry(self.data_dir)
+        self.assertEqual(
+            registry.condition_order("01234"),
+            ConditionOrder(Condition.E, Condition.H, Condition.C),
+        )
+        with self.assertRaises(KeyError):
+            registry.condition_order("1234")
+        self.assertEqual(registry.bads("ABC12"), ["F3", "F4"])
+        self.assertEqual(registry.bads("GHI56"), [])
+        # The sampling rate table is optional
+        self.assertIsNone(registry.sampling_rate("ABC12", STREAM_TYPES.brainvision_eda))
+
+        (self.data_dir / metadata.SAMPLING_RATE_LOOKUP_NAME).write_text(
+            f"VP-Code,Stream,Sampling Rate\nABC12,{STREAM_TYPES.brainvision_eda},500\n"
+        )
+        R = Recording(self.data_dir / "ABC12", registry=registry)
+        self.assertEqual(R.sampling_rate(STREAM_TYPES.brainvision_eda), 500.0)
+        self.assertIsNone(R.sampling_rate(STREAM_TYPES.g_tec))
+        self.assertEqual(R.condition_order().block0, Condition.H)
+
+    def test_reload_on_change(self):
+        registry = SubjectRegistry(self.data_dir)
+        with mock.patch.object(metadata.pd, "read_csv", wraps=pd.read_csv) as read_csv:
+            for _ in range(3):
+                registry.condition_order("ABC12")
+            self.assertEqual(read_csv.call_count, 1)
+
+            self.conditions_path.write_text(
+                "VP-Code,Block0,Block1,Block2\nABC12,easy,control,hard\n"
+            )
+            stat = self.conditions_path.stat()
+            os.utime(self.conditions_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+            self.assertEqual(registry.condition_order("ABC12").block0, Condition.E)
+            self.assertEqual(read_csv.call_count, 2)
+
+    def test_default_tables(self):
+        registry = metadata.default_registry()
+        self.assertEqual(registry.bads("ABC12"), ["F3", "F4"])
+        self.assertEqual(registry.condition_order("DEF34").block0, Condition.C)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,151 @@
+import pathlib
+import tempfile
+import unittest
+import warnings
+
+import numpy as np
+import scipy.signal
+
+from processing import ecg_rpeaks, online
+from processing.online import OnlineBandPower, OnlineEngine, OnlineHRV, RingBuffer
+from processing.shared.streams import STREAM_TYPES
+from processing.shared.xdf_stream import XDFWriter
+from processing.spectral import BandPowerAccumulator
+from processing.synthetic import SyntheticOptions, SyntheticRecording
+
+
+def _ecg(duration_s, sampling_rate):
+    recording = SyntheticRecording(SyntheticOptions(duration_s=max(duration_s, 60), start_ts=100))
+    time_stamps, signal = recording.ecg_signal(sampling_rate)
+    num_samples = int(duration_s * sampling_rate)
+    return time_stamps[:num_samples], signal[:num_samples]
+
+
+def _write_xdf(path, ecg_ts, ecg, marker_ts):
+    with XDFWriter(path) as writer:
+        ecg_id = writer.add_stream(STREAM_TYPES.brainvision_eda, "double64", ["ECG"], 250)
+        marker_id = writer.add_stream(STREAM_TYPES.marker, "string", channel_count=1)
+        for start in range(0, ecg_ts.size, 250):
+            writer.write_samples(ecg_id, ecg_ts[start : start + 250], ecg[start : start + 250])
+            if ecg_ts[start] in marker_ts:
+                marker = f"marker_{ecg_ts[start]:.0f}"
+                writer.write_samples(marker_id, ecg_ts[start : start + 1], [[marker]])
+
+
+class RingBufferTestCase(unittest.TestCase):
+    def test_wrap_around(self):
+        buffer = RingBuffer(5, num_channels=2)
+        values = np.arange(16).reshape(8, 2)
+        buffer.extend(np.arange(3), values[:3])
+        buffer.extend(np.arange(3, 6), values[3:6])
+        time_stamps, samples = buffer.latest()
+        np.testing.assert_array_equal(time_stamps, np.arange(1, 6))
+        np.testing.assert_array_equal(samples, values[1:6].T)
+
+        # Chunks larger than the buffer only keep their end
+        buffer.extend(np.arange(6, 14), np.arange(16).reshape(8, 2))
+        self.assertEqual(buffer.total, 14)
+        self.assertEqual(buffer.last_time_stamp, 13)
+        time_stamps, samples = buffer.since(11.5)
+        np.testing.assert_array_equal(time_stamps, [12, 13])
+        np.testing.assert_array_equal(samples, [[12, 14], [13, 15]])
+
+
+class OnlineProcessingTestCase(unittest.TestCase):
+    def test_hrv_matches_offline_peaks(self):
+        time_stamps, signal = _ecg(120, 250)
+        processor = OnlineHRV(250, width_s=30, hop_s=5)
+        updates = []
+        for start in range(0, time_stamps.size, 37):
+            stop = start + 37
+            updates += processor.update(time_stamps[start:stop], signal[start:stop, np.newaxis])
+        self.assertEqual(len(updates), 23)
+        self.assertEqual(updates[-1][1]["num_rr"] + 1, len(processor.rpeak_ts))
+
+        offline = time_stamps[ecg_rpeaks.pan_tompkins_detector(signal, 250)]
+        online_peaks = np.array(processor.rpeak_ts)
+        last_window = offline[(offline >= updates[-1][0] - 30) & (offline < updates[-1][0])]
+        np.testing.assert_array_equal(online_peaks, last_window)
+
+    def test_band_power_matches_accumulator(self):
+        rng = np.random.default_rng(1)
+        num_samples = 256 * 40
+        t = np.arange(num_samples) / 256
+        samples = rng.normal(size=(2, num_samples)) + np.sin(2 * np.pi * 10 * t)
+        processor = OnlineBandPower(256, [0, 1], ["F3", "F4"], window_s=8, hop_s=4)
+        updates = []
+        for start in range(0, num_samples, 100):
+            updates += processor.update(t[start : start + 100], samples[:, start : start + 100].T)
+        self.assertEqual(len(updates), 10)
+        self.assertAlmostEqual(updates[0][0], 4 - processor.delay_s)
+
+        history = np.repeat(samples[:, :1], processor.h.size - 1, axis=-1)
+        filtered = scipy.signal.oaconvolve(
+            np.concatenate([history, samples], axis=-1),
+            processor.h[np.newaxis],
+            mode="valid",
+            axes=-1,
+        )
+        accumulator = BandPowerAccumulator(256)
+        accumulator.update(filtered)
+        expected = accumulator.result()[..., -8:].mean(axis=-1)
+        power = updates[-1][1].to_numpy().reshape(2, -1)
+        np.testing.assert_allclose(power, expected, rtol=1e-10)
+
+    def test_band_power_without_valid_segments(self):
+        rng = np.random.default_rng(2)
+        t = np.arange(256 * 20) / 256
+        samples = rng.normal(size=(t.size, 1))
+        # The stream starts with a dropout longer than the window
+        samples[: 256 * 10] = np.nan
+        processor = OnlineBandPower(256, [0], ["Fz"], window_s=8, hop_s=4)
+        updates = []
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            for start in range(0, t.size, 100):
+                updates += processor.update(t[start : start + 100], samples[start : start + 100])
+        self.assertTrue(updates[0][1].isna().all())
+        self.assertFalse(updates[-1][1].isna().any())
+
+
+class ReplayTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = pathlib.Path(self.tmp_dir.name) / "session.xdf"
+        self.time_stamps, self.signal = _ecg(30, 250)
+        _write_xdf(self.path, self.time_stamps, self.signal, marker_ts=[100, 115])
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_paced_replay(self):
+        now = [0.0]
+        sleeps = []
+
+        def sleep(delay):
+            sleeps.append(delay)
+            now[0] += delay
+
+        source = online.XDFReplaySource(self.path, speed=2, clock=lambda: now[0], sleep=sleep)
+        chunks = list(source)
+        self.assertEqual(len(chunks), 32)
+        streams = [chunk.stream for chunk in chunks]
+        self.assertEqual(streams.count(STREAM_TYPES.marker), 2)
+        # Only sample chunks that are ahead of the clock wait, markers are due right away
+        self.assertEqual(len(sleeps), 30)
+        # 30 s of recording at twice the speed
+        self.assertAlmostEqual(now[0], (self.time_stamps[-1] - self.time_stamps[0]) / 2)
+
+    def test_engine(self):
+        source = online.XDFReplaySource(self.path, speed=None)
+        engine = OnlineEngine.for_streams(source.headers(), online.OnlineOptions(hrv_width_s=10))
+        features = list(engine.process(source))
+        self.assertEqual(len(features), 5)
+        self.assertEqual(features[0].marker, "marker_100")
+        self.assertEqual(features[-1].marker, "marker_115")
+        self.assertGreater(features[-1].values["hr_mean"], 60)
+        self.assertEqual(engine.num_samples[STREAM_TYPES.brainvision_eda], self.time_stamps.size)
+
+
+if __name__ == "__main__":
+    unittest.main()
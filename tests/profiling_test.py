@@ -0,0 +1,69 @@
+import pathlib
+import tempfile
+import unittest
+
+from processing.shared import profiling
+from processing.shared.profiling import Profiler
+
+
+class ProfilerTestCase(unittest.TestCase):
+    def test_nested_spans(self):
+        with Profiler() as profiler:
+            with profiling.span("ecg"):
+                with profiling.span("load", samples=1000):
+                    pass
+                with profiling.span("detect_rpeaks") as span:
+                    span.samples = 500
+            with profiling.span("write"):
+                pass
+        # Inactive spans are not recorded
+        with profiling.span("ignored"):
+            pass
+
+        paths = [record.path for record in profiler.records]
+        self.assertEqual(paths, ["ecg/load", "ecg/detect_rpeaks", "ecg", "write"])
+        self.assertEqual([record.samples for record in profiler.records[:2]], [1000, 500])
+        self.assertIsNone(profiler.records[0].alloc_peak_mb)
+        ecg = profiler.records[2]
+        self.assertGreaterEqual(ecg.seconds, sum(record.seconds for record in profiler.records[:2]))
+        self.assertGreater(ecg.peak_rss_mb, 0)
+
+    def test_allocation_peak(self):
+        with Profiler(track_allocations=True) as profiler:
+            with profiling.span("outer"):
+                with profiling.span("allocate"):
+                    buffer = bytearray(20 * profiling.MB)
+                    del buffer
+                with profiling.span("idle"):
+                    pass
+        allocate, idle, outer = profiler.records
+        self.assertGreater(allocate.alloc_peak_mb, 19)
+        self.assertLess(idle.alloc_peak_mb, 1)
+        # The peak of a span includes the peaks of its children
+        self.assertGreater(outer.alloc_peak_mb, 19)
+
+    def test_aggregate(self):
+        profiles = []
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for vp_code, seconds in (("ABC12", 1.0), ("DEF34", 3.0)):
+                profiler = Profiler()
+                profiler.records = [
+                    profiling.SpanRecord("ecg", 0.0, seconds + 1, None, 100.0, 0.0, None),
+                    profiling.SpanRecord("ecg/detect_rpeaks", 0.0, seconds, 1000, 100.0, 0.0, None),
+                ]
+                path = profiling.profile_path(pathlib.Path(tmp_dir), vp_code, "batch")
+                profiler.write(path, vp_code=vp_code)
+                profiles.append(profiling.read_profile(path))
+        self.assertEqual(profiles[0]["vp_code"], "ABC12")
+
+        stats = profiling.aggregate(profiles)
+        self.assertEqual(list(stats.index), ["ecg", "ecg/detect_rpeaks"])
+        detect = stats.loc["ecg/detect_rpeaks"]
+        self.assertEqual(detect["subjects"], 2)
+        self.assertEqual(detect["total_s"], 4.0)
+        self.assertEqual(detect["samples_per_s"], 500.0)
+        self.assertIn("ecg/detect_rpeaks", profiling.format_hot_spans(stats))
+
+
+if __name__ == "__main__":
+    unittest.main()
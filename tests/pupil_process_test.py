@@ -0,0 +1,121 @@
+import pathlib
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from processing import pupil_process
+from processing.pupil_process import PupilOptions
+from processing.synthetic import PUPIL_RATE, SyntheticOptions, generate_subject
+from processing.shared.recording import Recording
+from processing.shared.sample_store import SampleStore
+from processing.shared.select_data import period_slices
+from processing.shared.streams import STREAM_TYPES
+
+CHANNELS = [pupil_process.CONFIDENCE_CHANNEL, *pupil_process.DIAMETER_CHANNELS["3d"]]
+
+
+class CleanPupilTestCase(unittest.TestCase):
+    def test_blinks_and_gaps(self):
+        time_stamps = np.arange(1000) / 100
+        confidence = np.ones(1000)
+        diameters = np.tile(3 + time_stamps / 10, (2, 1))
+        # A blink, a short dropout, a long gap and one eye without a pupil
+        confidence[200:220] = 0
+        confidence[400] = 0.2
+        confidence[600:800] = 0
+        diameters[1, 900:] = 0
+
+        options = PupilOptions(blink_margin_s=0.045)
+        cleaned = pupil_process.clean_pupil(time_stamps, confidence, diameters, options)
+        np.testing.assert_array_equal(np.flatnonzero(cleaned.blink_onsets), [200])
+        self.assertEqual((~cleaned.valid).sum(), 221)
+        # Gaps are widened by the blink margin of 4 samples
+        np.testing.assert_array_equal(
+            np.flatnonzero(cleaned.interpolated), [*range(196, 224), *range(396, 405)]
+        )
+        np.testing.assert_allclose(cleaned.diameter[190:410], 3 + time_stamps[190:410] / 10)
+        self.assertTrue(np.isnan(cleaned.diameter[596:804]).all())
+        np.testing.assert_allclose(cleaned.diameter[900:], diameters[0, 900:])
+
+    def test_chunks_match_whole_stream(self):
+        rng = np.random.default_rng(0)
+        time_stamps = np.cumsum(rng.uniform(0.005, 0.012, 5000))
+        confidence = np.where(rng.random(5000) < 0.02, 0.0, 0.9)
+        confidence[1000:1200] = 0
+        diameters = 3 + rng.standard_normal((2, 5000)) * 0.1
+        whole = pupil_process.clean_pupil(time_stamps, confidence, diameters)
+
+        samples = np.vstack([confidence, diameters])
+        chunks = (
+            SampleStore(samples[:, start : start + 77], time_stamps[start : start + 77], CHANNELS)
+            for start in range(0, 5000, 77)
+        )
+        ranges = list(pupil_process.iter_clean_chunks(chunks))
+        np.testing.assert_array_equal(np.concatenate([ts for ts, _ in ranges]), time_stamps)
+        for field in pupil_process.CleanPupil._fields:
+            chunked = np.concatenate([getattr(cleaned, field) for _, cleaned in ranges])
+            np.testing.assert_array_equal(chunked, getattr(whole, field), err_msg=field)
+
+
+class PupilProcessTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.TemporaryDirectory()
+        cls.root = pathlib.Path(cls.tmp_dir.name)
+        cls.recording = generate_subject(
+            cls.root, "ABC12", SyntheticOptions(duration_s=120), xdf=False, parquet=True
+        )
+        cls.R = Recording(cls.root / "ABC12")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp_dir.cleanup()
+
+    def test_period_stats(self):
+        path = pupil_process.process_folder(self.R.directory, chunk_samples=1000)
+        self.assertEqual(path, pupil_process.result_path(self.R))
+        results = pd.read_csv(path).set_index(["block", "period"])
+        self.assertEqual(len(results), 3 * 8)
+
+        time_stamps = self.R.read_time_stamps(STREAM_TYPES.eye_tracking)
+        condition_labels = [cond.value for cond in self.R.condition_order()]
+        slices = period_slices(time_stamps, self.R.read_markers(), condition_labels)
+        start_time = self.recording.start_time
+        # The synthetic diameter oscillates with the time since the first sample
+        first_ts = self.recording.options.start_ts
+        for label, offsets in slices.items():
+            with self.subTest(period=label):
+                row = results.loc[label]
+                period_ts = time_stamps[offsets] + start_time
+                _, values = self.recording.pupil(offsets.start, offsets.stop)
+                in_task = self.recording.in_task(period_ts)
+                phase = 2 * np.pi * (period_ts - first_ts) / 60
+                expected = 3.5 + 0.4 * in_task + 0.1 * np.sin(phase)
+                self.assertAlmostEqual(row.pupil_mean, expected.mean(), delta=0.01)
+                blinks = self.recording.blinks[:, 0]
+                in_period = (blinks > period_ts[0]) & (blinks < period_ts[-1])
+                self.assertEqual(row.blinks, in_period.sum())
+                self.assertAlmostEqual(row.valid_ratio, (values[:, 0] > 0).mean())
+
+    def test_sample_store_matches_parquet(self):
+        time_stamps = self.R.read_time_stamps(STREAM_TYPES.eye_tracking)
+        self.assertEqual(len(time_stamps), 120 * PUPIL_RATE)
+        slices = period_slices(time_stamps, self.R.read_markers())
+        from_parquet = pupil_process.period_pupil_stats(
+            self.R.iter_stream(STREAM_TYPES.eye_tracking, CHANNELS, 5000), time_stamps, slices
+        )
+        store = SampleStore.from_parquet(self.R.eye_tracking_path())
+        from_store = pupil_process.period_pupil_stats(
+            (store.slice(start, start + 300).select_channels(CHANNELS)
+             for start in range(0, len(store), 300)),
+            store.time_stamps,
+            slices,
+        )
+        pd.testing.assert_frame_equal(from_store, from_parquet, rtol=1e-9)
+        self.assertEqual(from_parquet.index.names, ["block", "period"])
+
+
+if __name__ == "__main__":
+    unittest.main()
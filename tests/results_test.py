@@ -0,0 +1,77 @@
+import concurrent.futures
+import pathlib
+import tempfile
+import unittest
+
+import pandas as pd
+
+from processing.shared import results
+from processing.shared.recording import Recording
+
+
+def _frame(vp_code, power=1.0):
+    return pd.DataFrame(
+        {
+            "vp_code": vp_code,
+            "block": ["hard", "hard", "easy"],
+            "period": ["baseline_h", "task_subblock_0", "baseline_h"],
+            "Freq Bands": ["Alpha", "Beta", "Alpha"],
+            "Power": [power, 2 * power, 3 * power],
+        }
+    )
+
+
+class ResultsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.root = pathlib.Path(self.tmp_dir.name) / "results"
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_round_trip(self):
+        vp_codes = ["ABC12", "01234", "DEF34"]
+
+        def write(vp_code):
+            return results.write_results(self.root, "eeg_freq", vp_code, _frame(vp_code))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+            paths = list(executor.map(write, vp_codes))
+        self.assertEqual(paths[1], results.partition_path(self.root, "eeg_freq", "01234"))
+
+        loaded = results.load_results(self.root, "eeg_freq")
+        self.assertEqual(list(loaded.columns), list(_frame("").columns))
+        self.assertEqual(sorted(loaded["vp_code"].unique()), sorted(vp_codes))
+        for column in ("vp_code", "block", "period", "Freq Bands"):
+            self.assertIsInstance(loaded[column].dtype, pd.CategoricalDtype, column)
+
+        selected = results.load_results(self.root, "eeg_freq", ["01234"], columns=["Power"])
+        self.assertEqual(list(selected.columns), ["vp_code", "Power"])
+        self.assertEqual(selected["Power"].tolist(), [1.0, 2.0, 3.0])
+
+    def test_replace(self):
+        results.write_results(self.root, "ecg", "ABC12", _frame("ABC12"))
+        path = results.write_results(self.root, "ecg", "ABC12", _frame("ABC12", 10.0))
+        # Leftovers of an interrupted writer are ignored
+        path.with_name(".part.123.tmp").write_bytes(b"partial")
+
+        loaded = results.load_results(self.root, "ecg")
+        self.assertEqual(loaded["Power"].tolist(), [10.0, 20.0, 30.0])
+        with self.assertRaises(FileNotFoundError):
+            results.load_results(self.root, "eeg_freq")
+
+
+    def test_subject_results(self):
+        R = Recording(pathlib.Path(self.tmp_dir.name) / "ABC12")
+        R.directory.mkdir()
+        path = results.write_subject_results(R, "ecg", _frame("ABC12"), "ecg_")
+        self.assertEqual(path, R.directory / "extracted_csv" / "ecg_ABC12.csv")
+        self.assertEqual(path, results.subject_result_path(R, "ecg", "ecg_"))
+        pd.testing.assert_frame_equal(pd.read_csv(path), _frame("ABC12"))
+
+        path = results.write_subject_results(R, "ecg", _frame("ABC12"), "ecg_", self.root)
+        self.assertEqual(path, results.subject_result_path(R, "ecg", "ecg_", self.root))
+        self.assertEqual(results.load_results(self.root, "ecg")["Power"].tolist(), [1.0, 2.0, 3.0])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,46 @@
+import pathlib
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from processing.shared.sample_store import SampleStore
+from processing.shared.select_data import select_from_data
+from processing.shared.markers_example import Periods
+
+
+class SampleStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        directory = pathlib.Path(self.tmp_dir.name)
+        index = pd.Index(np.arange(1000) / 100, name="time_stamps")
+        self.df = pd.DataFrame(
+            {"Cz": np.arange(1000.0), "Pz": -np.arange(1000.0), "label": "x"},
+            index=index,
+        )
+        self.df.to_parquet(directory / "ABC12_gtec.parquet")
+        self.store = SampleStore.from_parquet(directory / "ABC12_gtec.parquet", batch_rows=300)
+
+    def tearDown(self):
+        del self.store
+        self.tmp_dir.cleanup()
+
+    def test_roundtrip(self):
+        self.assertEqual(self.store.channels, ["Cz", "Pz"])
+        self.assertIsInstance(self.store.samples, np.memmap)
+        pd.testing.assert_frame_equal(self.store.to_frame(), self.df[["Cz", "Pz"]])
+
+    def test_loc_matches_pandas(self):
+        view = self.store.loc[1.005:2.0]
+        np.testing.assert_array_equal(view.channel("Cz"), self.df.Cz.loc[1.005:2.0])
+        self.assertTrue(np.shares_memory(view.samples, self.store.samples))
+
+    def test_select_from_data(self):
+        markers = pd.DataFrame({"id": [1, 10]}, index=[2.0, 3.0])
+        data_slice, _ = next(select_from_data(self.store, markers, Periods.block))
+        np.testing.assert_array_equal(data_slice.time_stamps, self.df.loc[2.0:3.0].index)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from processing.shared.markers_example import Markers, Periods
+from processing.shared.select_data import (
+    extract_periods,
+    period_slices,
+    select_data_around,
+    select_epochs_around,
+    select_from_data,
+)
+
+
+def _example_markers(num_blocks=3):
+    sequence = [
+        (Markers.block_start, 1.0),
+        (Markers.baseline_high_start, 3.3),
+        (Markers.baseline_high_end, 60.0),
+        (Markers.baseline_low_start, 2.0),
+        (Markers.baseline_low_end, 60.0),
+        (Markers.task_start, 2.0),
+        (Markers.stimulus_on, 1.0),
+        (Markers.response, 0.5),
+        (Markers.task_end, 150.0),
+        (Markers.block_end, 1.0),
+    ]
+    ids, time_stamps = [], []
+    ts = 0.0
+    for _ in range(num_blocks):
+        for marker, delta in sequence:
+            ts += delta
+            ids.append(marker.value)
+            time_stamps.append(ts)
+    return pd.DataFrame({"id": ids, "label": ""}, index=time_stamps)
+
+
+class PeriodSlicesTestCase(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(42)
+        time_stamps = np.cumsum(rng.uniform(0.005, 0.015, size=100_000))
+        index = pd.Index(time_stamps, name="time_stamps")
+        self.data = pd.DataFrame({"ECG": rng.normal(size=index.size)}, index=index)
+        self.markers = _example_markers()
+
+    def test_matches_extract_periods(self):
+        labels = ["hard", "control", "easy"]
+        slices = period_slices(self.data.index.values, self.markers, labels)
+
+        blocks = select_from_data(self.data, self.markers, Periods.block)
+        expected = pd.concat(
+            [extract_periods(block) for block in blocks], keys=labels, names=["block"]
+        )
+        self.assertEqual(len(slices.labels), 3 * 8)
+        for label, period_data in slices.take(self.data):
+            np.testing.assert_array_equal(
+                period_data.index.values, expected.loc[label].index.values
+            )
+
+    def test_task_without_samples(self):
+        time_stamps = self.data.index.values
+        task_markers = [Markers.task_start.value, Markers.task_end.value]
+        tasks = self.markers[self.markers.id.isin(task_markers)]
+        task_intervals = tasks.index.values.reshape(-1, 2)
+        # A dropout during the task of block 1, the recording ends before the
+        # task of block 2
+        dropout = (time_stamps >= task_intervals[1, 0]) & (time_stamps <= task_intervals[1, 1])
+        time_stamps = time_stamps[~dropout & (time_stamps < task_intervals[2, 0])]
+
+        slices = period_slices(time_stamps, self.markers)
+        lengths = pd.Series(slices.stop - slices.start, index=slices.labels)
+        self.assertTrue((lengths.loc[0] > 0).all())
+        for block in (1, 2):
+            self.assertTrue((lengths.loc[block].filter(like="task") == 0).all())
+            self.assertTrue((lengths.loc[block].filter(like="baseline") > 0).all())
+        self.assertTrue((slices.stop <= len(time_stamps)).all())
+
+    def test_views(self):
+        slices = period_slices(self.data.index.values, self.markers)
+        self.assertEqual(slices.labels[0], (0, "baseline_high"))
+        _, period_data = next(slices.take(self.data.ECG.values))
+        self.assertTrue(np.shares_memory(period_data, self.data.ECG.values))
+
+
+class EpochsTestCase(unittest.TestCase):
+    def setUp(self):
+        index = pd.Index(np.arange(0, 50, 0.01), name="time_stamps")
+        self.data = pd.DataFrame(
+            {"Cz": np.arange(index.size), "Pz": -np.arange(index.size)}, index=index
+        )
+        self.markers = pd.DataFrame(
+            {"id": Markers.stimulus_on.value}, index=[0.1, 10.0, 20.004, 49.9]
+        )
+
+    def test_matches_select_data_around(self):
+        epochs = select_epochs_around(self.data, self.markers, Markers.stimulus_on)
+        self.assertEqual(epochs.data.shape, (4, 71, 2))
+        expected = select_data_around(self.data, self.markers, Markers.stimulus_on)
+        for epoch, mask, expected_epoch in zip(epochs.data, epochs.mask, expected):
+            # Depending on rounding, the time based selection has one sample less
+            num_samples = len(expected_epoch)
+            self.assertLessEqual(abs(mask.sum() - num_samples), 1)
+            np.testing.assert_array_equal(epoch[mask][:num_samples], expected_epoch.values)
+
+    def test_edges_are_padded(self):
+        epochs = select_epochs_around(self.data, self.markers, Markers.stimulus_on)
+        self.assertEqual(epochs.mask[0].sum(), 61)
+        self.assertTrue(np.isnan(epochs.data[0, :10]).all())
+        self.assertEqual(epochs.mask[-1].sum(), 30)
+        np.testing.assert_allclose(epochs.times[[0, 20, -1]], [-0.2, 0.0, 0.5], atol=1e-9)
+
+
+if __name__ == "__main__":
+    unittest.main()
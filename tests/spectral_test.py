@@ -0,0 +1,68 @@
+import unittest
+
+import mne
+import numpy as np
+
+from processing.spectral import BandPowerAccumulator, band_bins, period_mean
+
+
+class BandPowerAccumulatorTestCase(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.sfreq = 256.0
+        self.signal = rng.normal(size=(3, 256 * 30 + 77))
+        self.signal += np.sin(2 * np.pi * 10 * np.arange(self.signal.shape[-1]) / self.sfreq)
+
+    def assertMatchesWelch(self, accumulator, **welch_kwargs):
+        psd, freqs = mne.time_frequency.psd_array_welch(
+            self.signal, self.sfreq, fmin=0, fmax=self.sfreq / 2,
+            average=None, verbose=False, **welch_kwargs,
+        )
+        np.testing.assert_array_equal(freqs, accumulator.freqs)
+        expected = np.stack(
+            [psd[:, start:stop].mean(axis=1) for start, stop in accumulator.band_bins], axis=1
+        )
+        np.testing.assert_allclose(accumulator.result(), expected, rtol=1e-10)
+
+    def test_chunked_updates(self):
+        accumulator = BandPowerAccumulator(self.sfreq, segments_per_chunk=4)
+        for chunk in np.array_split(self.signal, [100, 101, 3000, 5000], axis=1):
+            accumulator.update(chunk)
+        self.assertEqual(accumulator.result().shape, (3, 5, 30))
+        self.assertMatchesWelch(accumulator)
+        # The 10 Hz sine dominates the alpha band
+        self.assertEqual(accumulator.result().mean(axis=(0, 2)).argmax(), 2)
+
+    def test_overlap(self):
+        accumulator = BandPowerAccumulator(self.sfreq, n_fft=128, n_overlap=64)
+        accumulator.update(self.signal)
+        np.testing.assert_array_equal(
+            accumulator.segment_offsets(), np.arange(accumulator.num_segments) * 64
+        )
+        self.assertMatchesWelch(accumulator, n_fft=128, n_overlap=64)
+
+    def test_band_bins(self):
+        freqs = np.arange(129, dtype=float)
+        bins = band_bins(freqs, {"low": (0, 4), "high": (40, 60)}, fmin=1, fmax=48)
+        np.testing.assert_array_equal(bins, [[1, 4], [40, 49]])
+        with self.assertRaises(ValueError):
+            band_bins(freqs, {"empty": (50, 60)}, fmax=48)
+
+
+class PeriodMeanTestCase(unittest.TestCase):
+    def test_period_mean(self):
+        values = np.random.default_rng(0).normal(size=(3, 5, 100))
+        start = np.array([0, 10, 50, 40, 7])
+        stop = np.array([100, 20, 90, 40, 3])
+        means = period_mean(values, start, stop)
+        self.assertEqual(means.shape, (5, 3, 5))
+        for idx in range(3):
+            np.testing.assert_allclose(
+                means[idx], values[..., start[idx] : stop[idx]].mean(axis=-1)
+            )
+        # Empty periods
+        self.assertTrue(np.isnan(means[3:]).all())
+
+
+if __name__ == "__main__":
+    unittest.main()
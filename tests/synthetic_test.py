@@ -0,0 +1,92 @@
+import pathlib
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import pyxdf
+
+from processing import benchmark, ecg_rpeaks
+from processing.spectral import BandPowerAccumulator
+from processing.synthetic import SyntheticOptions, XDF_NAME, generate_subject
+from processing.shared.recording import Recording
+from processing.shared.select_data import period_slices
+from processing.shared.streams import FILE_SUFFIXES, STREAM_TYPES
+
+
+class SyntheticRecordingTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.TemporaryDirectory()
+        cls.root = pathlib.Path(cls.tmp_dir.name)
+        cls.recording = generate_subject(
+            cls.root, "ABC12", SyntheticOptions(duration_s=120), xdf=True, parquet=True
+        )
+        cls.R = Recording(cls.root / "ABC12")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp_dir.cleanup()
+
+    def test_periods(self):
+        data = self.R.read_stream(STREAM_TYPES.brainvision_eda)
+        self.assertEqual(len(data), 120_000)
+        slices = period_slices(data.index.values, self.R.read_markers())
+        self.assertEqual(len(slices.labels), 3 * 8)
+        self.assertTrue(all(stop > start for start, stop in zip(slices.start, slices.stop)))
+
+    def test_xdf_matches_parquet(self):
+        xdf_path = self.root / "ABC12" / XDF_NAME.format(vp_code="ABC12")
+        streams, _ = pyxdf.load_xdf(str(xdf_path))
+        streams = {stream["info"]["name"][0]: stream for stream in streams}
+        self.assertEqual(set(streams), set(FILE_SUFFIXES))
+
+        eeg = self.R.read_stream(STREAM_TYPES.g_tec)
+        np.testing.assert_array_equal(streams[STREAM_TYPES.g_tec]["time_series"], eeg.to_numpy())
+        np.testing.assert_allclose(
+            streams[STREAM_TYPES.g_tec]["time_stamps"] - self.recording.start_time,
+            eeg.index.to_numpy(),
+            atol=1e-9,
+        )
+        markers = streams[STREAM_TYPES.marker]["time_series"]
+        self.assertEqual([label for _, label in markers], list(self.recording.markers.label))
+
+    def test_known_rpeaks(self):
+        ecg = self.R.read_stream(STREAM_TYPES.brainvision_eda)
+        peaks = ecg_rpeaks.pan_tompkins_detector(ecg.ECG.to_numpy(), 1000)
+        detected_ts = ecg.index.to_numpy()[peaks] + self.recording.start_time
+        np.testing.assert_allclose(detected_ts, self.recording.rpeak_ts, atol=0.002)
+
+    def test_known_band_power(self):
+        eeg = self.R.read_stream(STREAM_TYPES.g_tec)
+        accumulator = BandPowerAccumulator(256)
+        accumulator.update(eeg.to_numpy().T.astype(np.float64))
+        expected = self.recording.expected_band_power()
+        np.testing.assert_allclose(accumulator.result().mean(axis=-1), expected, rtol=0.05)
+
+    def test_in_task(self):
+        task_start, task_end = self.recording.task_intervals[0]
+        in_task = self.recording.in_task(np.array([task_start - 1, task_start + 1, task_end + 1]))
+        np.testing.assert_array_equal(in_task, [False, True, False])
+
+
+class BenchmarkTestCase(unittest.TestCase):
+    def test_run_benchmarks(self):
+        with tempfile.TemporaryDirectory() as tmp_dir, mock.patch.dict(
+            benchmark.DURATIONS, {"2min": 120}
+        ):
+            results = list(
+                benchmark.run_benchmarks(
+                    "2min", ["period_slices", "select"], pathlib.Path(tmp_dir)
+                )
+            )
+        stages = [result.stage for result in results]
+        self.assertEqual(stages, ["generate", "select", "period_slices"])
+        self.assertEqual(results[-1].samples, 120_000)
+        self.assertGreaterEqual(results[-1].peak_rss_mb, results[-1].baseline_rss_mb)
+        entry = benchmark.history_entry(results[-1], "pantompkins", revision=None)
+        self.assertAlmostEqual(entry["realtime_factor"], 120 / results[-1].seconds)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,124 @@
+import pathlib
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from click.testing import CliRunner
+
+from processing.synthetic import XDF_NAME, SyntheticOptions, SyntheticRecording, generate_subject
+from processing.shared.recording import Recording
+from processing.shared.streams import STREAM_TYPES
+from processing.shared.xdf_convert import OutputFormat, export_stream, xdf_convert
+
+
+class ExportStreamTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.export_path = pathlib.Path(self.tmp_dir.name) / "ABC12_gtec.parquet"
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _split(self, start):
+        index = pd.Index([start, start + 0.5], name="time_stamps")
+        return pd.DataFrame({"Cz": [start, start + 1.0]}, index=index)
+
+    def test_split_recordings_are_appended_as_parts(self):
+        for idx, start in enumerate([0.0, 10.0, 20.0]):
+            export_stream(self._split(start), self.export_path, OutputFormat.PARQUET, idx > 0)
+
+        self.assertTrue(self.export_path.is_dir())
+        self.assertEqual(len(list(self.export_path.iterdir())), 3)
+        df = Recording.read_parquet(self.export_path)
+        self.assertEqual(df.index.tolist(), [0.0, 0.5, 10.0, 10.5, 20.0, 20.5])
+
+    def test_reexport_replaces_dataset(self):
+        export_stream(self._split(0.0), self.export_path, OutputFormat.PARQUET)
+        export_stream(self._split(10.0), self.export_path, OutputFormat.PARQUET, True)
+        export_stream(self._split(30.0), self.export_path, OutputFormat.PARQUET)
+
+        self.assertTrue(self.export_path.is_file())
+        df = Recording.read_parquet(self.export_path)
+        self.assertEqual(df.index.tolist(), [30.0, 30.5])
+
+
+class ConvertTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.TemporaryDirectory()
+        cls.xdf_root = pathlib.Path(cls.tmp_dir.name) / "xdf"
+        for seed, vp_code in enumerate(["ABC12", "DEF34"]):
+            options = SyntheticOptions(duration_s=60, seed=seed)
+            generate_subject(cls.xdf_root, vp_code, options, xdf=True, parquet=False)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp_dir.cleanup()
+
+    def convert(self, name, *args):
+        """Converts a copy of the XDF files and returns the recordings"""
+        root = pathlib.Path(self.tmp_dir.name) / name
+        shutil.copytree(self.xdf_root, root)
+        paths = sorted(str(path) for path in root.glob("*/*.xdf"))
+        result = CliRunner().invoke(xdf_convert, ["--quiet", *args, *paths])
+        self.assertEqual(result.exit_code, 0, result.output)
+        return [Recording(directory) for directory in sorted(root.iterdir())]
+
+    def assertSameExports(self, recordings, expected_recordings):
+        for R, expected in zip(recordings, expected_recordings):
+            self.assertEqual(R.vp_code, expected.vp_code)
+            pd.testing.assert_frame_equal(R.read_markers(), expected.read_markers())
+            for stream_type in (
+                STREAM_TYPES.brainvision_eda, STREAM_TYPES.g_tec, STREAM_TYPES.eye_tracking
+            ):
+                with self.subTest(vp_code=R.vp_code, stream=stream_type):
+                    pd.testing.assert_frame_equal(
+                        R.read_stream(stream_type), expected.read_stream(stream_type)
+                    )
+
+    def test_streaming_and_jobs_match_serial(self):
+        serial = self.convert("serial")
+        self.assertEqual(len(serial[0].read_stream(STREAM_TYPES.g_tec)), 60 * 256)
+        streaming = self.convert("streaming", "--streaming", "--chunk-samples", "5000")
+        self.assertSameExports(streaming, serial)
+        jobs = self.convert("jobs", "--jobs", "2")
+        self.assertSameExports(jobs, serial)
+
+
+    def test_compact_split_recording(self):
+        directory = pathlib.Path(self.tmp_dir.name) / "split" / "GHI56"
+        directory.mkdir(parents=True)
+        # The recording was restarted after a minute
+        for run, start_ts in enumerate([1000.0, 1070.0], start=1):
+            recording = SyntheticRecording(SyntheticOptions(duration_s=60, start_ts=start_ts))
+            name = XDF_NAME.format(vp_code="GHI56").replace("run-001", f"run-{run:03d}")
+            recording.write_xdf(directory / name)
+        paths = sorted(str(path) for path in directory.glob("*.xdf"))
+        result = CliRunner().invoke(xdf_convert, ["--quiet", "--compact", *paths])
+        self.assertEqual(result.exit_code, 0, result.output)
+
+        R = Recording(directory)
+        export_path = R.eeg_path()
+        parts = sorted(export_path.iterdir())
+        self.assertEqual(len(parts), 2)
+        column = pq.ParquetFile(parts[0]).metadata.row_group(0).column(0)
+        self.assertEqual(column.compression, "ZSTD")
+        self.assertIn("BYTE_STREAM_SPLIT", column.encodings)
+
+        eeg = R.read_stream(STREAM_TYPES.g_tec)
+        self.assertEqual(len(eeg), 2 * 60 * 256)
+        self.assertTrue((eeg.dtypes == np.float32).all())
+        self.assertTrue(eeg.index.is_monotonic_increasing)
+        np.testing.assert_allclose(eeg.index[60 * 256] - eeg.index[0], 70)
+
+        selected = Recording.read_parquet(export_path, columns=["Fz", "Cz"], dtype="float64")
+        self.assertEqual(list(selected.columns), ["Fz", "Cz"])
+        self.assertTrue((selected.dtypes == np.float64).all())
+        np.testing.assert_array_equal(selected.to_numpy(), eeg[["Fz", "Cz"]].to_numpy())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+import pathlib
+import tempfile
+import unittest
+
+import numpy as np
+
+from processing.shared.xdf_stream import XDFStreamReader, XDFWriter
+
+
+class XDFStreamReaderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = pathlib.Path(self.tmp_dir.name) / "test.xdf"
+        self.values = np.arange(600, dtype="<f4").reshape(300, 2)
+
+        with XDFWriter(self.path) as writer:
+            ecg_id = writer.add_stream("ecg", "float32", ["ECG", "X"], 100)
+            marker_id = writer.add_stream("marker", "string", ["id"])
+            # Irregular streams carry a time stamp per sample
+            eda_id = writer.add_stream("eda", "double64", ["EDA"])
+            for chunk_idx in range(3):
+                chunk = np.s_[chunk_idx * 100 : (chunk_idx + 1) * 100]
+                time_stamps = 10 + np.arange(300)[chunk] / 100
+                writer.write_samples(ecg_id, time_stamps, self.values[chunk])
+                writer.write_samples(eda_id, time_stamps ** 2, self.values[chunk, :1])
+                for stream_id in (ecg_id, eda_id):
+                    writer.write_clock_offset(stream_id, 10 + chunk_idx, 0.5)
+                writer.write_samples(marker_id, [10 + chunk_idx], [["7"]])
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_scan(self):
+        headers = XDFStreamReader(self.path, names=["ecg"]).scan()
+        self.assertEqual(list(headers), [1])
+        self.assertEqual(headers[1].columns, ["ECG", "X"])
+        self.assertEqual(len(headers[1].clock_times), 3)
+
+    def test_read_numeric_stream(self):
+        reader = XDFStreamReader(self.path)
+        reader.scan()
+        time_stamps, values = reader.read_stream(1)
+        np.testing.assert_array_equal(values, self.values)
+        np.testing.assert_allclose(time_stamps, 10.5 + np.arange(300) / 100)
+        time_stamps, values = reader.read_stream(3, clock_sync=False)
+        np.testing.assert_array_equal(values, self.values[:, :1])
+        np.testing.assert_array_equal(time_stamps, (10 + np.arange(300) / 100) ** 2)
+
+    def test_read_string_stream(self):
+        reader = XDFStreamReader(self.path)
+        reader.scan()
+        time_stamps, values = reader.read_stream(2, clock_sync=False)
+        self.assertEqual(values, [["7"]] * 3)
+        np.testing.assert_array_equal(time_stamps, [10, 11, 12])
+
+
+if __name__ == "__main__":
+    unittest.main()